@@ -0,0 +1,166 @@
+"""
+MedGemma CPU Inference Benchmark
+================================
+Generated tokens/sec and per-note latency of the extraction engine on CPU,
+for sizing clinic deployments without GPUs.
+
+1. Synthesize clinical notes of a fixed length
+2. Run them through HypothesisExtractor at each batch size, on one backend:
+     stand_in    deterministic CPU stand-in (no model; checks the harness)
+     torch       PyTorch fp32 on CPU
+     torch_int8  PyTorch with dynamic int8 Linear layers
+     onnx        an export_cpu_model() directory in ONNX Runtime
+3. Report notes/sec, generated tokens/sec and p50/p95 per-note latency
+   (a note's latency is the wall time of the batch it ran in)
+
+Usage:
+    python benchmark_cpu_inference.py --backend torch_int8 --model hf-internal-testing/tiny-random-LlamaForCausalLM
+    python benchmark_cpu_inference.py --backend onnx --model ../output/cpu_model --threads 16
+    python benchmark_cpu_inference.py --backend stand_in
+"""
+
+import argparse
+import json
+import random
+import sys
+import time
+from pathlib import Path
+from typing import List, Optional
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from src.ai.hypothesis_extractor import (  # noqa: E402
+    ExtractionBackend, GenerationParams, HypothesisExtractor, StandInBackend,
+)
+from synthetic_text import synth_text  # noqa: E402
+
+BACKENDS = ["stand_in", "torch", "torch_int8", "onnx"]
+DEFAULT_MODEL = "hf-internal-testing/tiny-random-LlamaForCausalLM"
+
+
+class TimedBackend(ExtractionBackend):
+    """Records (batch_size, seconds) for every generate() call of the wrapped backend."""
+
+    def __init__(self, backend: ExtractionBackend):
+        self.backend = backend
+        self.name = backend.name
+        self.calls: List[tuple] = []
+
+    def count_tokens(self, prompts, add_special_tokens=True):
+        return self.backend.count_tokens(prompts, add_special_tokens=add_special_tokens)
+
+    def generate(self, prompts, params, prefix=None):
+        t0 = time.perf_counter()
+        out = self.backend.generate(prompts, params, prefix=prefix)
+        self.calls.append((len(prompts), time.perf_counter() - t0))
+        return out
+
+
+def load_backend(kind: str, model: str, threads: Optional[int], stand_in_latency: float) -> ExtractionBackend:
+    if kind == "stand_in":
+        return StandInBackend(latency=stand_in_latency)
+    from src.ai.cpu_backend import CPUBackend
+    if kind == "onnx":
+        return CPUBackend.from_export(model, num_threads=threads)
+    return CPUBackend.from_pretrained(model, quantize=kind == "torch_int8", num_threads=threads)
+
+
+def percentile(values: List[float], p: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))] if ordered else 0.0
+
+
+def run(backend: ExtractionBackend, notes: List[str], batch_size: int, params: GenerationParams) -> dict:
+    timed = TimedBackend(backend)
+    extractor = HypothesisExtractor(timed, params, max_batch_size=batch_size,
+                                    max_batch_tokens=1 << 30, window=max(64, batch_size))
+    before = backend.generated_tokens
+    t0 = time.perf_counter()
+    for _ in extractor.extract(notes):
+        pass
+    elapsed = time.perf_counter() - t0
+    tokens = backend.generated_tokens - before
+
+    latencies = [seconds for size, seconds in timed.calls for _ in range(size)]
+    return {
+        "batch_size": batch_size,
+        "notes": len(notes),
+        "seconds": round(elapsed, 3),
+        "notes_per_sec": round(len(notes) / elapsed, 2),
+        "generated_tokens": tokens,
+        "tokens_per_sec": round(tokens / elapsed, 1),
+        "latency_p50_ms": round(percentile(latencies, 50) * 1000, 1),
+        "latency_p95_ms": round(percentile(latencies, 95) * 1000, 1),
+        "prompt_tokens": extractor.stats.prompt_tokens,
+        "padding_efficiency": round(extractor.stats.padding_efficiency, 3),
+    }
+
+
+# ─────────────────────────────────────────────
+# MAIN
+# ─────────────────────────────────────────────
+
+def main():
+    parser = argparse.ArgumentParser(description="MedGemma CPU Inference Benchmark")
+    parser.add_argument("--backend",        default="torch_int8", choices=BACKENDS)
+    parser.add_argument("--model",          default=DEFAULT_MODEL,
+                        help="HF model id/path, or an export directory for --backend onnx")
+    parser.add_argument("--notes",          type=int, default=32,
+                        help="Notes per batch-size run")
+    parser.add_argument("--note_chars",     type=int, default=1200)
+    parser.add_argument("--batch_sizes",    default="1,4,8",
+                        help="Comma-separated batch sizes to time")
+    parser.add_argument("--max_new_tokens", type=int, default=128)
+    parser.add_argument("--threads",        type=int, default=None,
+                        help="Intra-op threads (default: all available cores)")
+    parser.add_argument("--stand_in_latency_ms", type=float, default=0.0,
+                        help="Simulated device time per stand-in batch")
+    parser.add_argument("--seed",           type=int, default=7)
+    parser.add_argument("--output",         default=None,
+                        help="Also write the results to this JSON file")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    notes = ["SUBJECTIVE: " + synth_text(rng, args.note_chars) for _ in range(args.notes)]
+    batch_sizes = [int(b) for b in args.batch_sizes.split(",") if b.strip()]
+    # Fixed work per note: a small stand-in model never writes the reasoning field
+    params = GenerationParams(max_new_tokens=args.max_new_tokens, early_stop=False)
+
+    t0 = time.perf_counter()
+    backend = load_backend(args.backend, args.model, args.threads, args.stand_in_latency_ms / 1000)
+    load_seconds = time.perf_counter() - t0
+
+    print(f"\n{'='*72}")
+    print(f"  {backend.name} — {args.model if args.backend != 'stand_in' else 'no model'}")
+    print(f"  threads {getattr(backend, 'num_threads', '-')}, loaded in {load_seconds:.1f}s, "
+          f"{args.notes} notes x {args.note_chars} chars, {args.max_new_tokens} new tokens")
+    print(f"{'='*72}")
+    print(f"  {'batch':>5} {'notes/s':>9} {'tok/s':>10} {'p50 ms':>9} {'p95 ms':>9} {'pad eff':>8}")
+    print(f"  {'─'*55}")
+
+    # One untimed note so lazy initialization does not land in the first row
+    run(backend, notes[:1], 1, params)
+
+    results = []
+    for batch_size in batch_sizes:
+        r = run(backend, notes, batch_size, params)
+        results.append(r)
+        print(f"  {batch_size:>5} {r['notes_per_sec']:>9.2f} {r['tokens_per_sec']:>10.1f} "
+              f"{r['latency_p50_ms']:>9.1f} {r['latency_p95_ms']:>9.1f} {r['padding_efficiency']:>8.3f}")
+    print()
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({
+                "backend": backend.name,
+                "model": args.model if args.backend != "stand_in" else None,
+                "threads": getattr(backend, "num_threads", None),
+                "load_seconds": round(load_seconds, 2),
+                "note_chars": args.note_chars,
+                "max_new_tokens": args.max_new_tokens,
+                "results": results,
+            }, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,345 @@
+"""
+MedGemma Data Pipeline Benchmark
+================================
+Throughput of the data QA stages on synthetic data — no model or API access.
+
+1. Synthesize training shards + patient scenarios (configurable count/size,
+   with a controlled fraction of WARNING / REJECT cases and model artifacts)
+2. Time each stage in a fresh process: records/sec, MB/sec, peak RSS
+   (process peak, and its growth over the inputs the stage is handed)
+3. Compare against a stored baseline JSON; any regression beyond the
+   tolerance, or a missing baseline, exits non-zero
+
+Usage:
+    python benchmark_pipeline.py --sizes 1000,100000,1000000
+    python benchmark_pipeline.py --sizes 1000 --save_baseline
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing as mp
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+from queue import Empty
+
+import data_pipeline as dp
+from synthetic_text import synth_text
+
+DEFAULT_BASELINE = str(Path(__file__).with_name("benchmark_baseline.json"))
+
+STAGES = [
+    "merge_training_files",
+    "merge_training_files_streaming",
+    "validate_training_data",
+    "save_clean_training",
+    "evaluate_patients",
+]
+
+# ─────────────────────────────────────────────
+# STEP 1: SYNTHETIC DATA
+# ─────────────────────────────────────────────
+
+_DIAGNOSES = ["Pulmonary embolism", "Community-acquired pneumonia", "Ovarian cancer",
+              "Acute coronary syndrome", "Deep vein thrombosis", "Hyponatremia"]
+
+
+def synth_training_example(rng: random.Random, note_chars: int,
+                           warn_frac: float, reject_frac: float, artifact_frac: float) -> dict:
+    """One training example; a fraction is degraded into WARNING / REJECT / artifact cases."""
+    ex = {
+        "input": "SUBJECTIVE: " + synth_text(rng, note_chars),
+        "output": {
+            "primary_hypothesis": rng.choice(_DIAGNOSES),
+            "differential_diagnoses": rng.sample(_DIAGNOSES, 3),
+            "key_symptoms": [synth_text(rng, 20), synth_text(rng, 20), synth_text(rng, 20)],
+            "urgency": rng.choice(["high", "medium", "low"]),
+            "tests_ordered": ["CBC", "CT angiogram"],
+            "reasoning": synth_text(rng, rng.randint(120, 280)),
+        },
+    }
+    roll = rng.random()
+    if roll < reject_frac:
+        del ex["output"][rng.choice(dp.REQUIRED_OUTPUT_FIELDS)]
+    elif roll < reject_frac + warn_frac:
+        ex["output"]["reasoning"] = synth_text(rng, 20)
+    elif roll < reject_frac + warn_frac + artifact_frac:
+        ex["output"]["reasoning"] += " <unused42>"
+    return ex
+
+
+def synth_patient(rng: random.Random, i: int, note_chars: int,
+                  warn_frac: float, reject_frac: float, artifact_frac: float) -> dict:
+    """One patient scenario with the fields evaluate_patient checks."""
+    p = {
+        "patient_id": f"P{i:07d}",
+        "demographics": {"age": rng.randint(18, 90), "sex": rng.choice("MF")},
+        "visit_date": "2026-01-15",
+        "clinical_note": {"text": "SUBJECTIVE: " + synth_text(rng, note_chars)},
+        "orders": [{"test_name": "CT abdomen", "status": "pending",
+                    "days_pending": rng.randint(2, 30), "failure_reason": synth_text(rng, 40)},
+                   {"test_name": "CBC", "status": "completed"}],
+        "results": [{"test_name": "CBC", "full_text": synth_text(rng, 120)}],
+        "diagnostic_hypothesis": {"primary": rng.choice(_DIAGNOSES), "reasoning": synth_text(rng, 150)},
+        "ground_truth_diagnosis": rng.choice(_DIAGNOSES),
+        "failure_mode": synth_text(rng, 80),
+        "ai_should_flag": [synth_text(rng, 30), synth_text(rng, 30)],
+    }
+    roll = rng.random()
+    if roll < reject_frac:
+        for field in ("failure_mode", "diagnostic_hypothesis", "results"):
+            del p[field]
+    elif roll < reject_frac + warn_frac:
+        p["orders"][0].pop("failure_reason")
+    elif roll < reject_frac + warn_frac + artifact_frac:
+        p["clinical_note"]["text"] += " <unused7>"
+    return p
+
+
+def synthesize(workdir: Path, n: int, args) -> dict:
+    """Write n training examples (sharded) and n patients; return input paths + sizes."""
+    rng = random.Random(args.seed)
+    train_dir = workdir / "training"
+    train_dir.mkdir(parents=True, exist_ok=True)
+
+    for start in range(0, n, args.shard_size):
+        count = min(args.shard_size, n - start)
+        shard = [synth_training_example(rng, args.note_chars, args.warn_frac,
+                                        args.reject_frac, args.artifact_frac)
+                 for _ in range(count)]
+        with open(train_dir / f"shard_{start // args.shard_size:05d}.json", "w") as f:
+            json.dump(shard, f)
+
+    patients_path = workdir / "patients.json"
+    with open(patients_path, "w") as f:
+        f.write('{"patient_scenarios": [')
+        for i in range(n):
+            f.write(("," if i else "") + json.dumps(
+                synth_patient(rng, i, args.note_chars, args.warn_frac,
+                              args.reject_frac, args.artifact_frac)))
+        f.write("]}")
+
+    train_bytes = sum(p.stat().st_size for p in train_dir.glob("*.json"))
+    return {"training_dir": str(train_dir), "training_bytes": train_bytes,
+            "patients_file": str(patients_path), "patients_bytes": patients_path.stat().st_size,
+            "workdir": str(workdir)}
+
+
+# ─────────────────────────────────────────────
+# STEP 2: TIMED STAGES (one fresh process each)
+# ─────────────────────────────────────────────
+
+def _peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS bytes
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def _run_stage(stage: str, inputs: dict, queue) -> None:
+    """Child process: load the stage's inputs, time only the stage itself."""
+    quiet = io.StringIO()
+    with contextlib.redirect_stdout(quiet):
+        examples = results = patients = None
+        if stage in ("validate_training_data", "save_clean_training"):
+            examples = dp.merge_training_files(inputs["training_dir"])
+        if stage == "save_clean_training":
+            results = dp.validate_training_data(examples)
+        if stage == "evaluate_patients":
+            with open(inputs["patients_file"]) as f:
+                patients = json.load(f)["patient_scenarios"]
+
+        out_dir = Path(inputs["workdir"]) / "out"
+        out_dir.mkdir(exist_ok=True)
+        setup_rss = _peak_rss_mb()
+        t0 = time.perf_counter()
+        if stage == "merge_training_files":
+            n = len(dp.merge_training_files(inputs["training_dir"]))
+        elif stage == "merge_training_files_streaming":
+            n = dp.merge_training_files_streaming(inputs["training_dir"],
+                                                  str(out_dir / "merged.jsonl"))
+        elif stage == "validate_training_data":
+            dp.validate_training_data(examples)
+            n = len(examples)
+        elif stage == "save_clean_training":
+            dp.save_clean_training(examples, results, str(out_dir / "clean.json"))
+            n = len(examples)
+        else:
+            dp.evaluate_patients(patients)
+            n = len(patients)
+        elapsed = time.perf_counter() - t0
+
+    nbytes = inputs["patients_bytes"] if stage == "evaluate_patients" else inputs["training_bytes"]
+    peak = _peak_rss_mb()
+    queue.put({
+        "records": n,
+        "seconds": round(elapsed, 4),
+        "records_per_sec": round(n / elapsed, 1) if elapsed else None,
+        "mb_per_sec": round(nbytes / 1e6 / elapsed, 2) if elapsed else None,
+        "peak_rss_mb": round(peak, 1),
+        # Growth of the peak past the setup (loaded/validated inputs); the
+        # process peak above includes that setup
+        "stage_rss_mb": round(peak - setup_rss, 1),
+    })
+
+
+def time_stage(stage: str, inputs: dict, timeout: float | None = None) -> dict:
+    """
+    Run one stage in a fresh interpreter, so no earlier stage's memory counts
+    towards its peak RSS. Raises RuntimeError if the child dies without
+    reporting or runs past `timeout` seconds.
+    """
+    ctx = mp.get_context("spawn")
+    queue = ctx.Queue()
+    proc = ctx.Process(target=_run_stage, args=(stage, inputs, queue))
+    proc.start()
+    deadline = time.monotonic() + timeout if timeout else None
+    try:
+        while True:
+            try:
+                return queue.get(timeout=1.0)
+            except Empty:
+                pass
+            if not proc.is_alive():
+                try:  # the result may have been flushed just before exit
+                    return queue.get(timeout=1.0)
+                except Empty:
+                    raise RuntimeError(f"{stage}: process exited with code {proc.exitcode} "
+                                       "without reporting") from None
+            if deadline and time.monotonic() > deadline:
+                proc.terminate()
+                raise RuntimeError(f"{stage}: no result after {timeout:.0f}s")
+    finally:
+        proc.join()
+
+
+# ─────────────────────────────────────────────
+# STEP 3: BASELINE COMPARISON
+# ─────────────────────────────────────────────
+
+# Stage RSS growth below this is allocator noise at small sizes
+RSS_FLOOR_MB = 16
+
+
+def compare_to_baseline(current: dict, baseline: dict, tolerance: float) -> list[str]:
+    """
+    Regression messages: throughput below, or the stage's own RSS growth
+    (stage_rss_mb) above, baseline by > tolerance; RSS also needs to grow by
+    more than RSS_FLOOR_MB. peak_rss_mb includes the setup and is reported only.
+    """
+    regressions = []
+    for size, stages in current.items():
+        for stage, m in stages.items():
+            base = baseline.get(size, {}).get(stage)
+            if not base:
+                continue
+            if base.get("records_per_sec") and m["records_per_sec"] is not None and \
+                    m["records_per_sec"] < base["records_per_sec"] * (1 - tolerance):
+                regressions.append(
+                    f"{stage} @ {size}: {m['records_per_sec']:.0f} rec/s "
+                    f"vs baseline {base['records_per_sec']:.0f}")
+            if "stage_rss_mb" in base and \
+                    m["stage_rss_mb"] > base["stage_rss_mb"] * (1 + tolerance) + RSS_FLOOR_MB:
+                regressions.append(
+                    f"{stage} @ {size}: stage RSS +{m['stage_rss_mb']:.0f} MB "
+                    f"vs baseline +{base['stage_rss_mb']:.0f} MB")
+    return regressions
+
+
+# ─────────────────────────────────────────────
+# MAIN
+# ─────────────────────────────────────────────
+
+def main():
+    parser = argparse.ArgumentParser(description="MedGemma Data Pipeline Benchmark")
+    parser.add_argument("--sizes",         default="1000,100000,1000000",
+                        help="Comma-separated record counts")
+    parser.add_argument("--stages",        default=",".join(STAGES),
+                        help="Comma-separated subset of stages to time")
+    parser.add_argument("--note_chars",    type=int, default=1200,
+                        help="Clinical note length per record")
+    parser.add_argument("--shard_size",    type=int, default=1000,
+                        help="Training examples per synthetic file")
+    parser.add_argument("--warn_frac",     type=float, default=0.10)
+    parser.add_argument("--reject_frac",   type=float, default=0.05)
+    parser.add_argument("--artifact_frac", type=float, default=0.01)
+    parser.add_argument("--seed",          type=int, default=7)
+    parser.add_argument("--baseline",      default=DEFAULT_BASELINE,
+                        help="Baseline JSON to compare against")
+    parser.add_argument("--save_baseline", action="store_true",
+                        help="Write this run's numbers as the new baseline")
+    parser.add_argument("--tolerance",     type=float, default=0.20,
+                        help="Allowed relative slowdown / stage RSS growth")
+    parser.add_argument("--stage_timeout", type=float, default=3600,
+                        help="Seconds before a stage counts as hung")
+    parser.add_argument("--output",        default=None,
+                        help="Also write this run's numbers to this JSON file")
+    args = parser.parse_args()
+
+    sizes = [int(s) for s in args.sizes.split(",") if s.strip()]
+    stages = [s.strip() for s in args.stages.split(",") if s.strip()]
+    unknown = set(stages) - set(STAGES)
+    if unknown:
+        parser.error(f"Unknown stages: {', '.join(sorted(unknown))}")
+    if not args.save_baseline and not os.path.exists(args.baseline):
+        print(f"  ❌ No baseline at {args.baseline} — run with --save_baseline to create one")
+        sys.exit(1)
+
+    current = {}
+    for n in sizes:
+        workdir = Path(tempfile.mkdtemp(prefix=f"tracer_bench_{n}_"))
+        try:
+            print(f"\n{'='*65}")
+            print(f"  {n:,} RECORDS")
+            print(f"{'='*65}")
+            t0 = time.perf_counter()
+            inputs = synthesize(workdir, n, args)
+            print(f"  🧪 Synthesized in {time.perf_counter() - t0:.1f}s "
+                  f"(training {inputs['training_bytes']/1e6:.1f} MB, "
+                  f"patients {inputs['patients_bytes']/1e6:.1f} MB)")
+            print(f"  {'stage':<32} {'rec/s':>10} {'MB/s':>8} {'peak RSS':>10} {'stage':>9}")
+            print(f"  {'─'*72}")
+
+            current[str(n)] = {}
+            for stage in stages:
+                m = time_stage(stage, inputs, args.stage_timeout)
+                current[str(n)][stage] = m
+                print(f"  {stage:<32} {m['records_per_sec'] or 0:>10,.0f} "
+                      f"{m['mb_per_sec'] or 0:>8.1f} {m['peak_rss_mb']:>7.0f} MB "
+                      f"{m['stage_rss_mb']:>+6.0f} MB")
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(current, f, indent=2)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(current, f, indent=2)
+        print(f"\n  💾 Baseline saved → {args.baseline}\n")
+        return
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    regressions = compare_to_baseline(current, baseline, args.tolerance)
+
+    print(f"\n{'='*65}")
+    if regressions:
+        print(f"  ❌ REGRESSIONS vs baseline (tolerance {args.tolerance:.0%}):")
+        for r in regressions:
+            print(f"     {r}")
+        print(f"{'='*65}\n")
+        sys.exit(1)
+    print(f"  ✅ Within {args.tolerance:.0%} of baseline")
+    print(f"{'='*65}\n")
+
+
+if __name__ == "__main__":
+    main()
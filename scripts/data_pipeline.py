@@ -2,16 +2,35 @@
 MedGemma Data Pipeline
 ======================
 1. Merge multiple training JSON files → training_final_400.json
+   (--stream: constant-memory merge via training_merged.jsonl)
+   (--incremental: reuse cached results for unchanged files)
+   (--artifact_scan: byte-level scan for model artifacts before parsing)
 2. Validate training examples (schema + medical quality checks)
+   (--dedup: drop near-duplicate notes via MinHash/LSH)
+   (--shard: also emit a JSONL + offset-index shard for random access)
 3. Evaluate patient scenarios (completeness + demo readiness)
+   (--stream: one pass, bounded memory, per-patient JSONL report)
+
+Checks run as a compiled rule plan over one or more QA profiles in a single
+pass (--profiles strict,lenient); data_qa_pipeline.py is the strict entry point.
 
 Usage:
     python data_pipeline.py --training_dir ./training_data --patients_file ./patients.json
 """
 
+import bisect
+import csv
+import hashlib
+import heapq
 import json
+import mmap
 import os
+import re
+import struct
 import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
 from pathlib import Path
 from typing import Any
 
@@ -19,13 +38,13 @@ from typing import Any
 # STEP 1: MERGE TRAINING JSON FILES
 # ─────────────────────────────────────────────
 
-def merge_training_files(training_dir: str) -> list[dict]:
-    """Merge all JSON files in a directory into one list."""
+def merge_training_files(training_dir: str, skip: set[Path] | None = None) -> list[dict]:
+    """Merge all JSON files in a directory into one list (minus any in `skip`)."""
     training_dir = Path(training_dir)
     all_examples = []
     files_found = []
 
-    for json_file in sorted(training_dir.glob("**/*.json")):
+    for json_file in _training_files(training_dir, skip):
         try:
             with open(json_file, "r") as f:
                 data = json.load(f)
@@ -47,17 +66,26 @@ def merge_training_files(training_dir: str) -> list[dict]:
         except Exception as e:
             print(f"  ❌ Error reading {json_file.name}: {e}")
 
+    _print_merge_summary(files_found, len(all_examples))
+
+    return all_examples
+
+
+def _training_files(training_dir: Path, skip: set[Path] | None = None) -> list[Path]:
+    files = sorted(training_dir.glob("**/*.json"))
+    return [f for f in files if f not in skip] if skip else files
+
+
+def _print_merge_summary(files_found: list[tuple], total: int) -> None:
     print(f"\n{'='*55}")
     print(f"  MERGE SUMMARY")
     print(f"{'='*55}")
     for fname, count in files_found:
         print(f"  ✅ {fname:<40} {count:>4} examples")
     print(f"{'─'*55}")
-    print(f"  {'TOTAL':<40} {len(all_examples):>4} examples")
+    print(f"  {'TOTAL':<40} {total:>4} examples")
     print(f"{'='*55}\n")
 
-    return all_examples
-
 
 def save_merged(examples: list[dict], output_path: str) -> None:
     with open(output_path, "w") as f:
@@ -65,6 +93,168 @@ def save_merged(examples: list[dict], output_path: str) -> None:
     print(f"  💾 Saved merged file → {output_path}\n")
 
 
+# ── Streaming merge (constant memory, JSONL output)
+
+STREAM_CHUNK_SIZE = 1 << 16  # 64 KB reads
+
+
+class _JSONStream:
+    """
+    Incremental reader over a JSON file.
+    Decodes one value at a time with raw_decode, refilling the buffer
+    only when a value straddles the end of what has been read so far.
+    """
+
+    def __init__(self, f, chunk_size: int = STREAM_CHUNK_SIZE):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def _fill(self) -> bool:
+        if self.eof:
+            return False
+        chunk = self.f.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        # Drop the consumed prefix so the buffer never grows past one value
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self) -> str:
+        """Next non-whitespace char ('' at EOF), without consuming it."""
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in " \t\r\n":
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                return ""
+
+    def expect(self, char: str) -> None:
+        if self.peek() != char:
+            raise json.JSONDecodeError(f"Expected '{char}'", self.buf, self.pos)
+        self.pos += 1
+
+    def value(self) -> Any:
+        """Decode the next complete JSON value."""
+        self.peek()
+        while True:
+            try:
+                obj, end = self.decoder.raw_decode(self.buf, self.pos)
+                # A number/literal ending exactly at the buffer edge may be cut short
+                if end < len(self.buf) or not self._fill():
+                    self.pos = end
+                    return obj
+            except json.JSONDecodeError:
+                if not self._fill():
+                    raise
+
+    def iter_array(self):
+        """Yield elements of the array starting at the current position."""
+        self.expect("[")
+        if self.peek() == "]":
+            self.pos += 1
+            return
+        while True:
+            yield self.value()
+            sep = self.peek()
+            self.pos += 1
+            if sep == "]":
+                return
+            if sep != ",":
+                raise json.JSONDecodeError("Expected ',' or ']'", self.buf, self.pos - 1)
+
+
+def iter_training_file(json_file: Path, list_key: str = "examples"):
+    """
+    Yield examples from one training file without loading it whole.
+    Supports array files, {"examples": [...]} files and single-object files
+    (list_key="patient_scenarios" reads patient files the same way).
+    """
+    with open(json_file, "r") as f:
+        stream = _JSONStream(f)
+        first = stream.peek()
+
+        if first == "[":
+            yield from stream.iter_array()
+        elif first == "{":
+            # Walk the object key by key so an "examples" list can be streamed
+            stream.expect("{")
+            other = {}
+            streamed = False
+            while stream.peek() != "}":
+                key = stream.value()
+                stream.expect(":")
+                if key == list_key and stream.peek() == "[":
+                    yield from stream.iter_array()
+                    streamed = True
+                else:
+                    other[key] = stream.value()
+                if stream.peek() == ",":
+                    stream.pos += 1
+            stream.pos += 1
+            if not streamed:
+                yield other
+        elif first:
+            raise json.JSONDecodeError("Expected array or object", stream.buf, stream.pos)
+
+
+def merge_training_files_streaming(training_dir: str, output_path: str,
+                                   skip: set[Path] | None = None) -> int:
+    """
+    Streaming variant of merge_training_files.
+    Writes one example per line (JSONL) as files are parsed; memory stays
+    bounded by the largest single example rather than the corpus size.
+    Returns the number of examples written.
+    """
+    training_dir = Path(training_dir)
+    files_found = []
+    total = 0
+
+    with open(output_path, "w") as out:
+        for json_file in _training_files(training_dir, skip):
+            start = out.tell()
+            count = 0
+            try:
+                for ex in iter_training_file(json_file):
+                    out.write(json.dumps(ex) + "\n")
+                    count += 1
+                files_found.append((json_file.name, count))
+                total += count
+            except Exception as e:
+                # Like the in-memory merge, a broken file contributes nothing
+                out.seek(start)
+                out.truncate()
+                if isinstance(e, json.JSONDecodeError):
+                    print(f"  ❌ JSON parse error in {json_file.name}: {e}")
+                else:
+                    print(f"  ❌ Error reading {json_file.name}: {e}")
+
+    _print_merge_summary(files_found, total)
+    print(f"  💾 Streamed merged file → {output_path}\n")
+
+    return total
+
+
+def iter_jsonl_lines(path: str):
+    """Yield the raw text of each non-empty line of a JSONL file."""
+    with open(path, "r") as f:
+        for line in f:
+            if line.strip():
+                yield line
+
+
+def iter_jsonl(path: str):
+    """Yield one parsed record per non-empty line of a JSONL file."""
+    for line in iter_jsonl_lines(path):
+        yield json.loads(line)
+
+
 # ─────────────────────────────────────────────
 # STEP 2: VALIDATE TRAINING EXAMPLES
 # ─────────────────────────────────────────────
@@ -83,103 +273,489 @@ VALID_URGENCY = {"low", "medium", "high"}
 REASONING_MIN = 50
 REASONING_MAX = 700
 
+# ── Artifact scanning (model corruption)
+#
+# One compiled alternation over every artifact token, run over raw file
+# bytes before any JSON parsing. Tokens are matched in their JSON-encoded
+# form (a newline in "thought\n" appears as the two bytes \n on disk),
+# both with and without \uXXXX escaping of non-ASCII characters.
+
+DEFAULT_ARTIFACT_TOKENS = ["<unused", "<start_of_turn>", "thought\n"]
+
+_JSON_STRUCT_RE = re.compile(rb'"(?:[^"\\]|\\.)*"|[\[\]{},]')
+
+
+class ArtifactScanner:
+    """Single-pass multi-token scanner for model artifacts."""
+
+    def __init__(self, tokens: list[str]):
+        self.tokens = list(tokens)
+        forms = {}
+        for tok in self.tokens:
+            for ensure_ascii in (True, False):
+                encoded = json.dumps(tok, ensure_ascii=ensure_ascii)[1:-1]
+                forms[encoded] = tok
+        # Longest first so overlapping tokens report the most specific one
+        ordered = sorted(forms, key=len, reverse=True)
+        self._token_of = {f.encode("utf-8"): t for f, t in forms.items()}
+        self._bytes_re = re.compile(b"|".join(re.escape(f.encode("utf-8")) for f in ordered))
+        self._text_re = re.compile("|".join(re.escape(f) for f in ordered))
+
+    def search_json(self, raw: str) -> bool:
+        """True if JSON-encoded text (e.g. json.dumps output) contains any token."""
+        return self._text_re.search(raw) is not None
+
+    def scan_bytes(self, data) -> list[tuple[int, str]]:
+        """(byte offset, token) for every hit in a bytes-like object (incl. mmap)."""
+        return [(m.start(), self._token_of[m.group()]) for m in self._bytes_re.finditer(data)]
+
+    def scan_file(self, path: Path) -> list[dict]:
+        """
+        Scan one file's raw bytes. Each hit carries file, byte offset, token and
+        record index (position in the array / JSONL line; None for hits outside
+        any record, e.g. file-level metadata).
+        """
+        if path.stat().st_size == 0:
+            return []
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            hits = self.scan_bytes(mm)
+            if not hits:
+                return []
+            if path.suffix == ".jsonl":
+                records = _jsonl_record_index(mm, [off for off, _ in hits])
+            else:
+                starts, end = _json_record_starts(mm)
+                records = [None if off < starts[0] or off >= end
+                           else bisect.bisect_right(starts, off) - 1
+                           for off, _ in hits]
+        return [{"file": str(path), "offset": off, "token": tok, "record": rec}
+                for (off, tok), rec in zip(hits, records)]
+
+
+def _jsonl_record_index(mm, offsets: list[int]) -> list[int]:
+    """Line number of each (sorted) offset, counting newlines in 1 MB windows."""
+    out, line, pos = [], 0, 0
+    for off in offsets:
+        while pos < off:
+            end = min(off, pos + (1 << 20))
+            line += mm[pos:end].count(b"\n")
+            pos = end
+        out.append(line)
+    return out
+
+
+def _json_record_starts(mm) -> tuple[list[int], int]:
+    """
+    Byte offsets where each record begins, plus the end of the record region.
+    Mirrors iter_training_file: top-level array elements, elements of a
+    top-level "examples" array, or the whole file as one record.
+    """
+    size = len(mm)
+    first = None
+    for i in range(size):
+        if mm[i:i + 1] not in b" \t\r\n":
+            first = mm[i:i + 1]
+            break
+    if first != b"[" and first != b"{":
+        return [0], size
+
+    starts, depth, target, key, prev = [], 0, None, None, None
+    for m in _JSON_STRUCT_RE.finditer(mm):
+        tok = m.group()
+        if tok[:1] == b'"':
+            # At depth 1 of an object, a string after '{' or ',' is a key
+            if depth == 1 and first == b"{" and prev in (b"{", b","):
+                key = tok
+            prev = b'"'
+            continue
+        if tok in (b"[", b"{"):
+            depth += 1
+            if target is None and tok == b"[" and (
+                    (first == b"[" and depth == 1) or
+                    (first == b"{" and depth == 2 and key == b'"examples"')):
+                target = depth
+                starts.append(m.end())
+        elif tok in (b"]", b"}"):
+            if depth == target:
+                return starts, m.start()
+            depth -= 1
+        elif tok == b"," and depth == target:
+            starts.append(m.end())
+        prev = tok
+    if target is None:
+        return [0], size  # single-object file
+    return starts, size
+
+
+ARTIFACT_SCANNER = ArtifactScanner(DEFAULT_ARTIFACT_TOKENS)
+
+
+def set_artifact_tokens(tokens: list[str]) -> None:
+    """Replace the module-wide scanner (also used as a pool initializer)."""
+    global ARTIFACT_SCANNER
+    ARTIFACT_SCANNER = ArtifactScanner(tokens)
+
+
+def scan_training_files(training_dir: str, output_dir: str) -> set[Path]:
+    """
+    Pre-parse artifact scan over every training file. Writes each hit to
+    artifact_hits.jsonl, prints a summary, and returns the poisoned files.
+    """
+    poisoned = set()
+    hits_path = os.path.join(output_dir, "artifact_hits.jsonl")
+    per_file = []
+
+    with open(hits_path, "w") as out:
+        for json_file in sorted(Path(training_dir).glob("**/*.json")):
+            try:
+                hits = ARTIFACT_SCANNER.scan_file(json_file)
+            except (OSError, ValueError) as e:
+                print(f"  ❌ Error scanning {json_file.name}: {e}")
+                continue
+            for h in hits:
+                out.write(json.dumps(h) + "\n")
+            if hits:
+                poisoned.add(json_file)
+                per_file.append((json_file.name, hits))
 
-def validate_training_example(ex: Any, idx: int) -> dict:
-    """Validate a single training example. Returns result dict."""
-    issues = []
+    print(f"\n{'='*55}")
+    print(f"  ARTIFACT SCAN ({len(ARTIFACT_SCANNER.tokens)} tokens)")
+    print(f"{'='*55}")
+    if not per_file:
+        print(f"  ✅ No model artifacts found")
+    for fname, hits in per_file:
+        records = {h["record"] for h in hits} - {None}
+        print(f"  ❌ {fname:<40} {len(hits):>4} hits in {len(records)} records")
+        for h in hits[:5]:
+            print(f"     byte {h['offset']:>10}  record {h['record']}  {h['token']!r}")
+        if len(hits) > 5:
+            print(f"     ... and {len(hits)-5} more")
+    print(f"{'='*55}\n")
+    print(f"  💾 Artifact hits → {hits_path}\n")
+
+    return poisoned
+
+
+# ── QA rule engine (profiles)
+#
+# The checks below are declared as rules: a check function plus the profile
+# parameters it reads. compile_plan groups, per rule, the profiles that share
+# the same parameter values, so one pass over a record evaluates every
+# profile and each distinct threshold is checked only once. Gate rules stop
+# evaluation for all profiles (the record is unusable either way).
+#
+# "lenient" matches this script's historical thresholds; "strict" matches
+# data_qa_pipeline.py (reasoning capped at 300 chars). Custom profiles from
+# --profiles_file are layered over "lenient".
+
+QA_PROFILES = {
+    "lenient": {
+        "input_min": 100,
+        "differential_min": 1,
+        "differential_max": 5,
+        "key_symptoms_min": 2,
+        "reasoning_min": REASONING_MIN,
+        "reasoning_max": REASONING_MAX,
+        "note_min": 200,
+        "failure_mode_min": 30,
+        "flags_min": 2,
+        "reject_score": 40,
+    },
+}
+QA_PROFILES["strict"] = {**QA_PROFILES["lenient"], "reasoning_max": 300}
+
+
+def compile_plan(rules: list[dict], profiles: dict[str, dict]) -> list[tuple]:
+    """[(rule, [(params, [profile names]), ...]), ...] — one group per distinct params."""
+    plan = []
+    for rule in rules:
+        groups = {}
+        for name, prof in profiles.items():
+            key = tuple(prof[k] for k in rule["params"])
+            groups.setdefault(key, []).append(name)
+        plan.append((rule, [(dict(zip(rule["params"], key)), names)
+                            for key, names in groups.items()]))
+    return plan
+
+
+def run_plan(plan: list[tuple], subject: Any, names: list[str]) -> tuple[dict[str, list], bool]:
+    """
+    Evaluate every rule once per parameter group.
+    Returns (findings per profile, whether a gate rule stopped evaluation).
+    """
+    found = {name: [] for name in names}
+    for rule, groups in plan:
+        fired = False
+        for params, members in groups:
+            hits = rule["check"](subject, params)
+            if hits:
+                fired = True
+                for name in members:
+                    found[name].extend(hits)
+        if fired and rule.get("gate"):
+            return found, True
+    return found, False
+
+
+# ── Training example rules (each returns a list of issue strings)
+
+def _r_input(ex, p):
+    if "input" not in ex:
+        return ["Missing 'input' field"]
+    if not isinstance(ex["input"], str) or len(ex["input"]) < p["input_min"]:
+        return [f"'input' too short ({len(ex.get('input',''))} chars, min {p['input_min']})"]
+    return []
 
-    # ── Top-level structure
-    if not isinstance(ex, dict):
-        return {"idx": idx, "status": "REJECT", "issues": ["Not a dict"]}
 
-    if "input" not in ex:
-        issues.append("Missing 'input' field")
-    elif not isinstance(ex["input"], str) or len(ex["input"]) < 100:
-        issues.append(f"'input' too short ({len(ex.get('input',''))} chars, min 100)")
+def _r_output_present(ex, p):
+    return [] if "output" in ex else ["Missing 'output' field"]
 
-    if "output" not in ex:
-        issues.append("Missing 'output' field")
-        return {"idx": idx, "status": "REJECT", "issues": issues}
 
-    out = ex["output"]
-    if not isinstance(out, dict):
-        issues.append("'output' is not a dict")
-        return {"idx": idx, "status": "REJECT", "issues": issues}
+def _r_output_dict(ex, p):
+    return [] if isinstance(ex["output"], dict) else ["'output' is not a dict"]
+
+
+def _r_required_fields(ex, p):
+    return [f"Missing output field: '{field}'"
+            for field in REQUIRED_OUTPUT_FIELDS if field not in ex["output"]]
 
-    # ── Required output fields
-    for field in REQUIRED_OUTPUT_FIELDS:
-        if field not in out:
-            issues.append(f"Missing output field: '{field}'")
 
-    # ── Field-specific checks
+def _r_primary(ex, p):
+    out = ex["output"]
     if "primary_hypothesis" in out:
         if not isinstance(out["primary_hypothesis"], str) or not out["primary_hypothesis"].strip():
-            issues.append("'primary_hypothesis' is empty or not a string")
-
-    if "differential_diagnoses" in out:
-        d = out["differential_diagnoses"]
-        if not isinstance(d, list):
-            issues.append("'differential_diagnoses' must be a list")
-        elif len(d) < 1:
-            issues.append("'differential_diagnoses' must have at least 1 item")
-        elif len(d) > 5:
-            issues.append(f"'differential_diagnoses' has {len(d)} items (max 5)")
-
-    if "key_symptoms" in out:
-        k = out["key_symptoms"]
-        if not isinstance(k, list):
-            issues.append("'key_symptoms' must be a list")
-        elif len(k) < 2:
-            issues.append("'key_symptoms' must have at least 2 items")
-
-    if "urgency" in out:
-        if out["urgency"] not in VALID_URGENCY:
-            issues.append(f"'urgency' must be low/medium/high, got: '{out['urgency']}'")
+            return ["'primary_hypothesis' is empty or not a string"]
+    return []
+
+
+def _r_differential(ex, p):
+    out = ex["output"]
+    if "differential_diagnoses" not in out:
+        return []
+    d = out["differential_diagnoses"]
+    lo, hi = p["differential_min"], p["differential_max"]
+    if not isinstance(d, list):
+        return ["'differential_diagnoses' must be a list"]
+    if len(d) < lo:
+        return [f"'differential_diagnoses' must have at least {lo} item{'s' if lo != 1 else ''}"]
+    if len(d) > hi:
+        return [f"'differential_diagnoses' has {len(d)} items (max {hi})"]
+    return []
+
+
+def _r_key_symptoms(ex, p):
+    out = ex["output"]
+    if "key_symptoms" not in out:
+        return []
+    k = out["key_symptoms"]
+    if not isinstance(k, list):
+        return ["'key_symptoms' must be a list"]
+    if len(k) < p["key_symptoms_min"]:
+        return [f"'key_symptoms' must have at least {p['key_symptoms_min']} items"]
+    return []
+
 
+def _r_urgency(ex, p):
+    out = ex["output"]
+    if "urgency" in out and out["urgency"] not in VALID_URGENCY:
+        return [f"'urgency' must be low/medium/high, got: '{out['urgency']}'"]
+    return []
+
+
+def _r_tests(ex, p):
+    out = ex["output"]
     if "tests_ordered" in out:
         t = out["tests_ordered"]
         if not isinstance(t, list) or len(t) < 1:
-            issues.append("'tests_ordered' must be a non-empty list")
-
-    if "reasoning" in out:
-        r = out["reasoning"]
-        if not isinstance(r, str):
-            issues.append("'reasoning' must be a string")
-        elif len(r) < REASONING_MIN:
-            issues.append(f"'reasoning' too short ({len(r)} chars, min {REASONING_MIN})")
-        elif len(r) > REASONING_MAX:
-            issues.append(f"'reasoning' too long ({len(r)} chars, max {REASONING_MAX})")
-
-    # ── Artifact check (model corruption)
-    raw_str = json.dumps(ex)
-    if "<unused" in raw_str or "<start_of_turn>" in raw_str or "thought\n" in raw_str:
-        issues.append("⚠️  Model artifact detected (<unused> or turn tokens)")
-
-    # ── Status
+            return ["'tests_ordered' must be a non-empty list"]
+    return []
+
+
+def _r_reasoning(ex, p):
+    out = ex["output"]
+    if "reasoning" not in out:
+        return []
+    r = out["reasoning"]
+    if not isinstance(r, str):
+        return ["'reasoning' must be a string"]
+    if len(r) < p["reasoning_min"]:
+        return [f"'reasoning' too short ({len(r)} chars, min {p['reasoning_min']})"]
+    if len(r) > p["reasoning_max"]:
+        return [f"'reasoning' too long ({len(r)} chars, max {p['reasoning_max']})"]
+    return []
+
+
+def _r_artifact(ex, p):
+    if ARTIFACT_SCANNER.search_json(json.dumps(ex)):
+        return ["⚠️  Model artifact detected (<unused> or turn tokens)"]
+    return []
+
+
+TRAINING_RULES = [
+    {"id": "input",           "params": ("input_min",),                          "check": _r_input},
+    {"id": "output_present",  "params": (),                                      "check": _r_output_present, "gate": True},
+    {"id": "output_dict",     "params": (),                                      "check": _r_output_dict,    "gate": True},
+    {"id": "required_fields", "params": (),                                      "check": _r_required_fields},
+    {"id": "primary",         "params": (),                                      "check": _r_primary},
+    {"id": "differential",    "params": ("differential_min", "differential_max"), "check": _r_differential},
+    {"id": "key_symptoms",    "params": ("key_symptoms_min",),                   "check": _r_key_symptoms},
+    {"id": "urgency",         "params": (),                                      "check": _r_urgency},
+    {"id": "tests_ordered",   "params": (),                                      "check": _r_tests},
+    {"id": "reasoning",       "params": ("reasoning_min", "reasoning_max"),       "check": _r_reasoning},
+    {"id": "artifact",        "params": (),                                      "check": _r_artifact},
+]
+
+
+def _training_status(issues: list[str]) -> str:
     if not issues:
-        status = "PASS"
-    elif any("Missing" in i or "REJECT" in i or "artifact" in i for i in issues):
-        status = "REJECT"
-    else:
-        status = "WARNING"
+        return "PASS"
+    if any("Missing" in i or "REJECT" in i or "artifact" in i for i in issues):
+        return "REJECT"
+    return "WARNING"
 
-    return {"idx": idx, "status": status, "issues": issues}
 
+# Active profiles: the first one drives the clean file and the printed report
+ACTIVE_PROFILES = {"lenient": QA_PROFILES["lenient"]}
+TRAINING_PLAN = compile_plan(TRAINING_RULES, ACTIVE_PROFILES)
 
-def validate_training_data(examples: list[dict]) -> dict:
-    """Validate all training examples and print report."""
-    results = [validate_training_example(ex, i) for i, ex in enumerate(examples)]
 
-    passed  = [r for r in results if r["status"] == "PASS"]
-    warned  = [r for r in results if r["status"] == "WARNING"]
-    failed  = [r for r in results if r["status"] == "REJECT"]
+def set_qa_profiles(profiles: dict[str, dict]) -> None:
+    """Activate profiles (name → params) and recompile both rule plans."""
+    global ACTIVE_PROFILES, TRAINING_PLAN, PATIENT_PLAN
+    ACTIVE_PROFILES = dict(profiles)
+    TRAINING_PLAN = compile_plan(TRAINING_RULES, ACTIVE_PROFILES)
+    PATIENT_PLAN = compile_plan(PATIENT_RULES, ACTIVE_PROFILES)
+
+
+def resolve_profiles(names: str, profiles_file: str | None = None) -> dict[str, dict]:
+    """Comma-separated profile names → params, with custom ones from a JSON file."""
+    known = dict(QA_PROFILES)
+    if profiles_file:
+        with open(profiles_file, "r") as f:
+            for name, overrides in json.load(f).items():
+                known[name] = {**QA_PROFILES["lenient"], **overrides}
+    resolved = {}
+    for name in (n.strip() for n in names.split(",") if n.strip()):
+        if name not in known:
+            raise ValueError(f"Unknown QA profile '{name}' (known: {', '.join(known)})")
+        resolved[name] = known[name]
+    return resolved
+
 
-    pass_rate = len(passed) / len(examples) * 100 if examples else 0
+def _init_worker(tokens: list[str], profiles: dict[str, dict]) -> None:
+    """Pool initializer: mirror the parent's artifact tokens and profiles."""
+    set_artifact_tokens(tokens)
+    set_qa_profiles(profiles)
+
+
+def validate_training_example(ex: Any, idx: int) -> dict:
+    """
+    Validate a single training example against every active profile.
+    Returns the first profile's result dict; with several profiles active it
+    also carries "profiles": {name: status}.
+    """
+    if not isinstance(ex, dict):
+        result = {"idx": idx, "status": "REJECT", "issues": ["Not a dict"]}
+        if len(ACTIVE_PROFILES) > 1:
+            result["profiles"] = {name: "REJECT" for name in ACTIVE_PROFILES}
+        return result
+
+    found, gated = run_plan(TRAINING_PLAN, ex, list(ACTIVE_PROFILES))
+    statuses = {name: "REJECT" if gated else _training_status(issues)
+                for name, issues in found.items()}
+    primary = next(iter(found))
+
+    result = {"idx": idx, "status": statuses[primary], "issues": found[primary]}
+    if len(statuses) > 1:
+        result["profiles"] = statuses
+    return result
+
+
+VALIDATION_CHUNK_SIZE = 512
+
+
+def _validate_chunk(start: int, chunk: list, decode: bool = False) -> list[tuple]:
+    """
+    Validate a contiguous slice of examples (runs inside pool workers).
+    With decode=True the chunk holds raw JSONL lines, parsed here so the
+    parent process only reads text. Returns (result, urgency) pairs;
+    urgency is None for non-dict examples.
+    """
+    out = []
+    for j, ex in enumerate(chunk):
+        if decode:
+            ex = json.loads(ex)
+        urgency = (ex.get("output", {}).get("urgency", "unknown")
+                   if isinstance(ex, dict) else None)
+        out.append((validate_training_example(ex, start + j), urgency))
+    return out
+
+
+def _iter_validated(examples, workers: int, chunk_size: int, decode: bool):
+    """
+    Yield (result, urgency) pairs in original index order.
+    With workers > 1, chunks go to a process pool; at most 2 chunks per
+    worker are in flight so streaming inputs are never read ahead in full.
+    """
+    it = iter(examples)
+    if workers <= 1:
+        for i, ex in enumerate(it):
+            yield from _validate_chunk(i, [ex], decode)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(ARTIFACT_SCANNER.tokens, ACTIVE_PROFILES)) as pool:
+        pending = deque()
+        start = 0
+        while True:
+            while len(pending) < workers * 2:
+                chunk = list(islice(it, chunk_size))
+                if not chunk:
+                    break
+                pending.append(pool.submit(_validate_chunk, start, chunk, decode))
+                start += len(chunk)
+            if not pending:
+                return
+            yield from pending.popleft().result()
+
+
+def validate_training_data(examples, workers: int = 1,
+                           chunk_size: int = VALIDATION_CHUNK_SIZE,
+                           decode: bool = False) -> dict:
+    """
+    Validate all training examples and print report.
+    Accepts any iterable (e.g. iter_jsonl) — examples are consumed in one pass.
+    workers > 1 validates chunks in a process pool; results keep index order.
+    decode=True means the iterable yields raw JSON lines (iter_jsonl_lines).
+    """
+    return report_validation(_iter_validated(examples, workers, chunk_size, decode))
+
+
+def report_validation(pairs) -> dict:
+    """Aggregate (result, urgency) pairs in index order and print the report."""
+    passed, warned, failed = [], [], []
+    urgency_counts = {}
+    profile_counts = {}
+    total = 0
+
+    for r, u in pairs:
+        if r["status"] == "PASS":
+            passed.append(r)
+        elif r["status"] == "WARNING":
+            warned.append(r)
+        else:
+            failed.append(r)
+        if u is not None:
+            urgency_counts[u] = urgency_counts.get(u, 0) + 1
+        _count_profiles(profile_counts, r)
+        total += 1
+
+    pass_rate = len(passed) / total * 100 if total else 0
 
     print(f"\n{'='*55}")
     print(f"  TRAINING DATA VALIDATION REPORT")
     print(f"{'='*55}")
-    print(f"  Total examples : {len(examples)}")
+    print(f"  Total examples : {total}")
     print(f"  ✅ PASS        : {len(passed)}  ({pass_rate:.1f}%)")
     print(f"  ⚠️  WARNING     : {len(warned)}")
     print(f"  ❌ REJECT      : {len(failed)}")
@@ -209,27 +785,518 @@ def validate_training_data(examples: list[dict]) -> dict:
             print(f"    ... and {len(failed)-10} more")
 
     # Urgency distribution
-    urgencies = [ex.get("output", {}).get("urgency", "unknown")
-                 for ex in examples if isinstance(ex, dict)]
     print(f"\n  URGENCY DISTRIBUTION:")
     for u in ["high", "medium", "low", "unknown"]:
-        count = urgencies.count(u)
+        count = urgency_counts.get(u, 0)
         bar = "█" * (count // 5)
         print(f"    {u:<8}: {count:>4}  {bar}")
 
+    _print_profile_table(profile_counts)
     print(f"{'='*55}\n")
 
-    return {"passed": passed, "warned": warned, "failed": failed, "pass_rate": pass_rate}
-
-
-def save_clean_training(examples: list[dict], results: dict, output_path: str) -> None:
-    """Save only PASS + WARNING examples (exclude REJECT)."""
+    return {"passed": passed, "warned": warned, "failed": failed, "pass_rate": pass_rate,
+            "profiles": profile_counts}
+
+
+def _count_profiles(profile_counts: dict, r: dict) -> None:
+    for name, status in r.get("profiles", {}).items():
+        counts = profile_counts.setdefault(name, {"PASS": 0, "WARNING": 0, "REJECT": 0})
+        counts[status] += 1
+
+
+def _print_profile_table(profile_counts: dict) -> None:
+    if not profile_counts:
+        return
+    print(f"\n  PROFILE VERDICTS:")
+    print(f"    {'profile':<12} {'PASS':>6} {'WARNING':>8} {'REJECT':>7}")
+    for name, c in profile_counts.items():
+        print(f"    {name:<12} {c['PASS']:>6} {c['WARNING']:>8} {c['REJECT']:>7}")
+
+
+def save_profile_columns(results, output_path: str) -> None:
+    """One row per record: idx (and patient id), then one status column per profile."""
+    rows = sorted(results, key=lambda r: r["idx"])
+    names = list(rows[0]["profiles"]) if rows else []
+    with_id = bool(rows) and "id" in rows[0]
+    with open(output_path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["idx"] + (["id"] if with_id else []) + names)
+        for r in rows:
+            writer.writerow([r["idx"]] + ([r["id"]] if with_id else []) +
+                            [r["profiles"][n] for n in names])
+    print(f"  💾 Per-profile verdicts → {output_path}\n")
+
+
+def save_clean_training(examples: list[dict], results: dict, output_path: str,
+                        drop: set[int] | None = None, shard: bool = False) -> None:
+    """
+    Save only PASS + WARNING examples (exclude REJECT and any `drop` indices).
+    shard=True also writes the JSONL + offset-index shard next to output_path.
+    """
     reject_idxs = {r["idx"] for r in results["failed"]}
-    clean = [ex for i, ex in enumerate(examples) if i not in reject_idxs]
+    drop_idxs = (drop or set()) - reject_idxs
+    clean = [ex for i, ex in enumerate(examples)
+             if i not in reject_idxs and i not in drop_idxs]
     with open(output_path, "w") as f:
         json.dump(clean, f, indent=2)
+    _print_clean_summary(output_path, len(clean), len(reject_idxs), len(drop_idxs))
+    if shard:
+        with ShardWriter(_shard_path(output_path)) as w:
+            for ex in clean:
+                w.add(json.dumps(ex))
+        _print_shard_summary(w)
+
+
+def save_clean_training_streaming(jsonl_path: str, results: dict, output_path: str,
+                                  drop: set[int] | None = None, shard: bool = False) -> None:
+    """
+    Streaming variant of save_clean_training: re-reads the merged JSONL and
+    writes PASS + WARNING examples as a flat JSON array, one example per line.
+    """
+    reject_idxs = {r["idx"] for r in results["failed"]}
+    drop_idxs = (drop or set()) - reject_idxs
+    lines = (line for i, line in enumerate(iter_jsonl_lines(jsonl_path))
+             if i not in reject_idxs and i not in drop_idxs)
+    kept = _write_json_array(lines, output_path, shard=shard)
+    _print_clean_summary(output_path, kept, len(reject_idxs), len(drop_idxs))
+
+
+def _print_clean_summary(output_path: str, kept: int, rejected: int, dropped: int = 0) -> None:
+    dup_note = f" and {dropped} near-duplicates" if dropped else ""
     print(f"  💾 Clean training data saved → {output_path}")
-    print(f"     ({len(clean)} examples after removing {len(reject_idxs)} rejections)\n")
+    print(f"     ({kept} examples after removing {rejected} rejections{dup_note})\n")
+
+
+def _write_json_array(lines, output_path: str, shard: bool = False) -> int:
+    """
+    Write already-encoded JSON lines as a flat array, one element per line.
+    shard=True tees the same lines into a JSONL + offset-index shard.
+    """
+    count = 0
+    writer = ShardWriter(_shard_path(output_path)) if shard else None
+    with open(output_path, "w") as f:
+        f.write("[")
+        for line in lines:
+            line = line.rstrip("\n")
+            f.write(("\n" if count == 0 else ",\n") + line)
+            if writer:
+                writer.add(line)
+            count += 1
+        f.write("\n]\n")
+    if writer:
+        writer.close()
+        _print_shard_summary(writer)
+    return count
+
+
+# ── Shard format (random access without parsing)
+#
+#   <name>.jsonl  one compact JSON record per line
+#   <name>.idx    8-byte magic SHARD_MAGIC, uint64 record count N, then
+#                 N + 1 uint64 byte offsets into the .jsonl (all
+#                 little-endian); record i spans offsets[i]:offsets[i+1]
+#                 including its trailing newline
+#
+# Read with src/utils/data_loader.py::JSONLShard (memory-mapped).
+
+SHARD_MAGIC = b"TRCSHRD1"
+_U64 = struct.Struct("<Q")
+
+
+def _shard_path(json_path: str) -> str:
+    return str(Path(json_path).with_suffix(".jsonl"))
+
+
+class ShardWriter:
+    """Append encoded JSON lines to a shard; offsets are streamed to the index."""
+
+    def __init__(self, data_path: str):
+        self.data_path = data_path
+        self.index_path = str(Path(data_path).with_suffix(".idx"))
+        self.count = 0
+        self.offset = 0
+        self._data = open(data_path, "wb")
+        self._index = open(self.index_path, "wb")
+        self._index.write(SHARD_MAGIC + _U64.pack(0) + _U64.pack(0))
+
+    def add(self, line: str) -> None:
+        raw = line.encode("utf-8") + b"\n"
+        self._data.write(raw)
+        self.offset += len(raw)
+        self._index.write(_U64.pack(self.offset))
+        self.count += 1
+
+    def close(self) -> None:
+        self._data.close()
+        self._index.seek(len(SHARD_MAGIC))
+        self._index.write(_U64.pack(self.count))
+        self._index.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _print_shard_summary(writer: ShardWriter) -> None:
+    print(f"  💾 Shard ({writer.count} records) → {writer.data_path} + "
+          f"{Path(writer.index_path).name}\n")
+
+
+# ── Incremental runs (content-hash manifest)
+#
+# Each training file is parsed once into a JSONL "piece" under
+# <output_dir>/.pipeline_cache/, named by its SHA-256. The manifest records
+# path, size, mtime, hash and per-example validation results, so a rerun
+# only reparses files whose size/mtime changed and whose hash differs.
+# Changing this script (e.g. REASONING_MAX) invalidates the whole cache.
+
+MANIFEST_NAME = "pipeline_manifest.json"
+CACHE_DIRNAME = ".pipeline_cache"
+
+
+def _file_sha256(path: Path) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _rules_fingerprint() -> str:
+    """Script source + active profiles + artifact tokens."""
+    h = hashlib.sha256(_file_sha256(Path(__file__)).encode())
+    h.update(json.dumps([ACTIVE_PROFILES, ARTIFACT_SCANNER.tokens], sort_keys=True).encode())
+    return h.hexdigest()
+
+
+def load_manifest(output_dir: str) -> dict:
+    """Load the manifest, or start a fresh one if missing or built by other rules."""
+    path = Path(output_dir) / MANIFEST_NAME
+    rules = _rules_fingerprint()
+    if path.exists():
+        try:
+            with open(path, "r") as f:
+                manifest = json.load(f)
+            if manifest.get("rules") == rules:
+                return manifest
+        except (json.JSONDecodeError, OSError):
+            pass
+    return {"rules": rules, "files": {}}
+
+
+def _build_piece(json_file: Path, digest: str, cache_dir: Path, workers: int) -> dict:
+    """Parse + validate one training file into a cached piece. Returns its manifest entry."""
+    piece = cache_dir / f"{digest}.jsonl"
+    tmp = piece.with_suffix(".tmp")
+    try:
+        with open(tmp, "w") as out:
+            for ex in iter_training_file(json_file):
+                out.write(json.dumps(ex) + "\n")
+    except Exception as e:
+        tmp.unlink(missing_ok=True)
+        kind = "JSON parse error" if isinstance(e, json.JSONDecodeError) else "Error reading"
+        return {"sha256": digest, "error": f"{kind} in {json_file.name}: {e}"}
+    os.replace(tmp, piece)
+
+    results = [[r["status"], r["issues"], u, r.get("profiles")] for r, u in
+               _iter_validated(iter_jsonl_lines(piece), workers,
+                               VALIDATION_CHUNK_SIZE, decode=True)]
+    return {"sha256": digest, "count": len(results), "results": results}
+
+
+def run_incremental(training_dir: str, output_dir: str, workers: int = 1,
+                    skip: set[Path] | None = None, shard: bool = False,
+                    dedup_threshold: float | None = None) -> dict | None:
+    """
+    Merge + validate using the manifest cache, then rebuild
+    training_merged.json, training_final_400.json and the report from pieces.
+    dedup_threshold set: also drop near-duplicates across all pieces.
+    Returns the validation results (None if there were no examples).
+    """
+    training_dir = Path(training_dir)
+    cache_dir = Path(output_dir) / CACHE_DIRNAME
+    cache_dir.mkdir(parents=True, exist_ok=True)
+
+    manifest = load_manifest(output_dir)
+    old_files = manifest["files"]
+    files = {}
+    reused = 0
+
+    for json_file in _training_files(training_dir, skip):
+        rel = json_file.relative_to(training_dir).as_posix()
+        st = json_file.stat()
+        entry = old_files.get(rel)
+        piece_ok = entry is not None and (
+            "error" in entry or (cache_dir / f"{entry['sha256']}.jsonl").exists())
+
+        if piece_ok and entry["size"] == st.st_size and entry["mtime"] == st.st_mtime_ns:
+            reused += 1
+        else:
+            digest = _file_sha256(json_file)
+            if piece_ok and entry["sha256"] == digest:
+                reused += 1  # touched but unchanged
+            else:
+                entry = _build_piece(json_file, digest, cache_dir, workers)
+        entry = {**entry, "path": rel, "size": st.st_size, "mtime": st.st_mtime_ns}
+        files[rel] = entry
+
+    # ── Merge summary (errors re-reported from cache)
+    files_found = []
+    total = 0
+    for rel, entry in files.items():
+        if "error" in entry:
+            print(f"  ❌ {entry['error']}")
+        else:
+            files_found.append((Path(rel).name, entry["count"]))
+            total += entry["count"]
+    _print_merge_summary(files_found, total)
+    print(f"  ♻️  {reused} files reused from cache, "
+          f"{len(files) - reused} reparsed + revalidated\n")
+
+    pieces = [(cache_dir / f"{e['sha256']}.jsonl", e) for e in files.values() if "error" not in e]
+
+    def all_lines():
+        for piece, _ in pieces:
+            yield from iter_jsonl_lines(piece)
+
+    def clean_lines(drop):
+        i = 0
+        for piece, e in pieces:
+            for line, (status, *_) in zip(iter_jsonl_lines(piece), e["results"]):
+                if status != "REJECT" and i not in drop:
+                    yield line
+                i += 1
+
+    def pairs():
+        offset = 0
+        for _, e in pieces:
+            for j, (status, issues, u, profiles) in enumerate(e["results"]):
+                r = {"idx": offset + j, "status": status, "issues": issues}
+                if profiles:
+                    r["profiles"] = profiles
+                yield r, u
+            offset += e["count"]
+
+    if total:
+        merged_path = os.path.join(output_dir, "training_merged.json")
+        _write_json_array(all_lines(), merged_path)
+        print(f"  💾 Saved merged file → {merged_path}\n")
+
+        val_results = report_validation(pairs())
+
+        drop = set()
+        if dedup_threshold is not None:
+            # Dedup is not cached per piece: a duplicate can span two files
+            drop = dedup_training_examples((json.loads(line) for line in all_lines()), output_dir,
+                                           dedup_threshold,
+                                           rejected={r["idx"] for r in val_results["failed"]})
+
+        clean_path = os.path.join(output_dir, "training_final_400.json")
+        kept = _write_json_array(clean_lines(drop), clean_path, shard=shard)
+        _print_clean_summary(clean_path, kept, len(val_results["failed"]), len(drop))
+    else:
+        val_results = None
+        print("  ❌ No training examples found")
+
+    # ── Persist manifest, drop pieces no file points at any more
+    manifest["files"] = files
+    tmp = Path(output_dir) / (MANIFEST_NAME + ".tmp")
+    with open(tmp, "w") as f:
+        json.dump(manifest, f)
+    os.replace(tmp, Path(output_dir) / MANIFEST_NAME)
+
+    live = {f"{e['sha256']}.jsonl" for e in files.values()}
+    for piece in cache_dir.glob("*.jsonl"):
+        if piece.name not in live:
+            piece.unlink()
+
+    return val_results
+
+
+# ─────────────────────────────────────────────
+# STEP 2b: NEAR-DUPLICATE DETECTION (MinHash + LSH)
+# ─────────────────────────────────────────────
+#
+# Each `input` note is normalized (lowercase, collapsed whitespace) and cut
+# into overlapping character shingles. Shingles are hashed and MinHash'd
+# with NumPy, batch by batch, so only the (n, num_perm) signature matrix is
+# kept. LSH banding buckets signatures that agree on a whole band; bucket
+# members are verified against the bucket head by estimated Jaccard and
+# merged with union-find. In each cluster the lowest index is kept.
+
+DEDUP_NUM_PERM   = 128
+DEDUP_BANDS      = 16      # 16 bands × 8 rows → S-curve knee ≈ 0.71
+DEDUP_THRESHOLD  = 0.8     # estimated Jaccard to count as a duplicate
+DEDUP_SHINGLE    = 9       # characters per shingle
+DEDUP_BATCH_DOCS = 1024
+
+_WS_RE = re.compile(r"\s+")
+_MERSENNE_61 = (1 << 61) - 1
+
+
+def _shingle_hashes(texts: list[str], k: int):
+    """
+    Rolling k-byte polynomial hashes for a batch of texts.
+    Returns (hashes uint64, per-text shingle counts); shingles never cross
+    text boundaries.
+    """
+    import numpy as np
+
+    encoded = [_WS_RE.sub(" ", t.lower()).strip().encode("utf-8") for t in texts]
+    lengths = np.fromiter((len(b) for b in encoded), dtype=np.int64, count=len(encoded))
+    counts = np.maximum(lengths - k + 1, 0)
+    data = np.frombuffer(b"".join(encoded), dtype=np.uint8).astype(np.uint64)
+    n_windows = max(len(data) - k + 1, 0)
+
+    h = np.zeros(n_windows, dtype=np.uint64)
+    for j in range(k):
+        h = h * np.uint64(1099511628211) + data[j:j + n_windows]
+
+    # Keep only windows that start and end inside the same text
+    starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    valid = np.zeros(n_windows, dtype=bool)
+    for s, c in zip(starts, counts):
+        valid[s:s + c] = True
+    return h[valid], counts
+
+
+def minhash_signatures(texts, num_perm: int = DEDUP_NUM_PERM, shingle_size: int = DEDUP_SHINGLE,
+                       batch_docs: int = DEDUP_BATCH_DOCS, seed: int = 1):
+    """
+    MinHash signature matrix (n, num_perm) uint32 for an iterable of texts.
+    Texts shorter than one shingle get an all-max row and are never
+    reported as duplicates.
+    """
+    import numpy as np
+
+    rng = np.random.default_rng(seed)
+    a = rng.integers(1, _MERSENNE_61, size=num_perm, dtype=np.uint64) | np.uint64(1)
+    b = rng.integers(0, _MERSENNE_61, size=num_perm, dtype=np.uint64)
+    empty = np.full(num_perm, np.iinfo(np.uint32).max, dtype=np.uint32)
+
+    blocks = []
+    it = iter(texts)
+    while True:
+        batch = list(islice(it, batch_docs))
+        if not batch:
+            break
+        hashes, counts = _shingle_hashes(batch, shingle_size)
+        sig = np.tile(empty, (len(batch), 1))
+        has = counts > 0
+        if has.any():
+            offsets = np.concatenate(([0], np.cumsum(counts[has])[:-1]))
+            for p in range(num_perm):
+                # Multiply-shift universal hash, top 32 bits
+                hv = ((hashes * a[p] + b[p]) >> np.uint64(32)).astype(np.uint32)
+                sig[has, p] = np.minimum.reduceat(hv, offsets)
+        blocks.append(sig)
+
+    return np.vstack(blocks) if blocks else np.empty((0, num_perm), dtype=np.uint32)
+
+
+def lsh_clusters(signatures, bands: int = DEDUP_BANDS,
+                 threshold: float = DEDUP_THRESHOLD,
+                 rejected: set[int] | None = None) -> list[dict]:
+    """
+    Near-duplicate clusters from a MinHash signature matrix.
+    Returns [{"keep": i, "drop": [j, ...], "similarity": [est_jaccard, ...]}].
+    The keeper is the lowest index not in `rejected`; rejected members are
+    left out of "drop" (they are removed as rejections anyway), and a
+    cluster with no valid member is not reported.
+    """
+    import numpy as np
+
+    n, num_perm = signatures.shape
+    rows = num_perm // bands
+    parent = list(range(n))
+
+    def find(x):
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    real = ~(signatures == np.iinfo(np.uint32).max).all(axis=1)
+    idx = np.flatnonzero(real)
+    mult = (np.arange(1, rows + 1, dtype=np.uint64) * np.uint64(0x9E3779B97F4A7C15)) | np.uint64(1)
+
+    for band in range(bands):
+        block = signatures[idx, band * rows:(band + 1) * rows].astype(np.uint64)
+        keys = (block * mult).sum(axis=1)
+        order = np.argsort(keys, kind="stable")
+        sorted_keys = keys[order]
+        bounds = np.flatnonzero(np.diff(sorted_keys)) + 1
+        for group in np.split(order, bounds):
+            if len(group) < 2:
+                continue
+            members = idx[group]
+            head = members[0]
+            sims = (signatures[members[1:]] == signatures[head]).mean(axis=1)
+            for m in members[1:][sims >= threshold]:
+                ra, rb = find(head), find(int(m))
+                if ra != rb:
+                    parent[max(ra, rb)] = min(ra, rb)
+
+    groups = {}
+    for i in idx:
+        groups.setdefault(find(int(i)), []).append(int(i))
+
+    rejected = rejected or set()
+    clusters = []
+    for members in sorted(groups.values()):
+        valid = [i for i in members if i not in rejected]
+        if len(valid) < 2:
+            continue
+        keep, drop = valid[0], valid[1:]
+        sims = (signatures[drop] == signatures[keep]).mean(axis=1)
+        clusters.append({"keep": keep, "drop": drop,
+                         "similarity": [round(float(x), 3) for x in sims]})
+    return clusters
+
+
+def dedup_training_examples(examples, output_dir: str,
+                            threshold: float = DEDUP_THRESHOLD,
+                            rejected: set[int] | None = None) -> set[int]:
+    """
+    Find near-duplicate `input` notes, write dedup_report.json and print a
+    summary. Accepts any iterable; returns the indices to drop. Pass the
+    REJECT indices as `rejected` so each cluster keeps a valid example.
+    """
+    texts = (ex.get("input", "") if isinstance(ex, dict) and isinstance(ex.get("input"), str)
+             else "" for ex in examples)
+    signatures = minhash_signatures(texts)
+    clusters = lsh_clusters(signatures, threshold=threshold, rejected=rejected)
+    drop = sorted(j for c in clusters for j in c["drop"])
+
+    report_path = os.path.join(output_dir, "dedup_report.json")
+    with open(report_path, "w") as f:
+        json.dump({
+            "total_examples": len(signatures),
+            "threshold": threshold,
+            "num_perm": DEDUP_NUM_PERM,
+            "bands": DEDUP_BANDS,
+            "shingle_size": DEDUP_SHINGLE,
+            "clusters": clusters,
+            "drop": drop,
+        }, f, indent=2)
+
+    print(f"\n{'='*55}")
+    print(f"  NEAR-DUPLICATE REPORT (Jaccard ≥ {threshold})")
+    print(f"{'='*55}")
+    print(f"  Examples scanned : {len(signatures)}")
+    print(f"  Clusters         : {len(clusters)}")
+    print(f"  To drop          : {len(drop)}")
+    for c in sorted(clusters, key=lambda c: len(c["drop"]), reverse=True)[:10]:
+        print(f"    Example #{c['keep']:03d} ← {len(c['drop'])} duplicates "
+              f"(min sim {min(c['similarity']):.2f})")
+    if len(clusters) > 10:
+        print(f"    ... and {len(clusters)-10} more clusters")
+    print(f"{'='*55}\n")
+    print(f"  💾 Dedup report → {report_path}\n")
+
+    return set(drop)
 
 
 # ─────────────────────────────────────────────
@@ -245,138 +1312,167 @@ REQUIRED_PATIENT_FIELDS = [
 REQUIRED_DEMO_FIELDS = ["ai_should_flag"]  # bonus but important
 
 
-def evaluate_patient(p: Any, idx: int) -> dict:
-    """Evaluate a single patient scenario."""
-    issues = []
-    warnings = []
-    score = 100  # start at 100, deduct for issues
-
-    if not isinstance(p, dict):
-        return {"idx": idx, "id": "?", "status": "REJECT",
-                "score": 0, "issues": ["Not a dict"], "warnings": []}
+# ── Patient rules (each returns a list of (level, message, deduction);
+#    level is "issue" or "warning")
 
-    pid = p.get("patient_id", f"#{idx}")
+def _p_required(p, prm):
+    return [("issue", f"Missing: '{field}'", 15)
+            for field in REQUIRED_PATIENT_FIELDS if field not in p]
 
-    # ── Required fields
-    for field in REQUIRED_PATIENT_FIELDS:
-        if field not in p:
-            issues.append(f"Missing: '{field}'")
-            score -= 15
 
-    # ── Demographics
+def _p_demographics(p, prm):
     demo = p.get("demographics", {})
-    if isinstance(demo, dict):
-        age = demo.get("age")
-        if age is None:
-            issues.append("Missing demographics.age")
-            score -= 5
-        elif not (0 <= age <= 120):
-            issues.append(f"Unrealistic age: {age}")
-            score -= 10
-
-        if demo.get("sex") not in ("M", "F", None):
-            issues.append(f"Invalid sex value: {demo.get('sex')}")
-            score -= 5
-
-    # ── Clinical note
+    if not isinstance(demo, dict):
+        return []
+    found = []
+    age = demo.get("age")
+    if age is None:
+        found.append(("issue", "Missing demographics.age", 5))
+    elif not (0 <= age <= 120):
+        found.append(("issue", f"Unrealistic age: {age}", 10))
+    if demo.get("sex") not in ("M", "F", None):
+        found.append(("issue", f"Invalid sex value: {demo.get('sex')}", 5))
+    return found
+
+
+SOAP_KEYWORDS = ["SUBJECTIVE", "OBJECTIVE", "ASSESSMENT", "PLAN",
+                 "S:", "O:", "A:", "P:", "Subjective", "Objective"]
+
+
+def _p_note(p, prm):
     note = p.get("clinical_note", {})
-    if isinstance(note, dict):
-        text = note.get("text", "")
-        if len(text) < 200:
-            issues.append(f"Clinical note too short ({len(text)} chars, min 200)")
-            score -= 10
-        # Check SOAP format
-        soap_keywords = ["SUBJECTIVE", "OBJECTIVE", "ASSESSMENT", "PLAN",
-                        "S:", "O:", "A:", "P:", "Subjective", "Objective"]
-        if not any(kw in text for kw in soap_keywords):
-            warnings.append("Clinical note may not be in SOAP format")
-            score -= 5
-
-    # ── Orders
+    if not isinstance(note, dict):
+        return []
+    found = []
+    text = note.get("text", "")
+    if len(text) < prm["note_min"]:
+        found.append(("issue", f"Clinical note too short ({len(text)} chars, min {prm['note_min']})", 10))
+    if not any(kw in text for kw in SOAP_KEYWORDS):
+        found.append(("warning", "Clinical note may not be in SOAP format", 5))
+    return found
+
+
+def _p_orders(p, prm):
     orders = p.get("orders", [])
     if not isinstance(orders, list) or len(orders) < 1:
-        issues.append("Must have at least 1 order")
-        score -= 10
-    else:
-        pending = [o for o in orders if isinstance(o, dict)
-                   and o.get("status") == "pending"]
-        if not pending:
-            warnings.append("No pending orders — needed to show 'open loop'")
-            score -= 10
-        else:
-            for o in pending:
-                days = o.get("days_pending")
-                if days is None:
-                    warnings.append(f"Order '{o.get('test_name','?')}' missing days_pending")
-                    score -= 3
-                if not o.get("failure_reason"):
-                    warnings.append(f"Order '{o.get('test_name','?')}' missing failure_reason")
-                    score -= 3
-
-    # ── Results
+        return [("issue", "Must have at least 1 order", 10)]
+    pending = [o for o in orders if isinstance(o, dict) and o.get("status") == "pending"]
+    if not pending:
+        return [("warning", "No pending orders — needed to show 'open loop'", 10)]
+    found = []
+    for o in pending:
+        if o.get("days_pending") is None:
+            found.append(("warning", f"Order '{o.get('test_name','?')}' missing days_pending", 3))
+        if not o.get("failure_reason"):
+            found.append(("warning", f"Order '{o.get('test_name','?')}' missing failure_reason", 3))
+    return found
+
+
+def _p_results(p, prm):
     results = p.get("results", [])
     if not isinstance(results, list) or len(results) < 1:
-        issues.append("Must have at least 1 result")
-        score -= 10
-    else:
-        for r in results:
-            if isinstance(r, dict):
-                if not r.get("full_text"):
-                    warnings.append(f"Result '{r.get('test_name','?')}' missing full_text")
-                    score -= 3
+        return [("issue", "Must have at least 1 result", 10)]
+    return [("warning", f"Result '{r.get('test_name','?')}' missing full_text", 3)
+            for r in results if isinstance(r, dict) and not r.get("full_text")]
+
 
-    # ── Diagnostic hypothesis
+def _p_hypothesis(p, prm):
     hyp = p.get("diagnostic_hypothesis", {})
-    if isinstance(hyp, dict):
-        if not hyp.get("primary"):
-            issues.append("Missing diagnostic_hypothesis.primary")
-            score -= 10
-        if not hyp.get("reasoning"):
-            warnings.append("Missing diagnostic_hypothesis.reasoning")
-            score -= 5
-
-    # ── Failure mode (critical for demo)
+    if not isinstance(hyp, dict):
+        return []
+    found = []
+    if not hyp.get("primary"):
+        found.append(("issue", "Missing diagnostic_hypothesis.primary", 10))
+    if not hyp.get("reasoning"):
+        found.append(("warning", "Missing diagnostic_hypothesis.reasoning", 5))
+    return found
+
+
+def _p_failure_mode(p, prm):
     fm = p.get("failure_mode", "")
-    if not fm or len(str(fm)) < 30:
-        issues.append("failure_mode too short or missing (critical for demo)")
-        score -= 15
+    if not fm or len(str(fm)) < prm["failure_mode_min"]:
+        return [("issue", "failure_mode too short or missing (critical for demo)", 15)]
+    return []
 
-    # ── AI flags (demo quality)
+
+def _p_flags(p, prm):
     flags = p.get("ai_should_flag", [])
-    if not flags or len(flags) < 2:
-        warnings.append("ai_should_flag missing or too few items (needed for demo)")
-        score -= 8
+    if not flags or len(flags) < prm["flags_min"]:
+        return [("warning", "ai_should_flag missing or too few items (needed for demo)", 8)]
+    return []
+
 
-    # ── Days pending check (diversity)
-    all_days = [o.get("days_pending") for o in orders
+def _p_days_diversity(p, prm):
+    all_days = [o.get("days_pending") for o in p.get("orders", [])
                 if isinstance(o, dict) and o.get("days_pending")]
     if all_days and all(d == 14 for d in all_days):
-        warnings.append("All pending orders are exactly 14 days — lacks diversity")
-        score -= 5
+        return [("warning", "All pending orders are exactly 14 days — lacks diversity", 5)]
+    return []
+
+
+def _p_artifact(p, prm):
+    if ARTIFACT_SCANNER.search_json(json.dumps(p)):
+        return [("issue", "⚠️  Model artifact detected", 20)]
+    return []
+
+
+PATIENT_RULES = [
+    {"id": "required",       "params": (),                    "check": _p_required},
+    {"id": "demographics",   "params": (),                    "check": _p_demographics},
+    {"id": "clinical_note",  "params": ("note_min",),         "check": _p_note},
+    {"id": "orders",         "params": (),                    "check": _p_orders},
+    {"id": "results",        "params": (),                    "check": _p_results},
+    {"id": "hypothesis",     "params": (),                    "check": _p_hypothesis},
+    {"id": "failure_mode",   "params": ("failure_mode_min",), "check": _p_failure_mode},
+    {"id": "ai_flags",       "params": ("flags_min",),        "check": _p_flags},
+    {"id": "days_diversity", "params": (),                    "check": _p_days_diversity},
+    {"id": "artifact",       "params": (),                    "check": _p_artifact},
+]
 
-    # ── Artifact check
-    raw = json.dumps(p)
-    if "<unused" in raw or "thought\n" in raw:
-        issues.append("⚠️  Model artifact detected")
-        score -= 20
+PATIENT_PLAN = compile_plan(PATIENT_RULES, ACTIVE_PROFILES)
 
-    score = max(0, score)
+
+def _patient_verdict(found: list[tuple], reject_score: int) -> dict:
+    issues = [msg for level, msg, _ in found if level == "issue"]
+    warnings = [msg for level, msg, _ in found if level == "warning"]
+    score = max(0, 100 - sum(d for _, _, d in found))  # start at 100, deduct for issues
 
     if issues:
-        status = "REJECT" if score < 40 else "WARNING"
+        status = "REJECT" if score < reject_score else "WARNING"
     elif warnings:
         status = "WARNING"
     else:
         status = "PASS"
+    return {"status": status, "score": score, "issues": issues, "warnings": warnings}
 
-    return {
-        "idx": idx, "id": pid, "status": status,
-        "score": score, "issues": issues, "warnings": warnings
-    }
 
+def evaluate_patient(p: Any, idx: int) -> dict:
+    """
+    Evaluate a single patient scenario against every active profile.
+    Returns the first profile's result; with several profiles active it also
+    carries "profiles": {name: status}.
+    """
+    if not isinstance(p, dict):
+        result = {"idx": idx, "id": "?", "status": "REJECT",
+                  "score": 0, "issues": ["Not a dict"], "warnings": []}
+        if len(ACTIVE_PROFILES) > 1:
+            result["profiles"] = {name: "REJECT" for name in ACTIVE_PROFILES}
+        return result
 
-def evaluate_patients(patients: list[dict]) -> None:
-    """Evaluate all patient scenarios and print report."""
+    pid = p.get("patient_id", f"#{idx}")
+    found, _ = run_plan(PATIENT_PLAN, p, list(ACTIVE_PROFILES))
+    verdicts = {name: _patient_verdict(f, ACTIVE_PROFILES[name]["reject_score"])
+                for name, f in found.items()}
+    primary = verdicts[next(iter(verdicts))]
+
+    result = {"idx": idx, "id": pid, **primary}
+    if len(verdicts) > 1:
+        result["profiles"] = {name: v["status"] for name, v in verdicts.items()}
+    return result
+
+
+def evaluate_patients(patients: list[dict]) -> list[dict]:
+    """Evaluate all patient scenarios, print report and return the results."""
     results = [evaluate_patient(p, i) for i, p in enumerate(patients)]
 
     passed  = [r for r in results if r["status"] == "PASS"]
@@ -430,14 +1526,137 @@ def evaluate_patients(patients: list[dict]) -> None:
     else:
         print(f"\n  🔴 NEEDS WORK — several scenarios need attention")
 
+    profile_counts = {}
+    for r in results:
+        _count_profiles(profile_counts, r)
+    _print_profile_table(profile_counts)
+
     print(f"{'='*55}\n")
 
+    return results
+
+
+# ── Streaming evaluation (bounded memory)
+
+_ISSUE_NAME_RE = re.compile(r"^(Order|Result) '.*?'")
+_ISSUE_NUM_RE = re.compile(r"-?\d+(?:\.\d+)?")
+# "...: <raw value>" tails ("Invalid sex value: x"); quoted field names are kept
+_ISSUE_VALUE_RE = re.compile(r": (?!')[^:]*$")
+
+
+def _issue_key(msg: str) -> str:
+    """Collapse per-record details so the issue histogram stays bounded."""
+    msg = _ISSUE_VALUE_RE.sub(": …", _ISSUE_NAME_RE.sub(r"\1 '…'", msg))
+    return _ISSUE_NUM_RE.sub("N", msg)
+
+
+def evaluate_patients_streaming(patients, report_path: str, top_k: int = 10) -> dict:
+    """
+    One-pass variant of evaluate_patients for large panels.
+    Per-patient results go to a JSONL report as they are produced; only
+    counters, per-issue histograms and the top/bottom K scores (two heaps)
+    are kept in memory. Prints a summary and returns the aggregates.
+    """
+    counts = {"PASS": 0, "WARNING": 0, "REJECT": 0}
+    total = score_sum = 0
+    has_pending = has_flags = has_failure = 0
+    issue_hist, warning_hist, profile_counts = {}, {}, {}
+    top, bottom = [], []  # min-heap of best K, min-heap (negated) of worst K
+
+    with open(report_path, "w") as out:
+        for i, p in enumerate(patients):
+            r = evaluate_patient(p, i)
+            out.write(json.dumps(r) + "\n")
+
+            total += 1
+            score_sum += r["score"]
+            counts[r["status"]] += 1
+            _count_profiles(profile_counts, r)
+            for msg in r["issues"]:
+                key = _issue_key(msg)
+                issue_hist[key] = issue_hist.get(key, 0) + 1
+            for msg in r["warnings"]:
+                key = _issue_key(msg)
+                warning_hist[key] = warning_hist.get(key, 0) + 1
+
+            if isinstance(p, dict):
+                orders = p.get("orders", [])
+                if isinstance(orders, list) and any(
+                        isinstance(o, dict) and o.get("status") == "pending" for o in orders):
+                    has_pending += 1
+                has_flags += bool(p.get("ai_should_flag"))
+                has_failure += bool(p.get("failure_mode"))
+
+            entry = (r["score"], -i, r["id"], r["status"])
+            if len(top) < top_k:
+                heapq.heappush(top, entry)
+            else:
+                heapq.heappushpop(top, entry)
+            entry = (-r["score"], -i, r["id"], r["status"])
+            if len(bottom) < top_k:
+                heapq.heappush(bottom, entry)
+            else:
+                heapq.heappushpop(bottom, entry)
+
+    avg_score = score_sum / total if total else 0
+
+    def show(rows):
+        for score, _, pid, status in rows:
+            bar = "█" * (score // 10)
+            icon = "✅" if status == "PASS" else ("⚠️ " if status == "WARNING" else "❌")
+            print(f"  {icon} {pid:<8} {score:>3}/100  {bar}")
+
+    print(f"\n{'='*55}")
+    print(f"  PATIENT SCENARIOS EVALUATION REPORT (streaming)")
+    print(f"{'='*55}")
+    print(f"  Total scenarios : {total}")
+    print(f"  ✅ PASS         : {counts['PASS']}")
+    print(f"  ⚠️  WARNING      : {counts['WARNING']}")
+    print(f"  ❌ REJECT       : {counts['REJECT']}")
+    print(f"  📊 Avg score    : {avg_score:.0f}/100")
+    print(f"{'─'*55}")
+
+    print(f"\n  TOP {len(top)} SCORES:")
+    show(sorted(top, reverse=True))
+    print(f"\n  BOTTOM {len(bottom)} SCORES:")
+    show(sorted(((-s, i, pid, st) for s, i, pid, st in bottom), reverse=True))
+
+    for title, icon, hist in (("ISSUES", "❌", issue_hist), ("WARNINGS", "⚠️ ", warning_hist)):
+        if hist:
+            print(f"\n  MOST COMMON {title}:")
+            for key, n in sorted(hist.items(), key=lambda kv: kv[1], reverse=True)[:10]:
+                print(f"    {icon} {n:>7}  {key}")
+
+    print(f"\n  DEMO READINESS:")
+    print(f"    Scenarios with pending orders   : {has_pending}/{total}")
+    print(f"    Scenarios with AI flags         : {has_flags}/{total}")
+    print(f"    Scenarios with failure mode     : {has_failure}/{total}")
+
+    if avg_score >= 80 and counts["REJECT"] == 0:
+        print(f"\n  🟢 DEMO READY — all scenarios suitable for frontend")
+    elif avg_score >= 60:
+        print(f"\n  🟡 MOSTLY READY — fix warnings for best demo quality")
+    else:
+        print(f"\n  🔴 NEEDS WORK — several scenarios need attention")
+
+    _print_profile_table(profile_counts)
+    print(f"{'='*55}\n")
+    print(f"  💾 Per-patient results → {report_path}\n")
+
+    return {
+        "total": total, "counts": counts, "avg_score": avg_score,
+        "demo_readiness": {"pending": has_pending, "flags": has_flags, "failure_mode": has_failure},
+        "issues": issue_hist, "warnings": warning_hist, "profiles": profile_counts,
+        "top": sorted(top, reverse=True),
+        "bottom": sorted(((-s, i, pid, st) for s, i, pid, st in bottom), reverse=True),
+    }
+
 
 # ─────────────────────────────────────────────
 # MAIN
 # ─────────────────────────────────────────────
 
-def main():
+def main(default_profiles: str = "lenient"):
     parser = argparse.ArgumentParser(description="MedGemma Data Pipeline")
     parser.add_argument("--training_dir",   default="./training_data",
                         help="Directory containing training JSON files")
@@ -449,9 +1668,50 @@ def main():
                         help="Skip training data processing")
     parser.add_argument("--skip_patients",  action="store_true",
                         help="Skip patient scenario evaluation")
+    parser.add_argument("--stream",         action="store_true",
+                        help="Constant-memory mode: merge to training_merged.jsonl and "
+                             "validate from it line by line; stream patient evaluation "
+                             "to patient_eval.jsonl")
+    parser.add_argument("--top_k",          type=int, default=10,
+                        help="With --stream, best/worst patient scores to print")
+    parser.add_argument("--workers",        type=int, default=1,
+                        help="Validation processes (0 = all cores)")
+    parser.add_argument("--artifact_scan",  action="store_true",
+                        help="Scan raw training bytes for model artifacts before merging")
+    parser.add_argument("--artifact_tokens_file", default=None,
+                        help="JSON list of artifact tokens (default: Gemma markers)")
+    parser.add_argument("--reject_poisoned", action="store_true",
+                        help="With --artifact_scan, leave files with hits out of the merge")
+    parser.add_argument("--profiles",       default=default_profiles,
+                        help="Comma-separated QA profiles evaluated in one pass "
+                             "(strict, lenient, or names from --profiles_file); "
+                             "the first drives the clean file")
+    parser.add_argument("--profiles_file",  default=None,
+                        help="JSON {name: {param: value}} of custom profiles, "
+                             "layered over 'lenient'")
+    parser.add_argument("--dedup",          action="store_true",
+                        help="Drop near-duplicate notes (MinHash/LSH, needs numpy)")
+    parser.add_argument("--dedup_threshold", type=float, default=DEDUP_THRESHOLD,
+                        help="Estimated Jaccard at which two notes are duplicates")
+    parser.add_argument("--shard",          action="store_true",
+                        help="Also emit training_final_400.jsonl + .idx for "
+                             "random access (src/utils/data_loader.py::JSONLShard)")
+    parser.add_argument("--incremental",    action="store_true",
+                        help="Only reparse/revalidate changed files, using the "
+                             "manifest cache in --output_dir")
     args = parser.parse_args()
 
     os.makedirs(args.output_dir, exist_ok=True)
+    workers = args.workers or os.cpu_count() or 1
+
+    if args.artifact_tokens_file:
+        with open(args.artifact_tokens_file, "r") as f:
+            set_artifact_tokens(json.load(f))
+    try:
+        set_qa_profiles(resolve_profiles(args.profiles, args.profiles_file))
+    except ValueError as e:
+        parser.error(str(e))
+    multi_profile = len(ACTIVE_PROFILES) > 1
 
     # ── TRAINING EXAMPLES
     if not args.skip_training:
@@ -460,22 +1720,61 @@ def main():
         print("="*55)
 
         training_dir = Path(args.training_dir)
+        skip = None
+        if args.artifact_scan and training_dir.exists():
+            poisoned = scan_training_files(args.training_dir, args.output_dir)
+            if args.reject_poisoned and poisoned:
+                skip = poisoned
+                print(f"  🚫 Leaving {len(poisoned)} poisoned files out of the merge\n")
+
+        val_results = None
         if not training_dir.exists():
             print(f"  ❌ Training directory not found: {training_dir}")
+        elif args.incremental:
+            val_results = run_incremental(args.training_dir, args.output_dir,
+                                          workers=workers, skip=skip, shard=args.shard,
+                                          dedup_threshold=args.dedup_threshold if args.dedup else None)
+        elif args.stream:
+            merged_path = os.path.join(args.output_dir, "training_merged.jsonl")
+            total = merge_training_files_streaming(args.training_dir, merged_path, skip=skip)
+
+            if total:
+                val_results = validate_training_data(iter_jsonl_lines(merged_path),
+                                                     workers=workers, decode=True)
+
+                drop = (dedup_training_examples(iter_jsonl(merged_path), args.output_dir,
+                                                args.dedup_threshold,
+                                                rejected={r["idx"] for r in val_results["failed"]})
+                        if args.dedup else None)
+
+                clean_path = os.path.join(args.output_dir, "training_final_400.json")
+                save_clean_training_streaming(merged_path, val_results, clean_path, drop=drop,
+                                              shard=args.shard)
+            else:
+                print("  ❌ No training examples found")
         else:
-            examples = merge_training_files(args.training_dir)
+            examples = merge_training_files(args.training_dir, skip=skip)
 
             if examples:
                 merged_path = os.path.join(args.output_dir, "training_merged.json")
                 save_merged(examples, merged_path)
 
-                val_results = validate_training_data(examples)
+                val_results = validate_training_data(examples, workers=workers)
+
+                drop = (dedup_training_examples(examples, args.output_dir, args.dedup_threshold,
+                                                rejected={r["idx"] for r in val_results["failed"]})
+                        if args.dedup else None)
 
                 clean_path = os.path.join(args.output_dir, "training_final_400.json")
-                save_clean_training(examples, val_results, clean_path)
+                save_clean_training(examples, val_results, clean_path, drop=drop,
+                                    shard=args.shard)
             else:
                 print("  ❌ No training examples found")
 
+        if multi_profile and val_results:
+            save_profile_columns(val_results["passed"] + val_results["warned"] + val_results["failed"],
+                                 os.path.join(args.output_dir, "training_qa_profiles.csv"))
+
     # ── PATIENT SCENARIOS
     if not args.skip_patients:
         print("\n" + "="*55)
@@ -485,6 +1784,10 @@ def main():
         patients_path = Path(args.patients_file)
         if not patients_path.exists():
             print(f"  ❌ Patients file not found: {patients_path}")
+        elif args.stream:
+            report_path = os.path.join(args.output_dir, "patient_eval.jsonl")
+            evaluate_patients_streaming(iter_training_file(patients_path, "patient_scenarios"),
+                                        report_path, top_k=args.top_k)
         else:
             with open(patients_path, "r") as f:
                 patients = json.load(f)
@@ -496,7 +1799,11 @@ def main():
                     patients = [patients]# handle single patient file
 
             print(f"  📂 Loaded {len(patients)} patient scenarios")
-            evaluate_patients(patients)
+            patient_results = evaluate_patients(patients)
+
+            if multi_profile:
+                save_profile_columns(patient_results,
+                                     os.path.join(args.output_dir, "patient_qa_profiles.csv"))
 
     print("\n✅ Pipeline complete!\n")
 
@@ -0,0 +1,23 @@
+"""
+Synthetic Clinical Text
+=======================
+Seeded filler text for the benchmarks (benchmark_pipeline.py,
+benchmark_cpu_inference.py) — clinical vocabulary, fixed length, no PHI.
+"""
+
+import random
+
+WORDS = ("patient presents with worsening dyspnea fatigue fever cough chest pain "
+         "abdominal bloating weight loss hx htn dm2 ckd exam notable for tachycardia "
+         "crackles edema tenderness labs ordered cbc bmp troponin ct mri ultrasound").split()
+
+
+def synth_text(rng: random.Random, chars: int) -> str:
+    """Random WORDS joined by spaces, cut to exactly `chars` characters."""
+    words = []
+    n = 0
+    while n < chars:
+        w = rng.choice(WORDS)
+        words.append(w)
+        n += len(w) + 1
+    return " ".join(words)[:chars]
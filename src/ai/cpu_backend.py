@@ -0,0 +1,192 @@
+"""
+CPU Inference Backend
+Runs the extraction engine without CUDA. export_cpu_model() merges the LoRA
+adapter into the base model, exports it to ONNX and applies dynamic int8
+quantization (weights int8, activations quantized per batch); CPUBackend
+loads the export into ONNX Runtime with an explicit thread pool.
+
+    export_cpu_model('google/medgemma-1.5-4b-it', 'output/cpu_model',
+                     adapter='output/loopguard_adapter')
+    backend = CPUBackend.from_export('output/cpu_model', num_threads=16)
+    extractor = HypothesisExtractor(backend, max_batch_size=4)
+
+Without optimum/onnxruntime, CPUBackend.from_pretrained() gives the same
+interface on PyTorch with torch.ao dynamic int8 Linear layers.
+"""
+
+import argparse
+import json
+import os
+import time
+from pathlib import Path
+from typing import Any, Dict, Optional, Union
+
+from .hypothesis_extractor import TransformersBackend
+
+EXPORT_INFO = 'export_info.json'
+
+# ONNX Runtime quantization presets by CPU instruction set
+QUANT_ARCHS = ('avx2', 'avx512', 'avx512_vnni', 'arm64')
+
+
+def configure_threads(num_threads: Optional[int] = None) -> int:
+    """
+    Pin intra-op parallelism for PyTorch and OpenMP-based kernels; defaults
+    to the cores this process may run on. Returns the count used.
+    """
+    if num_threads is None:
+        num_threads = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+    os.environ.setdefault('OMP_NUM_THREADS', str(num_threads))
+    try:
+        import torch
+        torch.set_num_threads(num_threads)
+        # Inter-op threads only help multi-branch graphs; one keeps cores for GEMMs
+        torch.set_num_interop_threads(1)
+    except (ImportError, RuntimeError):  # interop threads can only be set once
+        pass
+    return num_threads
+
+
+def merge_adapter(base_model: str, adapter: Optional[str], output_dir: Union[str, Path]) -> Path:
+    """Base model with the LoRA adapter folded in, saved in fp32 for export."""
+    import torch
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    model = AutoModelForCausalLM.from_pretrained(base_model, dtype=torch.float32)
+    if adapter:
+        from peft import PeftModel
+        model = PeftModel.from_pretrained(model, adapter).merge_and_unload()
+    model.save_pretrained(output_dir)
+    AutoTokenizer.from_pretrained(base_model).save_pretrained(output_dir)
+    return output_dir
+
+
+def export_cpu_model(
+    base_model: str,
+    output_dir: Union[str, Path],
+    adapter: Optional[str] = None,
+    quantize: bool = True,
+    arch: str = 'avx2'
+) -> Dict[str, Any]:
+    """
+    Merge base + adapter, export to ONNX (with past key/values) and
+    dynamically quantize to int8. Writes export_info.json next to the model
+    and returns it.
+    """
+    from optimum.onnxruntime import ORTModelForCausalLM, ORTQuantizer
+    from optimum.onnxruntime.configuration import AutoQuantizationConfig
+
+    if arch not in QUANT_ARCHS:
+        raise ValueError(f'arch must be one of {QUANT_ARCHS}, got {arch!r}')
+
+    output_dir = Path(output_dir)
+    started = time.time()
+    merged = merge_adapter(base_model, adapter, output_dir / 'merged')
+
+    onnx_dir = output_dir / 'onnx'
+    ORTModelForCausalLM.from_pretrained(merged, export=True, use_cache=True).save_pretrained(onnx_dir)
+
+    model_dir = onnx_dir
+    if quantize:
+        model_dir = output_dir / 'onnx_int8'
+        qconfig = getattr(AutoQuantizationConfig, arch)(is_static=False, per_channel=False)
+        ORTQuantizer.from_pretrained(onnx_dir).quantize(save_dir=model_dir, quantization_config=qconfig)
+
+    # from_export() loads the tokenizer from beside the graph
+    from transformers import AutoTokenizer
+    AutoTokenizer.from_pretrained(merged).save_pretrained(model_dir)
+
+    info = {
+        'base_model': base_model,
+        'adapter': adapter,
+        'quantized': quantize,
+        'arch': arch if quantize else None,
+        'model_dir': model_dir.name,      # relative to the export directory
+        'onnx_bytes': sum(f.stat().st_size for f in Path(model_dir).glob('*.onnx*')),
+        'export_seconds': round(time.time() - started, 1),
+        'exported_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+    with open(output_dir / EXPORT_INFO, 'w') as f:
+        json.dump(info, f, indent=2)
+    return info
+
+
+class CPUBackend(TransformersBackend):
+    """
+    TransformersBackend on CPU: the generate() loop, early stopping and JSON
+    constraints are shared; only model loading differs. Prefix KV reuse is
+    off because ONNX Runtime sessions take past key/values as graph inputs,
+    not as a transformers Cache object.
+    """
+    name = 'cpu'
+
+    def __init__(self, model, tokenizer, runtime: str, num_threads: int):
+        super().__init__(model, tokenizer, prefix_cache=False)
+        self.runtime = runtime
+        self.num_threads = num_threads
+        self.name = f'cpu-{runtime}'
+
+    @classmethod
+    def from_export(cls, export_dir: Union[str, Path], num_threads: Optional[int] = None) -> 'CPUBackend':
+        """Load an export_cpu_model() directory into ONNX Runtime."""
+        import onnxruntime as ort
+        from optimum.onnxruntime import ORTModelForCausalLM
+        from transformers import AutoTokenizer
+
+        export_dir = Path(export_dir)
+        info_path = export_dir / EXPORT_INFO
+        model_dir = export_dir
+        if info_path.exists():
+            # .name also reads exports that stored the path as given at export time
+            model_dir = export_dir / Path(json.loads(info_path.read_text())['model_dir']).name
+
+        num_threads = configure_threads(num_threads)
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = num_threads
+        options.inter_op_num_threads = 1
+        options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+
+        model = ORTModelForCausalLM.from_pretrained(
+            model_dir, provider='CPUExecutionProvider', session_options=options, use_cache=True
+        )
+        return cls(model, AutoTokenizer.from_pretrained(model_dir), 'onnx', num_threads)
+
+    @classmethod
+    def from_pretrained(cls, model_name: str, adapter: Optional[str] = None, quantize: bool = True,
+                        num_threads: Optional[int] = None) -> 'CPUBackend':
+        """PyTorch fallback: fp32 weights, Linear layers dynamically quantized to int8."""
+        import torch
+        from transformers import AutoModelForCausalLM, AutoTokenizer
+
+        num_threads = configure_threads(num_threads)
+        model = AutoModelForCausalLM.from_pretrained(model_name, dtype=torch.float32)
+        if adapter:
+            from peft import PeftModel
+            model = PeftModel.from_pretrained(model, adapter).merge_and_unload()
+        model.eval()
+        if quantize:
+            model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        tokenizer = AutoTokenizer.from_pretrained(model_name)
+        return cls(model, tokenizer, 'torch-int8' if quantize else 'torch-fp32', num_threads)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export a merged, int8 ONNX model for CPU inference')
+    parser.add_argument('--base_model', default='google/medgemma-1.5-4b-it')
+    parser.add_argument('--adapter', default=None, help='LoRA adapter directory to merge')
+    parser.add_argument('--output_dir', default='output/cpu_model')
+    parser.add_argument('--arch', default='avx2', choices=QUANT_ARCHS,
+                        help='Target instruction set for int8 kernels')
+    parser.add_argument('--no_quantize', action='store_true', help='Export fp32 ONNX only')
+    args = parser.parse_args()
+
+    info = export_cpu_model(args.base_model, args.output_dir, adapter=args.adapter,
+                            quantize=not args.no_quantize, arch=args.arch)
+    print(json.dumps(info, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,250 @@
+"""
+Extraction Cache
+Persistent SQLite cache of model outputs for the extraction and agent layers,
+keyed by hash(prompt, base model id, adapter revision, generation params).
+The prompt already contains the note text and the prompt template, so any
+change to either is a miss. Parsed fields are stored next to the raw output
+and served by generate_parsed(), which HypothesisExtractor and the agents use.
+
+    cache = ExtractionCache("output/extraction_cache.sqlite")
+    backend = CachedBackend(TransformersBackend(model, tokenizer), cache, model_id=BASE_MODEL,
+                            adapter_revision=adapter_fingerprint("output/loopguard_adapter"))
+    extractor = HypothesisExtractor(backend)
+"""
+
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from dataclasses import asdict
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple, Union
+
+from .hypothesis_extractor import (
+    EXTRACTION_PREFIX, ExtractionBackend, GenerationParams, ScoredText, parse_raw_output,
+)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key        TEXT PRIMARY KEY,
+    model_id   TEXT NOT NULL,
+    adapter    TEXT NOT NULL,
+    raw        TEXT NOT NULL,
+    parsed     TEXT,
+    size       INTEGER NOT NULL,
+    created    REAL NOT NULL,
+    last_used  REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used);
+CREATE INDEX IF NOT EXISTS entries_created ON entries (created);
+"""
+
+
+def adapter_fingerprint(adapter_dir: Optional[Union[str, Path]]) -> str:
+    """
+    Adapter revision from the adapter's own files (config and weights), so
+    retraining or swapping the adapter changes every key. 'none' for the
+    base model alone.
+    """
+    if adapter_dir is None:
+        return 'none'
+    digest = hashlib.sha256()
+    files = sorted(p for p in Path(adapter_dir).iterdir()
+                   if p.is_file() and p.suffix in ('.json', '.safetensors', '.bin'))
+    if not files:
+        raise FileNotFoundError(f'no adapter config or weights in {adapter_dir}')
+    for path in files:
+        digest.update(path.name.encode('utf-8'))
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+    return digest.hexdigest()[:16]
+
+
+def cache_key(prompt: str, model_id: str, adapter_revision: str, params: GenerationParams) -> str:
+    payload = json.dumps([prompt, model_id, adapter_revision, asdict(params)], sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class ExtractionCache:
+    """
+    On-disk cache of raw generations plus their parsed fields.
+
+    Hit/miss counters cover this process; entry count and size come from
+    the database. evict() drops entries by age and then least-recently-used
+    until the total stored size fits.
+    """
+
+    def __init__(self, path: Union[str, Path]):
+        self.path = str(path)
+        if self.path != ':memory:':
+            Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.executescript(_SCHEMA)
+        self.hits = 0
+        self.misses = 0
+
+    def get_many(self, keys: List[str]) -> Dict[str, Tuple[str, Any]]:
+        """{key: (raw, parsed)} for the keys present; bumps their last_used."""
+        found: Dict[str, Tuple[str, Any]] = {}
+        if not keys:
+            return found
+        now = time.time()
+        with self._lock:
+            # SQLite caps bound parameters; 500 per query is safely below it
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                marks = ','.join('?' * len(chunk))
+                rows = self._db.execute(
+                    f'SELECT key, raw, parsed FROM entries WHERE key IN ({marks})', chunk
+                ).fetchall()
+                for key, raw, parsed in rows:
+                    found[key] = (raw, json.loads(parsed) if parsed is not None else None)
+                self._db.execute(
+                    f'UPDATE entries SET last_used = ? WHERE key IN ({marks})', [now, *chunk]
+                )
+            self._db.commit()
+            self.hits += len(found)
+            self.misses += len(set(keys)) - len(found)
+        return found
+
+    def get(self, key: str) -> Optional[Tuple[str, Any]]:
+        return self.get_many([key]).get(key)
+
+    def put_many(self, entries: Iterable[Tuple[str, str, str, str, Any]]):
+        """entries: (key, model_id, adapter_revision, raw, parsed)."""
+        now = time.time()
+        rows = []
+        for key, model_id, adapter, raw, parsed in entries:
+            parsed_json = json.dumps(parsed) if parsed is not None else None
+            size = len(raw.encode('utf-8')) + len(parsed_json or '')
+            rows.append((key, model_id, adapter, raw, parsed_json, size, now, now))
+        with self._lock:
+            self._db.executemany(
+                'INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows
+            )
+            self._db.commit()
+
+    def evict(self, max_age_days: Optional[float] = None, max_bytes: Optional[int] = None) -> int:
+        """Delete entries older than max_age_days, then LRU entries beyond max_bytes."""
+        removed = 0
+        with self._lock:
+            if max_age_days is not None:
+                cutoff = time.time() - max_age_days * 86400
+                removed += self._db.execute('DELETE FROM entries WHERE created < ?', (cutoff,)).rowcount
+            if max_bytes is not None:
+                (total,) = self._db.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()
+                if total > max_bytes:
+                    doomed, excess = [], total - max_bytes
+                    for key, size in self._db.execute('SELECT key, size FROM entries ORDER BY last_used'):
+                        if excess <= 0:
+                            break
+                        doomed.append((key,))
+                        excess -= size
+                    self._db.executemany('DELETE FROM entries WHERE key = ?', doomed)
+                    removed += len(doomed)
+            self._db.commit()
+        return removed
+
+    def clear(self):
+        with self._lock:
+            self._db.execute('DELETE FROM entries')
+            self._db.commit()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            entries, size = self._db.execute(
+                'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries'
+            ).fetchone()
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'entries': entries,
+            'bytes': size,
+        }
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class CachedBackend(ExtractionBackend):
+    """
+    Wraps a backend with an ExtractionCache: only prompts that miss are
+    sent to the wrapped backend, in one batch, and their outputs stored.
+
+    parsers maps a prompt prefix to a function (raw, params) -> parsed value
+    stored alongside the raw output (extraction prompts by default;
+    result_analyzer.AGENT_PARSERS adds the agent prompts). generate_parsed()
+    returns the stored value when the caller's parser is the registered one.
+
+    adapter_revision is required: use adapter_fingerprint(adapter_dir), or
+    'none' for the base model, so a swapped adapter never hits old entries.
+    """
+
+    def __init__(
+        self,
+        backend: ExtractionBackend,
+        cache: ExtractionCache,
+        model_id: str,
+        adapter_revision: str,
+        parsers: Optional[Dict[str, Callable[[str, GenerationParams], Any]]] = None
+    ):
+        if not adapter_revision:
+            raise ValueError("adapter_revision is required (adapter_fingerprint(dir), or 'none')")
+        self.backend = backend
+        self.cache = cache
+        self.model_id = model_id
+        self.adapter_revision = adapter_revision
+        self.parsers = {EXTRACTION_PREFIX: parse_raw_output, **(parsers or {})}
+        self.name = f'cached-{backend.name}'
+
+    def count_tokens(self, prompts: List[str], add_special_tokens: bool = True) -> List[int]:
+        return self.backend.count_tokens(prompts, add_special_tokens=add_special_tokens)
+
+    def _lookup(self, prompts: List[str], params: GenerationParams,
+                prefix: Optional[str]) -> List[Tuple[str, Any]]:
+        """(raw, stored parse or None) per prompt, generating and storing the misses."""
+        keys = [cache_key(p, self.model_id, self.adapter_revision, params) for p in prompts]
+        found = self.cache.get_many(keys)
+
+        missing = [i for i, k in enumerate(keys) if k not in found]
+        if missing:
+            generated = self.backend.generate([prompts[i] for i in missing], params, prefix=prefix)
+            parse = self.parsers.get(prefix) if prefix else None
+            new = []
+            for i, raw in zip(missing, generated):
+                parsed = parse(raw, params) if parse else None
+                found[keys[i]] = (raw, parsed)
+                new.append((keys[i], self.model_id, self.adapter_revision, raw, parsed))
+            self.cache.put_many(new)
+
+        return [found[k] for k in keys]
+
+    def generate(self, prompts: List[str], params: GenerationParams,
+                 prefix: Optional[str] = None) -> List[str]:
+        return [raw for raw, _ in self._lookup(prompts, params, prefix)]
+
+    def generate_parsed(self, prompts: List[str], params: GenerationParams,
+                        parse: Callable[[str, GenerationParams], Any],
+                        prefix: Optional[str] = None) -> List[Tuple[str, Any]]:
+        """Stored parses are reused only if `parse` is the parser registered for prefix."""
+        trusted = prefix is not None and parse is self.parsers.get(prefix)
+        return [(raw, parsed if trusted and parsed is not None else parse(raw, params))
+                for raw, parsed in self._lookup(prompts, params, prefix)]
+
+    def generate_scored(self, prompts: List[str], params: GenerationParams,
+                        prefix: Optional[str] = None) -> List[ScoredText]:
+        """Not cached: token log-probabilities are not stored, so this always generates."""
+        return self.backend.generate_scored(prompts, params, prefix=prefix)
@@ -0,0 +1,387 @@
+"""
+Extraction Service
+asyncio HTTP front end for HypothesisExtractor. Requests are queued, gathered
+into micro-batches (up to max_batch_size notes or max_wait_ms after the first
+one arrives) and run on a single inference thread; the next batch forms while
+the current one is on the device, so the model never waits for HTTP.
+
+The queue is bounded: when it is full, POST /extract answers 429 with
+Retry-After instead of buffering, so memory stays flat under burst load.
+
+    POST /extract   {"note": "..."} or a patient with clinical_note.text
+    GET  /metrics   queue depth, in-flight, counters, latency percentiles
+    GET  /health
+
+Usage:
+    python -m src.ai.extraction_service --stand_in --port 8080
+"""
+
+import argparse
+import asyncio
+import json
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+from .hypothesis_extractor import (
+    ExtractionBackend, GenerationParams, HypothesisExtractor, StandInBackend,
+)
+
+MAX_BODY_BYTES = 1 << 20
+
+_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+            413: 'Payload Too Large', 429: 'Too Many Requests', 500: 'Internal Server Error',
+            503: 'Service Unavailable', 504: 'Gateway Timeout'}
+
+
+class QueueFull(Exception):
+    """Raised by MicroBatcher.submit when the request queue is at capacity."""
+
+
+class ServiceStopped(Exception):
+    """Raised for requests still queued or in flight when MicroBatcher.stop runs."""
+
+
+class LatencyTracker:
+    """Latencies (seconds) of the most recent `window` requests, for percentiles."""
+
+    def __init__(self, window: int = 4096):
+        self.samples: Deque[float] = deque(maxlen=window)
+
+    def add(self, seconds: float):
+        self.samples.append(seconds)
+
+    def percentiles(self, points: Tuple[int, ...] = (50, 90, 95, 99)) -> Dict[str, float]:
+        ordered = sorted(self.samples)
+        if not ordered:
+            return {f'p{p}_ms': 0.0 for p in points}
+        return {
+            f'p{p}_ms': round(ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))] * 1000, 2)
+            for p in points
+        }
+
+
+class MicroBatcher:
+    """
+    Bounded request queue drained in micro-batches by one worker task.
+
+    Each batch runs through HypothesisExtractor in a single-thread executor,
+    so batches never overlap on the device and the event loop stays free to
+    accept (or reject) requests meanwhile. While a batch runs, the worker
+    already collects the next one, and keeps adding to it until the device
+    is free or the batch is full.
+    """
+
+    def __init__(
+        self,
+        backend: ExtractionBackend,
+        params: Optional[GenerationParams] = None,
+        max_batch_size: int = 8,
+        max_wait_ms: float = 10.0,
+        max_queue: int = 256,
+        max_batch_tokens: int = 8192
+    ):
+        self.extractor = HypothesisExtractor(backend, params, max_batch_size=max_batch_size,
+                                             max_batch_tokens=max_batch_tokens,
+                                             window=max_batch_size)
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.max_queue = max_queue
+        self.queue: Optional[asyncio.Queue] = None
+        self.latency = LatencyTracker()
+        self.counters = {'accepted': 0, 'rejected': 0, 'completed': 0, 'failed': 0,
+                         'batches': 0, 'batched_notes': 0}
+        self.in_flight = 0
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='extract')
+        self._worker: Optional[asyncio.Task] = None
+        self._running: Optional[asyncio.Task] = None
+        # Requests the worker holds outside the queue: the batch it is
+        # collecting and the batch on the device
+        self._collecting: List[Tuple[str, asyncio.Future, float]] = []
+        self._dispatched: List[Tuple[str, asyncio.Future, float]] = []
+
+    async def start(self):
+        self.queue = asyncio.Queue(maxsize=self.max_queue)
+        self._worker = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stop the worker; every request not yet answered fails with ServiceStopped."""
+        for task in (self._worker, self._running):
+            if task:
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        pending = self._collecting + self._dispatched
+        while self.queue and not self.queue.empty():
+            pending.append(self.queue.get_nowait())
+        for _, future, _ in pending:
+            if not future.done():
+                future.set_exception(ServiceStopped())
+        self._executor.shutdown(wait=True)
+
+    async def submit(self, note: str) -> Dict[str, Any]:
+        """Extraction result for one note; raises QueueFull when saturated."""
+        if self._worker is None or self._worker.done():
+            raise ServiceStopped()
+        future = asyncio.get_running_loop().create_future()
+        try:
+            self.queue.put_nowait((note, future, time.perf_counter()))
+        except asyncio.QueueFull:
+            self.counters['rejected'] += 1
+            raise QueueFull() from None
+        self.counters['accepted'] += 1
+        return await future
+
+    async def _collect(self, busy: Optional[asyncio.Task] = None
+                       ) -> List[Tuple[str, asyncio.Future, float]]:
+        """
+        Next batch: up to max_batch_size requests or max_wait after the first,
+        then, while `busy` (the batch on the device) runs, whatever else arrives.
+        """
+        batch = self._collecting = [await self.queue.get()]
+        deadline = asyncio.get_running_loop().time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            # Whatever is already queued joins without waiting
+            if not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+                continue
+            remaining = deadline - asyncio.get_running_loop().time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+
+        while busy and not busy.done() and len(batch) < self.max_batch_size:
+            if not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+                continue
+            get = asyncio.ensure_future(self.queue.get())
+            await asyncio.wait({get, busy}, return_when=asyncio.FIRST_COMPLETED)
+            if get.done():
+                batch.append(get.result())
+            else:
+                get.cancel()  # a cancelled get leaves its item in the queue
+        return batch
+
+    def _extract(self, notes: List[str]) -> List[Dict[str, Any]]:
+        return [
+            {'fields': r.fields, 'fields_present': r.fields_present, 'prompt_tokens': r.prompt_tokens}
+            for r in self.extractor.extract(notes)
+        ]
+
+    async def _run(self):
+        while True:
+            batch = await self._collect(self._running)
+            if self._running:
+                await self._running
+            # Requests whose client already went away are not worth generating
+            batch = [item for item in batch if not item[1].done()]
+            self._collecting, self._dispatched = [], batch
+            if batch:
+                self._running = asyncio.ensure_future(self._dispatch(batch))
+
+    async def _dispatch(self, batch: List[Tuple[str, asyncio.Future, float]]):
+        """Run one batch on the inference thread and resolve its futures."""
+        self.in_flight = len(batch)
+        try:
+            results = await asyncio.get_running_loop().run_in_executor(
+                self._executor, self._extract, [note for note, _, _ in batch])
+        except Exception as exc:  # one bad batch must not kill the worker
+            self.counters['failed'] += len(batch)
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(exc)
+        else:
+            now = time.perf_counter()
+            for (_, future, queued), result in zip(batch, results):
+                self.latency.add(now - queued)
+                if not future.done():
+                    future.set_result(result)
+            self.counters['completed'] += len(batch)
+        finally:
+            self.in_flight = 0
+        self.counters['batches'] += 1
+        self.counters['batched_notes'] += len(batch)
+
+    def metrics(self) -> Dict[str, Any]:
+        batches = self.counters['batches']
+        return {
+            'queue_depth': self.queue.qsize() if self.queue else 0,
+            'queue_capacity': self.max_queue,
+            'in_flight': self.in_flight,
+            **self.counters,
+            'mean_batch_size': round(self.counters['batched_notes'] / batches, 2) if batches else 0.0,
+            'latency': self.latency.percentiles(),
+            'extractor': {**asdict(self.extractor.stats),
+                          'padding_efficiency': round(self.extractor.stats.padding_efficiency, 3)},
+        }
+
+
+class ExtractionService:
+    """Minimal HTTP/1.1 server (keep-alive, JSON bodies) around a MicroBatcher."""
+
+    def __init__(self, batcher: MicroBatcher, request_timeout: Optional[float] = None):
+        self.batcher = batcher
+        self.request_timeout = request_timeout
+        self.server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self, host: str = '127.0.0.1', port: int = 8080):
+        await self.batcher.start()
+        self.server = await asyncio.start_server(self._handle, host, port)
+        return self.server
+
+    async def stop(self):
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+        await self.batcher.stop()
+
+    async def _respond(self, writer: asyncio.StreamWriter, status: int, body: Dict[str, Any],
+                       keep_alive: bool, headers: Optional[Dict[str, str]] = None):
+        payload = json.dumps(body).encode('utf-8')
+        head = [f'HTTP/1.1 {status} {_REASONS.get(status, "")}',
+                'Content-Type: application/json',
+                f'Content-Length: {len(payload)}',
+                f'Connection: {"keep-alive" if keep_alive else "close"}']
+        head += [f'{k}: {v}' for k, v in (headers or {}).items()]
+        writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1') + payload)
+        await writer.drain()
+
+    async def _route(self, method: str, path: str, body: bytes) -> Tuple[int, Dict[str, Any], Dict[str, str]]:
+        if path == '/health':
+            return 200, {'status': 'ok'}, {}
+        if path == '/metrics':
+            return 200, self.batcher.metrics(), {}
+        if path != '/extract':
+            return 404, {'error': 'not found'}, {}
+        if method != 'POST':
+            return 405, {'error': 'use POST'}, {'Allow': 'POST'}
+
+        try:
+            request = json.loads(body)
+            note = request.get('note')
+            if note is None:
+                note = request['clinical_note']['text']  # patient scenario format
+            if not isinstance(note, str) or not note.strip():
+                raise ValueError
+        except (ValueError, KeyError, TypeError, AttributeError):
+            return 400, {'error': 'body must be JSON with a non-empty "note" string'}, {}
+
+        started = time.perf_counter()
+        try:
+            result = await asyncio.wait_for(self.batcher.submit(note), self.request_timeout)
+        except QueueFull:
+            return 429, {'error': 'queue full'}, {'Retry-After': '1'}
+        except ServiceStopped:
+            return 503, {'error': 'service stopping'}, {}
+        except asyncio.TimeoutError:
+            return 504, {'error': 'extraction timed out'}, {}
+        except Exception as exc:
+            return 500, {'error': f'extraction failed: {exc}'}, {}
+        return 200, {**result, 'latency_ms': round((time.perf_counter() - started) * 1000, 2)}, {}
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                try:
+                    method, path, version = request_line.decode('latin-1').split()
+                except ValueError:
+                    await self._respond(writer, 400, {'error': 'bad request line'}, False)
+                    break
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+
+                keep_alive = (headers.get('connection', '').lower() != 'close'
+                              and version.upper() == 'HTTP/1.1')
+                length = int(headers.get('content-length') or 0)
+                if length > MAX_BODY_BYTES:
+                    await self._respond(writer, 413, {'error': 'body too large'}, False)
+                    break
+                body = await reader.readexactly(length) if length else b''
+
+                status, payload, extra = await self._route(method.upper(), path.split('?')[0], body)
+                await self._respond(writer, status, payload, keep_alive, extra)
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='MedGemma extraction service')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--model', default=None,
+                        help='Base model name or path (transformers backend)')
+    parser.add_argument('--adapter', default=None, help='Optional PEFT adapter path')
+    parser.add_argument('--stand_in', action='store_true',
+                        help='Use the deterministic CPU stand-in backend (no model)')
+    parser.add_argument('--stand_in_latency_ms', type=float, default=0.0,
+                        help='Simulated device time per stand-in batch')
+    parser.add_argument('--max_batch_size', type=int, default=8)
+    parser.add_argument('--max_wait_ms', type=float, default=10.0,
+                        help='How long the first request of a batch waits for company')
+    parser.add_argument('--max_queue', type=int, default=256,
+                        help='Queued requests beyond this get 429')
+    parser.add_argument('--timeout', type=float, default=None,
+                        help='Per-request timeout in seconds (504 after)')
+    parser.add_argument('--json_mode', action='store_true',
+                        help='Grammar-constrained JSON output')
+    args = parser.parse_args()
+
+    if args.stand_in:
+        backend: ExtractionBackend = StandInBackend(latency=args.stand_in_latency_ms / 1000)
+    elif args.model:
+        from transformers import AutoModelForCausalLM, AutoTokenizer
+
+        from .hypothesis_extractor import TransformersBackend
+
+        tokenizer = AutoTokenizer.from_pretrained(args.model)
+        model = AutoModelForCausalLM.from_pretrained(args.model, device_map='auto')
+        if args.adapter:
+            from peft import PeftModel
+            model = PeftModel.from_pretrained(model, args.adapter)
+        model.eval()
+        backend = TransformersBackend(model, tokenizer)
+    else:
+        parser.error('pass --model or --stand_in')
+
+    batcher = MicroBatcher(backend, GenerationParams(json_mode=args.json_mode),
+                           max_batch_size=args.max_batch_size, max_wait_ms=args.max_wait_ms,
+                           max_queue=args.max_queue)
+    service = ExtractionService(batcher, request_timeout=args.timeout)
+
+    async def serve():
+        server = await service.start(args.host, args.port)
+        print(f'Serving {backend.name} extraction on http://{args.host}:{args.port}')
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            await service.stop()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,217 @@
+"""
+Streaming Field Parser
+Single-pass parser for the six-field extraction format. Text can be fed in
+chunks as it is decoded; labels are found with one combined regex that only
+ever scans forward, and `done` turns True once CLINICAL REASONING (the last
+field) is complete, so generation can stop early (FieldStoppingCriteria).
+
+Results match the notebooks' parse_fields on complete text.
+"""
+
+import re
+from typing import Any, Dict, List, Optional, Tuple
+
+FIELD_PATTERNS = [
+    ('primary_hypothesis',      r'PRIMARY HYPOTHESIS:'),
+    ('differential_diagnoses',  r'DIFFERENTIAL DIAGNOSES:'),
+    ('key_supporting_evidence', r'KEY SUPPORTING EVIDENCE:'),
+    ('urgency_level',           r'URGENCY LEVEL:'),
+    ('tests_ordered',           r'TESTS ORDERED:'),
+    ('clinical_reasoning',      r'CLINICAL REASONING:'),
+]
+FIELD_KEYS = [k for k, _ in FIELD_PATTERNS]
+
+FIELD_LABEL_RE = (
+    r'(?:PRIMARY HYPOTHESIS|DIFFERENTIAL DIAGNOSES|KEY SUPPORTING EVIDENCE|'
+    r'URGENCY LEVEL|TESTS ORDERED|CLINICAL REASONING):'
+)
+
+# One alternation, one group per field, so a match says which label it was
+_LABELS_RE = re.compile('|'.join(f'({p})' for _, p in FIELD_PATTERNS), re.IGNORECASE)
+_LONGEST_LABEL = max(len(p) for _, p in FIELD_PATTERNS)
+
+# A field with no following label runs at most this many characters
+VALUE_LIMIT = 800
+
+_END_OF_TURN = '<end_of_turn>'
+
+
+def normalize_urgency(value: str) -> str:
+    """'moderate' -> 'medium', default 'medium'."""
+    u = value.lower()
+    if 'high' in u:
+        return 'high'
+    if 'low' in u:
+        return 'low'
+    return 'medium'
+
+
+class StreamingFieldParser:
+    """
+    Incremental parse_fields.
+
+        parser = StreamingFieldParser()
+        for chunk in chunks:
+            parser.feed(chunk)
+            if parser.done:
+                break
+        fields = parser.result()
+
+    Markdown bold markers (**) are dropped as text arrives, exactly like
+    re.sub(r'\\*\\*', '', text). Only the first occurrence of each label is
+    used; any label ends the field before it.
+
+    `done` needs all six labels and a finished reasoning field: another
+    label after it, VALUE_LIMIT characters of it, or (stop_on_blank_line)
+    a blank line / end-of-turn after some reasoning text. The blank-line
+    rule is what makes early stopping useful; it drops anything the model
+    would have written after a paragraph break in its reasoning.
+    """
+
+    def __init__(self, stop_on_blank_line: bool = True):
+        self.stop_on_blank_line = stop_on_blank_line
+        self.text = ''                    # cleaned text so far
+        self._stars = ''                  # trailing '*' run held back across chunks
+        self._scan = 0                    # label scanning resumes here
+        self.labels: List[Tuple[int, int, int]] = []   # (field index, label start, value start)
+        self.first: Dict[int, int] = {}   # field index -> position in self.labels
+        self.done = False
+
+    def _clean(self, chunk: str) -> str:
+        chunk = self._stars + chunk
+        stripped = chunk.rstrip('*')
+        self._stars = chunk[len(stripped):]
+        # A run of k stars leaves k % 2 after removing '**' pairs left to right
+        return re.sub(r'\*+', lambda m: '*' * (len(m.group()) % 2), stripped)
+
+    def feed(self, chunk: str) -> bool:
+        """Add decoded text; returns self.done. Text after done is still parsed."""
+        self.text += self._clean(chunk)
+        self._scan_labels()
+        self.done = self.done or self._reasoning_complete()
+        return self.done
+
+    def _scan_labels(self):
+        for m in _LABELS_RE.finditer(self.text, self._scan):
+            field = m.lastindex - 1
+            if field not in self.first:
+                self.first[field] = len(self.labels)
+            self.labels.append((field, m.start(), m.end()))
+            self._scan = m.end()
+        # A label could be cut off at the end of the text; rescan that tail next time
+        self._scan = max(self._scan, len(self.text) - _LONGEST_LABEL + 1)
+
+    def _reasoning_complete(self) -> bool:
+        if len(self.first) < len(FIELD_PATTERNS):
+            return False
+        pos = self.first[len(FIELD_PATTERNS) - 1]
+        if pos + 1 < len(self.labels):
+            return True
+        value = self.text[self.labels[pos][2]:]
+        if len(value) >= VALUE_LIMIT:
+            return True
+        if self.stop_on_blank_line:
+            body = value.lstrip()
+            return bool(body) and ('\n\n' in body.rstrip(' \t') or _END_OF_TURN in body)
+        return False
+
+    def finish(self):
+        """Flush held-back characters (call after the last chunk)."""
+        if self._stars:
+            self.text += '*' * (len(self._stars) % 2)
+            self._stars = ''
+            self._scan_labels()
+
+    def value(self, field: int) -> str:
+        pos = self.first.get(field)
+        if pos is None:
+            return ''
+        start = self.labels[pos][2]
+        end = self.labels[pos + 1][1] if pos + 1 < len(self.labels) else start + VALUE_LIMIT
+        value = self.text[start:end]
+        if self.done and self.stop_on_blank_line and field == len(FIELD_PATTERNS) - 1 \
+                and pos + 1 == len(self.labels):
+            value = value.split(_END_OF_TURN)[0]
+            body = value.lstrip()
+            cut = body.find('\n\n')
+            value = body[:cut] if cut >= 0 else body
+        return value.strip().strip('[]')
+
+    def result(self) -> Dict[str, str]:
+        """Parsed fields, same shape and urgency normalization as parse_fields."""
+        self.finish()
+        result = {key: self.value(i) for i, key in enumerate(FIELD_KEYS)}
+        result['urgency_level'] = normalize_urgency(result['urgency_level'])
+        return result
+
+
+def field_spans(text: str) -> Dict[str, Tuple[int, int]]:
+    """
+    Character span of each field's value in raw generated text (markdown
+    and all): from the end of its first label to the next label, or at
+    most VALUE_LIMIT characters. Used to line generated tokens up with fields.
+    """
+    labels = [(m.lastindex - 1, m.start(), m.end()) for m in _LABELS_RE.finditer(text)]
+    spans: Dict[str, Tuple[int, int]] = {}
+    for pos, (field, _, start) in enumerate(labels):
+        key = FIELD_KEYS[field]
+        if key not in spans:
+            end = labels[pos + 1][1] if pos + 1 < len(labels) else min(len(text), start + VALUE_LIMIT)
+            spans[key] = (start, end)
+    return spans
+
+
+def parse_fields(text: str, stop_on_blank_line: bool = False) -> Dict[str, str]:
+    """
+    Extract all 6 structured fields from complete generated text in one pass.
+    stop_on_blank_line applies the early-stop cut to the reasoning field, for
+    text generated with early stopping (the stop token may carry a fragment
+    past the blank line).
+    """
+    parser = StreamingFieldParser(stop_on_blank_line=stop_on_blank_line)
+    parser.feed(text)
+    return parser.result()
+
+
+class FieldStoppingCriteria:
+    """
+    transformers stopping criterion: decodes each row's new tokens
+    incrementally into a StreamingFieldParser and reports rows whose
+    reasoning field is complete. Pass it in generate(stopping_criteria=[...]).
+    """
+
+    def __init__(self, tokenizer, prompt_length: int, batch_size: int,
+                 stop_on_blank_line: bool = True):
+        self.tokenizer = tokenizer
+        self.prompt_length = prompt_length
+        self.parsers = [StreamingFieldParser(stop_on_blank_line) for _ in range(batch_size)]
+        # Per row: token ids not yet flushed and how much of their decode was fed
+        self._pending: List[List[int]] = [[] for _ in range(batch_size)]
+        self._fed: List[int] = [0] * batch_size
+        self._seen = prompt_length
+
+    def __call__(self, input_ids, scores, **kwargs) -> Any:
+        import torch
+
+        new = input_ids[:, self._seen:].tolist()
+        self._seen = input_ids.shape[1]
+        for row, ids in enumerate(new):
+            parser = self.parsers[row]
+            if parser.done:
+                continue
+            pending = self._pending[row]
+            pending.extend(ids)
+            text = self.tokenizer.decode(pending, skip_special_tokens=True)
+            # Hold back incomplete multi-byte sequences until the next token
+            if text.endswith('�'):
+                continue
+            parser.feed(text[self._fed[row]:])
+            if text.endswith('\n'):
+                pending.clear()
+                self._fed[row] = 0
+            else:
+                self._fed[row] = len(text)
+        return torch.tensor([p.done for p in self.parsers], device=input_ids.device)
+
+    def results(self) -> List[Optional[Dict[str, str]]]:
+        return [p.result() for p in self.parsers]
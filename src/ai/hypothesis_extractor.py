@@ -0,0 +1,679 @@
+"""
+Hypothesis Extraction Engine
+Batched version of the 03_batch_inference extraction loop: notes are bucketed
+by token length, generated in padded batches through a pluggable backend and
+parsed back into the six structured fields, in input order.
+
+    extractor = HypothesisExtractor(TransformersBackend(model, tokenizer))
+    for result in extractor.extract(notes):
+        print(result.index, result.fields["primary_hypothesis"])
+"""
+
+import hashlib
+import json
+import time
+from collections import deque
+from dataclasses import dataclass
+from itertools import islice
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from .field_parser import (  # noqa: F401  (re-exported for callers of this module)
+    FIELD_KEYS, FIELD_LABEL_RE, FIELD_PATTERNS, FieldStoppingCriteria,
+    StreamingFieldParser, field_spans, parse_fields,
+)
+from .json_grammar import (
+    EXTRACTION_SCHEMA, JSONConstraintProcessor, json_field_spans, json_prompt_tail, parse_json_fields,
+    token_index, token_strings,
+)
+from .note_compressor import NoteCompressor
+
+MODEL_TURN = '<start_of_turn>model'
+
+# Fixed instruction text before the note: identical for every note, so its
+# KV cache is computed once per model (see TransformersBackend)
+EXTRACTION_PREFIX = (
+    '<start_of_turn>user\n'
+    'Extract diagnostic information from this clinical note.\n\n'
+    'Clinical Note:\n'
+)
+
+
+def build_prompt(note_text: str) -> str:
+    """MedGemma chat prompt used for fine-tuning and inference."""
+    return (
+        f'{EXTRACTION_PREFIX}{note_text}\n\n'
+        'Output ONLY these 6 fields:\n'
+        'PRIMARY HYPOTHESIS: [main diagnosis]\n'
+        'DIFFERENTIAL DIAGNOSES: [comma-separated alternatives]\n'
+        'KEY SUPPORTING EVIDENCE: [comma-separated findings]\n'
+        'URGENCY LEVEL: [high/medium/low]\n'
+        'TESTS ORDERED: [comma-separated tests]\n'
+        'CLINICAL REASONING: [brief explanation]'
+        '<end_of_turn>\n<start_of_turn>model\n'
+    )
+
+
+def build_json_prompt(note_text: str) -> str:
+    """Prompt for json_mode: same prefix, JSON instead of the labelled fields."""
+    return (
+        f'{EXTRACTION_PREFIX}{note_text}\n\n'
+        f'{json_prompt_tail()}'
+        '<end_of_turn>\n<start_of_turn>model\n'
+    )
+
+
+def decode_output(raw: str) -> str:
+    """Model text after the last model-turn marker (keeps the PRIMARY HYPOTHESIS label)."""
+    if MODEL_TURN in raw:
+        return raw.split(MODEL_TURN)[-1].lstrip('\n').strip()
+    return raw.strip()
+
+
+@dataclass
+class GenerationParams:
+    """Decoding settings (defaults match the notebooks)."""
+    max_length: int = 1024          # prompt truncation, in tokens
+    max_new_tokens: int = 600
+    repetition_penalty: float = 1.1
+    do_sample: bool = False
+    early_stop: bool = True         # stop once CLINICAL REASONING is complete
+    json_mode: bool = False         # grammar-constrained JSON output (json_grammar)
+    logprobs: bool = False          # per-field token log-probability stats
+
+
+def parse_output(text: str, params: GenerationParams) -> Dict[str, str]:
+    """Six extraction fields from decoded model text, in either output mode."""
+    if params.json_mode:
+        fields = parse_json_fields(text)
+        if fields is not None:
+            return fields
+        # Not JSON at all: a backend that ignored json_mode
+    return parse_fields(text, stop_on_blank_line=params.early_stop)
+
+
+def parse_raw_output(raw: str, params: GenerationParams) -> Dict[str, str]:
+    """parse_output on raw backend output (model-turn marker and prompt echo stripped)."""
+    return parse_output(decode_output(raw), params)
+
+
+@dataclass
+class ExtractionResult:
+    """Parsed output for one input note."""
+    index: int
+    fields: Dict[str, str]
+    raw: str
+    prompt_tokens: int
+
+    field_logprobs: Optional[Dict[str, Dict[str, float]]] = None   # params.logprobs only
+
+    @property
+    def fields_present(self) -> int:
+        return sum(1 for k in FIELD_KEYS if self.fields.get(k))
+
+
+@dataclass
+class ScoredText:
+    """Generated text with, per generated token, its character span, log-probability and entropy."""
+    text: str
+    offsets: List[Tuple[int, int]]
+    logprobs: List[float]
+    entropies: List[float]
+
+
+def field_logprob_stats(scored: ScoredText, json_mode: bool = False) -> Dict[str, Dict[str, float]]:
+    """
+    mean / min token log-probability and mean entropy (nats) over the tokens
+    of each field's value; fields with no tokens are left out.
+    """
+    spans = json_field_spans(scored.text) if json_mode else field_spans(scored.text)
+    stats = {}
+    for key, (lo, hi) in spans.items():
+        picked = [(lp, ent) for (start, end), lp, ent in zip(scored.offsets, scored.logprobs, scored.entropies)
+                  if end > start and start < hi and end > lo]
+        if not picked:
+            continue
+        logprobs = [lp for lp, _ in picked]
+        stats[key] = {
+            'mean_logprob': round(sum(logprobs) / len(logprobs), 4),
+            'min_logprob': round(min(logprobs), 4),
+            'mean_entropy': round(sum(ent for _, ent in picked) / len(picked), 4),
+            'tokens': len(picked),
+        }
+    return stats
+
+
+# ── Backends
+
+class ExtractionBackend:
+    """
+    Interface the extractor drives. A backend only needs to count prompt
+    tokens (for bucketing) and generate a batch; padding, truncation and
+    device placement are its own business.
+
+    `prefix`, when given, is a fixed string every prompt in the batch starts
+    with; backends may reuse work for it across calls or ignore it.
+    count_tokens counts special tokens (BOS) unless add_special_tokens is
+    False, which is what fragments of a prompt (NoteCompressor units) need.
+    """
+    name = "backend"
+
+    def count_tokens(self, prompts: List[str], add_special_tokens: bool = True) -> List[int]:
+        raise NotImplementedError
+
+    def generate(self, prompts: List[str], params: GenerationParams,
+                 prefix: Optional[str] = None) -> List[str]:
+        """Generated text for each prompt (prompt echo optional; decode_output strips it)."""
+        raise NotImplementedError
+
+    def generate_scored(self, prompts: List[str], params: GenerationParams,
+                        prefix: Optional[str] = None) -> List[ScoredText]:
+        """generate() plus per-token log-probabilities (params.logprobs); optional."""
+        raise NotImplementedError(f'{self.name} backend does not expose token log-probabilities')
+
+    def generate_parsed(self, prompts: List[str], params: GenerationParams,
+                        parse: Callable[[str, GenerationParams], Any],
+                        prefix: Optional[str] = None) -> List[Tuple[str, Any]]:
+        """(raw, parse(raw, params)) per prompt; caching backends may return a stored parse."""
+        return [(raw, parse(raw, params)) for raw in self.generate(prompts, params, prefix=prefix)]
+
+
+class TransformersBackend(ExtractionBackend):
+    """
+    HF causal LM (+ optional PEFT adapter) with left-padded batched generate.
+
+    With a prefix, the prefix's key/value cache is computed once and kept
+    for the life of the backend (one backend per model); each call only
+    prefills the per-note suffixes. Suffixes are left-padded AFTER the
+    prefix, and the attention mask keeps the gap out of attention and
+    position ids, so cached prefix positions stay valid for every row.
+
+    generated_tokens counts the new tokens of every row, up to and including
+    its first EOS, across all calls.
+    """
+    name = "transformers"
+
+    def __init__(self, model, tokenizer, prefix_cache: bool = True):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.prefix_cache = prefix_cache
+        self._prefix_states: Dict[str, Tuple[Any, Any]] = {}
+        self._token_strings: Optional[List[Optional[str]]] = None
+        self._token_index: Optional[Dict[str, int]] = None
+        # Legal tokens per forced EXTRACTION_SCHEMA state, shared by every JSON generate()
+        self._json_legal: Dict[Any, List[Tuple[int, Any]]] = {}
+        self.generated_tokens = 0
+        # Decoder-only models must be left-padded so generation continues
+        # straight from each prompt's last real token
+        self.tokenizer.padding_side = 'left'
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+
+    def count_tokens(self, prompts: List[str], add_special_tokens: bool = True) -> List[int]:
+        encoded = self.tokenizer(prompts, add_special_tokens=add_special_tokens)['input_ids']
+        return [len(ids) for ids in encoded]
+
+    def _stopping(self, params: GenerationParams, prompt_length: int, batch_size: int) -> Dict[str, Any]:
+        """
+        generate() kwargs for early stopping or JSON constraints; rows stop
+        independently. A constrained row is forced to EOS once its object
+        closes, so json_mode needs no stopping criterion.
+        """
+        if params.json_mode:
+            if self._token_strings is None:
+                self._token_strings = token_strings(self.tokenizer)
+                self._token_index = token_index(self._token_strings)
+            return {'logits_processor': [JSONConstraintProcessor(
+                self.tokenizer, prompt_length, batch_size, strings=self._token_strings,
+                max_new_tokens=params.max_new_tokens, index=self._token_index,
+                legal=self._json_legal)]}
+        if not params.early_stop:
+            return {}
+        return {'stopping_criteria': [FieldStoppingCriteria(self.tokenizer, prompt_length, batch_size)]}
+
+    def _end_ids(self) -> set:
+        """Ids that end a row: the model's EOS ids (Gemma's <end_of_turn>) and pad."""
+        config = getattr(self.model, 'generation_config', None)
+        eos = getattr(config, 'eos_token_id', None)
+        if eos is None:
+            eos = self.tokenizer.eos_token_id
+        ends = set(eos) if isinstance(eos, (list, tuple)) else {eos}
+        return ends | {self.tokenizer.eos_token_id, self.tokenizer.pad_token_id}
+
+    def _decode_new(self, new_tokens) -> List[str]:
+        # Finished rows are filled with pad (EOS when the tokenizer has no pad)
+        ends = self._end_ids()
+        for ids in new_tokens.tolist():
+            self.generated_tokens += next((k + 1 for k, t in enumerate(ids) if t in ends), len(ids))
+        return self.tokenizer.batch_decode(new_tokens, skip_special_tokens=True)
+
+    def _prefix_state(self, prefix: str) -> Tuple[Any, Any]:
+        """(prefix input_ids, prefix KV cache), computed on first use."""
+        state = self._prefix_states.get(prefix)
+        if state is None:
+            import torch
+
+            ids = self.tokenizer(prefix, return_tensors='pt')['input_ids'].to(self.model.device)
+            with torch.no_grad():
+                cache = self.model(input_ids=ids, use_cache=True).past_key_values
+            state = self._prefix_states[prefix] = (ids, cache)
+        return state
+
+    def _prefix_inputs(self, prompts: List[str], params: GenerationParams,
+                       prefix: str) -> Dict[str, Any]:
+        """generate() inputs: shared prefix tokens, padded suffixes, a copy of the prefix cache."""
+        import copy
+        import torch
+
+        prefix_ids, prefix_cache = self._prefix_state(prefix)
+        n_prefix = prefix_ids.shape[1]
+        suffixes = self.tokenizer(
+            [p[len(prefix):] for p in prompts], add_special_tokens=False,
+            truncation=True, max_length=max(1, params.max_length - n_prefix)
+        )['input_ids']
+
+        width = max(len(s) for s in suffixes)
+        input_ids = torch.full((len(prompts), n_prefix + width), self.tokenizer.pad_token_id,
+                               dtype=torch.long)
+        attention_mask = torch.zeros_like(input_ids)
+        input_ids[:, :n_prefix] = prefix_ids[0].cpu()
+        attention_mask[:, :n_prefix] = 1
+        for row, ids in enumerate(suffixes):
+            input_ids[row, n_prefix + width - len(ids):] = torch.tensor(ids, dtype=torch.long)
+            attention_mask[row, n_prefix + width - len(ids):] = 1
+
+        # generate() extends the cache in place, so every call gets its own copy
+        cache = copy.deepcopy(prefix_cache)
+        if len(prompts) > 1:
+            if hasattr(cache, 'batch_repeat_interleave'):
+                cache.batch_repeat_interleave(len(prompts))
+            else:  # legacy tuple-of-tuples cache
+                cache = tuple(tuple(t.repeat_interleave(len(prompts), dim=0) for t in layer)
+                              for layer in cache)
+
+        return {
+            'input_ids': input_ids.to(self.model.device),
+            'attention_mask': attention_mask.to(self.model.device),
+            'past_key_values': cache,
+        }
+
+    def _inputs(self, prompts: List[str], params: GenerationParams,
+                prefix: Optional[str]) -> Dict[str, Any]:
+        if prefix and self.prefix_cache and all(p.startswith(prefix) for p in prompts):
+            return self._prefix_inputs(prompts, params, prefix)
+        return dict(self.tokenizer(
+            prompts, return_tensors='pt', padding=True,
+            truncation=True, max_length=params.max_length
+        ).to(self.model.device))
+
+    def _run(self, inputs: Dict[str, Any], params: GenerationParams,
+             recorder: Optional['TokenLogprobRecorder'] = None):
+        """model.generate() on prepared inputs; returns the new token ids."""
+        import torch
+
+        prompt_length = inputs['input_ids'].shape[1]
+        kwargs = self._stopping(params, prompt_length, inputs['input_ids'].shape[0])
+        if recorder is not None:
+            # First, so it sees the model's distribution before JSON masking
+            kwargs['logits_processor'] = [recorder, *kwargs.get('logits_processor', [])]
+
+        with torch.no_grad():
+            out = self.model.generate(
+                **inputs,
+                max_new_tokens=params.max_new_tokens,
+                do_sample=params.do_sample,
+                repetition_penalty=params.repetition_penalty,
+                pad_token_id=self.tokenizer.pad_token_id,   # set in __init__; 0 for Gemma
+                **kwargs,
+            )
+        return out[:, prompt_length:]
+
+    def generate(self, prompts: List[str], params: GenerationParams,
+                 prefix: Optional[str] = None) -> List[str]:
+        return self._decode_new(self._run(self._inputs(prompts, params, prefix), params))
+
+    def generate_scored(self, prompts: List[str], params: GenerationParams,
+                        prefix: Optional[str] = None) -> List['ScoredText']:
+        recorder = TokenLogprobRecorder()
+        new_tokens = self._run(self._inputs(prompts, params, prefix), params, recorder)
+        logprobs, entropies = recorder.finish(new_tokens)
+        texts = self._decode_new(new_tokens)
+
+        return [ScoredText(text, self._token_offsets(ids), logprobs[row], entropies[row])
+                for row, (text, ids) in enumerate(zip(texts, new_tokens.tolist()))]
+
+    def _token_offsets(self, ids: List[int]) -> List[Tuple[int, int]]:
+        """
+        Character span of each token in the decoded row. Like
+        FieldStoppingCriteria, only the tokens since the last newline are
+        re-decoded, so a row costs O(tokens x line length), not O(tokens^2).
+        """
+        offsets: List[Tuple[int, int]] = []
+        base, fed, pending = 0, 0, []
+        for token in ids:
+            pending.append(token)
+            text = self.tokenizer.decode(pending, skip_special_tokens=True)
+            if text.endswith('\ufffd'):
+                # Incomplete multi-byte sequence: the token completing it gets the span
+                offsets.append((base + fed, base + fed))
+                continue
+            offsets.append((base + fed, base + len(text)))
+            if text.endswith('\n'):
+                base += len(text)
+                pending.clear()
+                fed = 0
+            else:
+                fed = len(text)
+        return offsets
+
+
+class TokenLogprobRecorder:
+    """
+    transformers logits processor recording, per row and step, the entropy
+    of the next-token distribution and the log-probability of the token
+    that was then chosen. Holds one step's log-softmax at a time, never the
+    whole [steps, vocab] score history. Scores are those after repetition
+    penalty, which generate() applies before user processors.
+    """
+
+    def __init__(self):
+        self.logprobs: List[Any] = []
+        self.entropies: List[Any] = []
+        self._last = None
+
+    def __call__(self, input_ids, scores):
+        import torch
+
+        if self._last is not None:
+            self.logprobs.append(self._last.gather(1, input_ids[:, -1:]).squeeze(1).cpu())
+        logp = torch.log_softmax(scores.float(), dim=-1)
+        self.entropies.append(-(logp.exp() * logp.nan_to_num(neginf=0.0)).sum(-1).cpu())
+        self._last = logp
+        return scores
+
+    def finish(self, new_tokens) -> Tuple[List[List[float]], List[List[float]]]:
+        """Per-row (logprobs, entropies), one per generated token."""
+        import torch
+
+        if self._last is not None:
+            self.logprobs.append(self._last.gather(1, new_tokens[:, -1:].to(self._last.device)).squeeze(1).cpu())
+            self._last = None
+        if not self.logprobs:
+            return [[] for _ in range(new_tokens.shape[0])], [[] for _ in range(new_tokens.shape[0])]
+        return torch.stack(self.logprobs, 1).tolist(), torch.stack(self.entropies, 1).tolist()
+
+
+class StandInBackend(ExtractionBackend):
+    """
+    Deterministic CPU stand-in for tests and benchmarks: whitespace tokens,
+    field values derived from a hash of the note. Records every batch it is
+    given in self.batches as (batch_size, longest_prompt_tokens), and counts
+    prefill work the way TransformersBackend does it: prefill_tokens only
+    includes a prefix the first time that prefix is seen.
+
+    Extraction outputs end with a rambling tail after the reasoning, which
+    params.early_stop cuts off word by word through StreamingFieldParser;
+    generated_tokens counts the words actually produced. JSON prompts get
+    an object that satisfies EXTRACTION_SCHEMA (checked as it is emitted).
+    `latency` seconds are slept per generate() call to stand in for device time.
+    """
+    name = "stand-in"
+
+    URGENCIES = ("high", "medium", "low")
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.batches: List[Tuple[int, int]] = []
+        self.prefill_tokens = 0
+        self.generated_tokens = 0
+        self.prefixes_cached: Dict[str, int] = {}
+
+    def count_tokens(self, prompts: List[str], add_special_tokens: bool = True) -> List[int]:
+        return [len(p.split()) for p in prompts]
+
+    def _note(self, prompt: str) -> str:
+        start = prompt.find('Clinical Note')
+        if start < 0:
+            return prompt
+        start = prompt.find(':\n', start) + 2
+        end = prompt.find('\n\n', start)
+        return prompt[start:end if end > start else len(prompt)]
+
+    def _respond(self, prompt: str) -> str:
+        note = self._note(prompt)
+        digest = hashlib.sha1(note.encode('utf-8')).hexdigest()
+        roll = int(digest[18:20], 16)
+
+        # Agent prompts (result_analyzer) get answers in their own formats
+        quality = 'FAIL: Stand-in quality issue.' if roll % 7 == 0 else 'PASS'
+        flagged = roll % 5 == 0
+        confidence = (f'CONFIDENCE: {3 + roll % 8}\n'
+                      f'FLAG: {"yes" if flagged else "no"}\n'
+                      f'REASON: {"Stand-in flag." if flagged else "none"}')
+        if 'QUALITY: [PASS' in prompt:
+            return f'QUALITY: {quality}\n{confidence}'
+        if 'CONFIDENCE: [1-10]' in prompt:
+            return confidence
+        if 'Output exactly one of:\nPASS' in prompt:
+            return quality
+
+        words = [w.strip('.,;:()') for w in note.split()[:12] if len(w) > 3]
+        if 'Output ONLY a JSON object' in prompt:
+            symptoms = [w for w in words[:3] if w]
+            return json.dumps({
+                'primary_hypothesis': f'Condition {digest[:6]}',
+                'differential_diagnoses': [f'Condition {digest[6:12]}', f'Condition {digest[12:18]}'],
+                'key_symptoms': symptoms + ['none'] * (2 - len(symptoms)),
+                'urgency': self.URGENCIES[roll % 3],
+                'tests_ordered': ['CBC', 'BMP'],
+                'reasoning': f'Stand-in output for a {len(note.split())}-word note.',
+            }, ensure_ascii=False)
+        return (
+            f'PRIMARY HYPOTHESIS: Condition {digest[:6]}\n'
+            f'DIFFERENTIAL DIAGNOSES: Condition {digest[6:12]}, Condition {digest[12:18]}\n'
+            f'KEY SUPPORTING EVIDENCE: {", ".join(words[:3]) or "none"}\n'
+            f'URGENCY LEVEL: {self.URGENCIES[roll % 3]}\n'
+            f'TESTS ORDERED: CBC, BMP\n'
+            f'CLINICAL REASONING: Stand-in output for a {len(note.split())}-word note.\n\n'
+            + 'Additional commentary the parser never uses. ' * 20
+        )
+
+    def _emit(self, text: str, params: GenerationParams) -> str:
+        """Word-by-word 'generation', honoring max_new_tokens and early_stop."""
+        words = text.split(' ')[:params.max_new_tokens]
+        if params.json_mode:
+            state = EXTRACTION_SCHEMA.advance(EXTRACTION_SCHEMA.start(), ' '.join(words))
+            if state is None:
+                raise ValueError('stand-in JSON output violates EXTRACTION_SCHEMA')
+        elif params.early_stop and 'PRIMARY HYPOTHESIS:' in text:
+            parser = StreamingFieldParser()
+            for n, word in enumerate(words, 1):
+                if parser.feed(word + ' '):
+                    words = words[:n]
+                    break
+        self.generated_tokens += len(words)
+        return ' '.join(words)
+
+    def generate(self, prompts: List[str], params: GenerationParams,
+                 prefix: Optional[str] = None) -> List[str]:
+        lengths = self.count_tokens(prompts)
+        self.batches.append((len(prompts), max(lengths, default=0)))
+        self.prefill_tokens += sum(lengths)
+        if prefix and all(p.startswith(prefix) for p in prompts):
+            n_prefix = len(prefix.split())
+            self.prefill_tokens -= n_prefix * len(prompts)
+            if prefix not in self.prefixes_cached:
+                self.prefixes_cached[prefix] = n_prefix
+                self.prefill_tokens += n_prefix
+        if self.latency:
+            time.sleep(self.latency)
+        return [self._emit(self._respond(p), params) for p in prompts]
+
+    def generate_scored(self, prompts: List[str], params: GenerationParams,
+                        prefix: Optional[str] = None) -> List[ScoredText]:
+        """
+        Words as tokens, with log-probabilities drawn from a hash of the note:
+        each note gets a fixed 'difficulty', so some come out confidently and
+        some do not.
+        """
+        scored = []
+        for prompt, text in zip(prompts, self.generate(prompts, params, prefix=prefix)):
+            digest = hashlib.sha1(self._note(prompt).encode('utf-8')).digest()
+            difficulty = digest[0] / 255
+            offsets, logprobs, entropies, pos = [], [], [], 0
+            for n, word in enumerate(text.split(' ')):
+                end = pos + len(word) + (1 if pos + len(word) < len(text) else 0)
+                u = digest[1 + n % 19] / 255
+                offsets.append((pos, end))
+                logprobs.append(round(-2.5 * difficulty * u, 4))
+                entropies.append(round(0.05 + 3.0 * difficulty * u, 4))
+                pos = end
+            scored.append(ScoredText(text, offsets, logprobs, entropies))
+        return scored
+
+
+# ── Engine
+
+@dataclass
+class ExtractorStats:
+    """Batching efficiency counters."""
+    notes: int = 0
+    batches: int = 0
+    prompt_tokens: int = 0
+    padded_tokens: int = 0     # batch_size x longest prompt, summed over batches
+
+    @property
+    def padding_efficiency(self) -> float:
+        return self.prompt_tokens / self.padded_tokens if self.padded_tokens else 1.0
+
+
+class HypothesisExtractor:
+    """
+    Dynamic-batching extraction engine.
+
+    Reads up to `window` notes ahead, sorts them by tokenized length and
+    cuts them into batches of at most `max_batch_size` notes and
+    `max_batch_tokens` padded prompt tokens, so similar-length notes share
+    a batch and padding stays small. Results are yielded in input order as
+    soon as every earlier note is done.
+
+    With params.json_mode the prompt asks for a JSON object and
+    TransformersBackend masks the vocabulary to EXTRACTION_SCHEMA, so
+    output parses with json.loads on the first try.
+
+    With params.logprobs the backend's generate_scored() is used and each
+    result carries per-field token log-probability stats (field_logprobs;
+    '_field_logprobs' in extract_patients), which
+    result_analyzer.CascadePolicy turns into a confidence score.
+
+    A NoteCompressor, if given, packs each note into its 'extraction'
+    budget before prompting, instead of leaving the tokenizer to cut the
+    end of the note (usually the ASSESSMENT and PLAN) at max_length.
+    """
+
+    def __init__(
+        self,
+        backend: ExtractionBackend,
+        params: Optional[GenerationParams] = None,
+        max_batch_size: int = 8,
+        max_batch_tokens: int = 8192,
+        window: int = 64,
+        compressor: Optional[NoteCompressor] = None
+    ):
+        self.backend = backend
+        self.compressor = compressor
+        self.params = params or GenerationParams()
+        self.max_batch_size = max_batch_size
+        self.max_batch_tokens = max_batch_tokens
+        self.window = max(window, max_batch_size)
+        self.stats = ExtractorStats()
+
+    def _batches(self, order: List[int], lengths: List[int]) -> Iterator[List[int]]:
+        batch: List[int] = []
+        longest = 0
+        for i in order:
+            n = min(lengths[i], self.params.max_length)
+            if batch and (len(batch) >= self.max_batch_size
+                          or max(longest, n) * (len(batch) + 1) > self.max_batch_tokens):
+                yield batch
+                batch, longest = [], 0
+            batch.append(i)
+            longest = max(longest, n)
+        if batch:
+            yield batch
+
+    def extract(self, notes: Iterable[str]) -> Iterator[ExtractionResult]:
+        """Yield an ExtractionResult per note, in input order."""
+        notes = iter(notes)
+        base = 0
+        while True:
+            prompt = build_json_prompt if self.params.json_mode else build_prompt
+            batch_notes = list(islice(notes, self.window))
+            if self.compressor:
+                batch_notes = [self.compressor.compress(n, 'extraction') for n in batch_notes]
+            prompts = [prompt(n) for n in batch_notes]
+            if not prompts:
+                return
+            lengths = self.backend.count_tokens(prompts)
+            order = sorted(range(len(prompts)), key=lengths.__getitem__)
+
+            done: Dict[int, ExtractionResult] = {}
+            next_out = 0
+            for batch in self._batches(order, lengths):
+                batch_prompts = [prompts[i] for i in batch]
+                if self.params.logprobs:
+                    scored = self.backend.generate_scored(batch_prompts, self.params,
+                                                          prefix=EXTRACTION_PREFIX)
+                    generated = [s.text for s in scored]
+                    parsed = [parse_raw_output(t, self.params) for t in generated]
+                else:
+                    scored = None
+                    pairs = self.backend.generate_parsed(batch_prompts, self.params, parse_raw_output,
+                                                         prefix=EXTRACTION_PREFIX)
+                    generated = [raw for raw, _ in pairs]
+                    parsed = [fields for _, fields in pairs]
+                for k, (i, raw, fields) in enumerate(zip(batch, generated, parsed)):
+                    done[i] = ExtractionResult(base + i, fields, decode_output(raw), lengths[i])
+                    if scored:
+                        done[i].field_logprobs = field_logprob_stats(scored[k], self.params.json_mode)
+
+                batch_lengths = [min(lengths[i], self.params.max_length) for i in batch]
+                self.stats.batches += 1
+                self.stats.prompt_tokens += sum(batch_lengths)
+                self.stats.padded_tokens += max(batch_lengths) * len(batch)
+
+                while next_out in done:
+                    yield done.pop(next_out)
+                    next_out += 1
+
+            self.stats.notes += len(prompts)
+            base += len(prompts)
+
+    def extract_one(self, note: str) -> ExtractionResult:
+        return next(self.extract([note]))
+
+    def extract_patients(self, patients: Iterable[Dict[str, Any]]) -> Iterator[Dict[str, Any]]:
+        """
+        Enrich patient scenarios the way 03_batch_inference does: original
+        fields plus an ai_analysis block with the parsed fields, _raw_output
+        and _fields_present (and _field_logprobs with params.logprobs).
+        """
+        pending: deque = deque()
+
+        def notes():
+            for p in patients:
+                pending.append(p)
+                yield p['clinical_note']['text']  # clinical_note is a dict
+
+        # Results come back in input order, so the oldest pending patient
+        # is always the one just finished
+        for result in self.extract(notes()):
+            yield {
+                **pending.popleft(),
+                'ai_analysis': {
+                    **result.fields,
+                    '_raw_output': result.raw,
+                    '_fields_present': result.fields_present,
+                    **({'_field_logprobs': result.field_logprobs}
+                       if result.field_logprobs is not None else {}),
+                }
+            }
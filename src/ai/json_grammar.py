@@ -0,0 +1,538 @@
+"""
+Grammar-Constrained JSON Decoding
+Character-level automaton for the extraction JSON schema and a logits
+processor that masks every token which would take the output off-grammar,
+so a json_mode generation always parses on the first try.
+
+The schema mirrors REQUIRED_OUTPUT_FIELDS in scripts/data_pipeline.py: keys
+in a fixed order, urgency as an enum, list and string lengths bounded.
+Given max_new_tokens, the processor also keeps each row able to close its
+object in the tokens left, and forces the shortest closing when it must;
+values that closing had to invent are FILLER, which parse_json_fields
+reports as missing.
+"""
+
+import json
+import re
+from bisect import bisect_left, bisect_right
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+# Placeholder for a required value the output ran out of tokens for
+FILLER = '-'
+
+
+# ── Schema segments
+
+class Literal:
+    """Fixed text the model has no choice over (keys, separators, braces)."""
+
+    def __init__(self, text: str):
+        self.text = text
+
+    def start(self):
+        return 0
+
+    def step(self, state: int, ch: str) -> Optional[int]:
+        return state + 1 if state < len(self.text) and self.text[state] == ch else None
+
+    def done(self, state: int) -> bool:
+        return state == len(self.text)
+
+    def closing(self, state: int) -> str:
+        return self.text[state:]
+
+    def forced(self, state: int) -> Optional[List[str]]:
+        return [self.text[state:]]
+
+
+_ESCAPES = set('"\\/bfnrt')
+
+
+class String:
+    """JSON string of 1..max_len characters (no \\u escapes, no raw control chars)."""
+
+    def __init__(self, max_len: int):
+        self.max_len = max_len
+
+    # state: (phase, length) with phase 0 = before quote, 1 = inside,
+    # 2 = after backslash, 3 = closed
+    def start(self):
+        return (0, 0)
+
+    def step(self, state, ch: str):
+        phase, n = state
+        if phase == 0:
+            return (1, 0) if ch == '"' else None
+        if phase == 1:
+            if ch == '"':
+                return (3, n) if n > 0 else None
+            if n >= self.max_len or ch < ' ':
+                return None
+            return (2, n) if ch == '\\' else (1, n + 1)
+        if phase == 2:
+            return (1, n + 1) if ch in _ESCAPES else None
+        return None
+
+    def done(self, state) -> bool:
+        return state[0] == 3
+
+    def closing(self, state) -> str:
+        """Shortest text that closes the string from state."""
+        phase, n = state
+        if phase == 0:
+            return f'"{FILLER}"'
+        if phase == 1:
+            return '"' if n else f'{FILLER}"'
+        if phase == 2:
+            return '/"'      # finish the escape as \/
+        return ''
+
+    def forced(self, state) -> Optional[List[str]]:
+        """Texts one of which must come next from state; None inside the string."""
+        return ['"'] if state[0] == 0 else None
+
+
+class Enum:
+    """One of a fixed set of JSON strings; `default` is what a forced closing picks."""
+
+    def __init__(self, options: Sequence[str], default: Optional[str] = None):
+        self.options = tuple(options)
+        self.default = default or self.options[0]
+
+    # state: None before the opening quote, text typed so far, or (text,) when closed
+    def start(self):
+        return None
+
+    def step(self, state, ch: str):
+        if state is None:
+            return '' if ch == '"' else None
+        if isinstance(state, tuple):
+            return None
+        if ch == '"':
+            return (state,) if state in self.options else None
+        typed = state + ch
+        return typed if any(o.startswith(typed) for o in self.options) else None
+
+    def done(self, state) -> bool:
+        return isinstance(state, tuple)
+
+    def closing(self, state) -> str:
+        if state is None:
+            return json.dumps(self.default)
+        if isinstance(state, tuple):
+            return ''
+        option = self.default if self.default.startswith(state) else \
+            next(o for o in self.options if o.startswith(state))
+        return option[len(state):] + '"'
+
+    def forced(self, state) -> Optional[List[str]]:
+        if state is None:
+            return [json.dumps(o) for o in self.options]
+        if isinstance(state, tuple):
+            return None
+        return [o[len(state):] + '"' for o in self.options if o.startswith(state)]
+
+
+class StringList:
+    """JSON array of min_items..max_items Strings, separated by ', '."""
+
+    def __init__(self, min_items: int, max_items: int, item_len: int):
+        self.min_items = min_items
+        self.max_items = max_items
+        self.item = String(item_len)
+
+    # state: (phase, count, item_state) with phase 0 = before '[', 1 = in item,
+    # 2 = after item, 3 = after ',', 4 = closed
+    def start(self):
+        return (0, 0, None)
+
+    def step(self, state, ch: str):
+        phase, count, item = state
+        if phase == 0:
+            if ch != '[':
+                return None
+            return (1, 0, self.item.start()) if self.min_items > 0 else (5, 0, None)
+        if phase == 5:  # just opened an array that may stay empty
+            if ch == ']':
+                return (4, 0, None)
+            return self.step((1, 0, self.item.start()), ch)
+        if phase == 1:
+            item = self.item.step(item, ch)
+            if item is None:
+                return None
+            return (2, count + 1, None) if self.item.done(item) else (1, count, item)
+        if phase == 2:
+            if ch == ']' and count >= self.min_items:
+                return (4, count, None)
+            if ch == ',' and count < self.max_items:
+                return (3, count, None)
+            return None
+        if phase == 3:
+            return (1, count, self.item.start()) if ch == ' ' else None
+        return None
+
+    def done(self, state) -> bool:
+        return state[0] == 4
+
+    def closing(self, state) -> str:
+        """Shortest text that closes the array: pad to min_items with FILLER items."""
+        phase, count, item = state
+        filler = self.item.closing(self.item.start())
+        if phase == 0:
+            return '[' + ', '.join([filler] * self.min_items) + ']'
+        if phase == 5:
+            return ']'
+        if phase == 4:
+            return ''
+        if phase == 1:
+            text, count = self.item.closing(item), count + 1
+        elif phase == 3:
+            text, count = ' ' + filler, count + 1
+        else:
+            text = ''
+        return text + f', {filler}' * max(0, self.min_items - count) + ']'
+
+    def forced(self, state) -> Optional[List[str]]:
+        phase, count, item = state
+        if phase == 0:
+            return ['[']
+        if phase == 5:
+            return [']', '"']
+        if phase == 1:
+            return self.item.forced(item)
+        if phase == 2:
+            return ([']'] if count >= self.min_items else []) + \
+                ([', '] if count < self.max_items else [])
+        if phase == 3:
+            return [' ']
+        return None
+
+
+class ObjectSchema:
+    """
+    Fixed-order JSON object as a chain of segments. Machine state is
+    (segment index, segment state); advance() is pure, so states can be
+    probed per candidate token without copying anything.
+    """
+
+    def __init__(self, fields: Sequence[Tuple[str, Any]]):
+        self.keys = [k for k, _ in fields]
+        segments: List[Any] = []
+        for i, (key, value) in enumerate(fields):
+            segments.append(Literal(('{' if i == 0 else ', ') + json.dumps(key) + ': '))
+            segments.append(value)
+        segments.append(Literal('}'))
+        self.segments = segments
+
+    def start(self):
+        return (0, self.segments[0].start())
+
+    def advance(self, state, text: str):
+        """State after consuming text, or None if text leaves the grammar."""
+        idx, sub = state
+        for ch in text:
+            if idx >= len(self.segments):
+                return None
+            seg = self.segments[idx]
+            sub = seg.step(sub, ch)
+            if sub is None:
+                return None
+            if seg.done(sub):
+                idx += 1
+                sub = self.segments[idx].start() if idx < len(self.segments) else None
+        return (idx, sub)
+
+    def complete(self, state) -> bool:
+        return state[0] >= len(self.segments)
+
+    def closing(self, state) -> str:
+        """Shortest text that completes the object from state."""
+        idx, sub = state
+        if idx >= len(self.segments):
+            return ''
+        return self.segments[idx].closing(sub) + ''.join(
+            seg.closing(seg.start()) for seg in self.segments[idx + 1:])
+
+    def forced(self, state) -> Optional[List[str]]:
+        """
+        Texts one of which the output must continue with from state (keys,
+        separators, enum options), or None where free string text may follow.
+        """
+        idx, sub = state
+        if idx >= len(self.segments):
+            return None
+        return self.segments[idx].forced(sub)
+
+
+# Keys and bounds follow scripts/data_pipeline.py (REQUIRED_OUTPUT_FIELDS,
+# lenient QA profile). The worst case (~2.2k characters) can exceed
+# max_new_tokens; JSONConstraintProcessor closes the object in time.
+EXTRACTION_SCHEMA = ObjectSchema([
+    ('primary_hypothesis',     String(120)),
+    ('differential_diagnoses', StringList(1, 5, 80)),
+    ('key_symptoms',           StringList(2, 6, 80)),
+    ('urgency',                Enum(('high', 'medium', 'low'), default='medium')),
+    ('tests_ordered',          StringList(1, 6, 80)),
+    ('reasoning',              String(600)),
+])
+
+# JSON keys -> extractor field names (parse_fields output)
+JSON_FIELD_MAP = {
+    'primary_hypothesis': 'primary_hypothesis',
+    'differential_diagnoses': 'differential_diagnoses',
+    'key_symptoms': 'key_supporting_evidence',
+    'urgency': 'urgency_level',
+    'tests_ordered': 'tests_ordered',
+    'reasoning': 'clinical_reasoning',
+}
+
+
+_JSON_KEY_RE = re.compile('"(' + '|'.join(JSON_FIELD_MAP) + ')":')
+
+
+def json_prompt_tail() -> str:
+    """Instruction that follows the note in a json_mode extraction prompt."""
+    return (
+        'Output ONLY a JSON object with these keys, in this order:\n'
+        '"primary_hypothesis" (string), "differential_diagnoses" (list of strings), '
+        '"key_symptoms" (list of strings), "urgency" ("high", "medium" or "low"), '
+        '"tests_ordered" (list of strings), "reasoning" (string)'
+    )
+
+
+def _salvage(text: str) -> Dict[str, Any]:
+    """Values that are complete in a JSON object cut off part-way."""
+    decoder = json.JSONDecoder()
+    obj = {}
+    for m in _JSON_KEY_RE.finditer(text):
+        start = m.end()
+        while start < len(text) and text[start].isspace():
+            start += 1
+        try:
+            obj[m.group(1)] = decoder.raw_decode(text, start)[0]
+        except ValueError:
+            break
+    return obj
+
+
+def parse_json_fields(text: str) -> Optional[Dict[str, str]]:
+    """
+    Extractor fields from json_mode output, lists joined with ', ' so the
+    result has the same shape as parse_fields. A truncated object keeps its
+    complete values. FILLER values are missing (''), and so is urgency when
+    every field after it is FILLER: a closing forced that early may have
+    picked it. None if text is not a JSON object at all.
+    """
+    try:
+        obj = json.loads(text)
+        complete = True     # only a complete object can end in a forced closing
+    except ValueError:
+        if not text.lstrip().startswith('{'):
+            return None
+        obj, complete = _salvage(text), False
+    if not isinstance(obj, dict):
+        return None
+
+    values = {}
+    for key in JSON_FIELD_MAP:
+        value = obj.get(key, '')
+        if isinstance(value, list):
+            value = [str(v) for v in value if v != FILLER]
+        values[key] = '' if value == FILLER else value
+    if complete and not values['tests_ordered'] and not values['reasoning']:
+        values['urgency'] = ''
+
+    return {name: ', '.join(values[key]) if isinstance(values[key], list) else str(values[key])
+            for key, name in JSON_FIELD_MAP.items()}
+
+
+def json_field_spans(text: str) -> Dict[str, Tuple[int, int]]:
+    """Character span of each value in json_mode output, keyed by extractor field name."""
+    keys = [(m.group(1), m.start(), m.end()) for m in _JSON_KEY_RE.finditer(text)]
+    spans: Dict[str, Tuple[int, int]] = {}
+    for pos, (key, _, start) in enumerate(keys):
+        end = keys[pos + 1][1] if pos + 1 < len(keys) else len(text)
+        spans.setdefault(JSON_FIELD_MAP[key], (start, end))
+    return spans
+
+
+# ── Token-level constraint
+
+def token_strings(tokenizer) -> List[Optional[str]]:
+    """
+    Surface text of every vocabulary entry, None for tokens that can never
+    be used inside the grammar (special tokens, partial UTF-8 bytes).
+    """
+    pieces = tokenizer.convert_ids_to_tokens(list(range(len(tokenizer))))
+    special = set(getattr(tokenizer, 'all_special_ids', []))
+    sentencepiece = any(p and '▁' in p for p in pieces[:5000])
+    strings: List[Optional[str]] = []
+    for i, piece in enumerate(pieces):
+        if piece is None or i in special:
+            strings.append(None)
+        elif sentencepiece:
+            if piece.startswith('<0x') and piece.endswith('>') and len(piece) == 6:
+                byte = int(piece[3:5], 16)
+                strings.append(chr(byte) if byte < 0x80 else None)
+            else:
+                strings.append(piece.replace('▁', ' '))
+        else:
+            strings.append(tokenizer.convert_tokens_to_string([piece]))
+    return strings
+
+
+class JSONConstraintProcessor:
+    """
+    transformers logits processor enforcing an ObjectSchema per row.
+
+    Where the schema forces the next text (keys, separators, enum options),
+    the legal tokens are looked up once per state by prefix in a sorted
+    vocabulary and kept in `legal` (share it across calls for the same
+    schema and vocabulary); elsewhere candidates are checked in score order,
+    and past the top 256 the first legal one ends the search. Only the best
+    `top_k` legal tokens survive (greedy decoding only ever needs the first).
+    Once a row's object is complete, only EOS is allowed. Pass in
+    generate(logits_processor=[...]); it must run after other processors,
+    which is where generate() puts user-supplied ones.
+
+    With max_new_tokens, a row near the end of its budget only takes tokens
+    that leave its closing (counted in characters, an upper bound on tokens)
+    within the steps left, and falls back to the closing itself, longest
+    vocabulary entry first, so the object is always complete in time.
+    """
+
+    # Steps left at which the closing length starts being checked; one token
+    # cannot lengthen the closing by more than this
+    CLOSING_WINDOW = 64
+
+    def __init__(self, tokenizer, prompt_length: int, batch_size: int,
+                 schema: ObjectSchema = EXTRACTION_SCHEMA, top_k: int = 8,
+                 strings: Optional[List[Optional[str]]] = None,
+                 max_new_tokens: Optional[int] = None,
+                 index: Optional[Dict[str, int]] = None,
+                 legal: Optional[Dict[Any, List[Tuple[int, Any]]]] = None):
+        self.schema = schema
+        self.top_k = top_k
+        self.strings = strings if strings is not None else token_strings(tokenizer)
+        self.eos_token_id = tokenizer.eos_token_id
+        self.states = [schema.start() for _ in range(batch_size)]
+        self.prompt_length = prompt_length
+        self.max_new_tokens = max_new_tokens
+        self._index = index
+        self._legal = legal if legal is not None else {}
+        self._table: Optional[Tuple[List[str], List[int]]] = None
+        self._seen = prompt_length
+
+    @staticmethod
+    def _candidates(row_scores, first: int = 256):
+        """Token ids by descending score; a full sort only if the top ones are all illegal."""
+        import torch
+
+        top = torch.topk(row_scores, min(first, row_scores.shape[-1])).indices.tolist()
+        yield from top
+        if len(top) < row_scores.shape[-1]:
+            yield from torch.argsort(row_scores, descending=True)[len(top):].tolist()
+
+    def _closing_token(self, closing: str) -> int:
+        """Vocabulary entry matching the longest prefix of closing."""
+        if self._index is None:
+            self._index = token_index(self.strings)
+        for n in range(len(closing), 0, -1):
+            token = self._index.get(closing[:n])
+            if token is not None:
+                return token
+        return self.eos_token_id
+
+    def _legal_tokens(self, state) -> Optional[List[Tuple[int, Any]]]:
+        """(token, next state) for every legal token where the next text is forced, else None."""
+        legal = self._legal.get(state)
+        if legal is not None:
+            return legal
+        forced = self.schema.forced(state)
+        if forced is None:
+            return None
+        if self._table is None:
+            self._table = token_table(self.strings)
+        texts, ids = self._table
+        found: Dict[int, Any] = {}
+        for text in forced:
+            # Tokens ending inside the forced text, then tokens running past it
+            spans = [(bisect_left(texts, text[:n]), bisect_right(texts, text[:n]))
+                     for n in range(1, len(text))]
+            spans.append((bisect_left(texts, text), bisect_left(texts, text + _LAST_CHAR)))
+            for lo, hi in spans:
+                for j in range(lo, hi):
+                    nxt = self.schema.advance(state, texts[j])
+                    if nxt is not None:
+                        found[ids[j]] = nxt
+        self._legal[state] = legal = sorted(found.items())
+        return legal
+
+    def __call__(self, input_ids, scores):
+        import torch
+
+        # Advance each row by the token chosen at the previous step
+        if input_ids.shape[1] > self._seen:
+            for row, token in enumerate(input_ids[:, -1].tolist()):
+                state = self.states[row]
+                if state is not None and not self.schema.complete(state):
+                    text = self.strings[token] if token < len(self.strings) else None
+                    self.states[row] = self.schema.advance(state, text) if text else None
+            self._seen = input_ids.shape[1]
+
+        # Steps left after this one
+        left = (self.max_new_tokens - (input_ids.shape[1] - self.prompt_length) - 1
+                if self.max_new_tokens else None)
+
+        mask = torch.full_like(scores, float('-inf'))
+        for row, state in enumerate(self.states):
+            if state is None or self.schema.complete(state):
+                mask[row, self.eos_token_id] = 0
+                continue
+            closing = self.schema.closing(state) if left is not None else ''
+            tight = left is not None and left < len(closing) + self.CLOSING_WINDOW
+            allowed = 0
+            legal = self._legal_tokens(state)
+            if legal is not None:
+                if tight:
+                    legal = [(t, nxt) for t, nxt in legal if len(self.schema.closing(nxt)) <= left]
+                if legal:
+                    ids = torch.tensor([t for t, _ in legal], device=scores.device)
+                    best = torch.topk(scores[row, ids], min(self.top_k, len(legal))).indices
+                    mask[row, ids[best]] = 0
+                    allowed = len(legal)
+            else:
+                for k, token in enumerate(self._candidates(scores[row])):
+                    if k >= 256 and (allowed or tight):
+                        break                # past the top ones: first legal will do, or close
+                    text = self.strings[token] if token < len(self.strings) else None
+                    nxt = self.schema.advance(state, text) if text else None
+                    if nxt is None or (tight and len(self.schema.closing(nxt)) > left):
+                        continue
+                    mask[row, token] = 0
+                    allowed += 1
+                    if allowed >= self.top_k:
+                        break
+            if not allowed:
+                # Out of budget, or (not for a well-formed vocab) out of legal tokens
+                mask[row, self._closing_token(closing) if closing else self.eos_token_id] = 0
+        return scores + mask
+
+
+def token_index(strings: List[Optional[str]]) -> Dict[str, int]:
+    """Surface text -> lowest token id with that text."""
+    index: Dict[str, int] = {}
+    for token, text in enumerate(strings):
+        if text:
+            index.setdefault(text, token)
+    return index
+
+
+# Sorts after any text, so text + _LAST_CHAR bounds every token starting with text
+_LAST_CHAR = chr(0x10FFFF)
+
+
+def token_table(strings: List[Optional[str]]) -> Tuple[List[str], List[int]]:
+    """Usable token texts in sorted order and their ids, for prefix lookups."""
+    table = sorted((text, token) for token, text in enumerate(strings) if text)
+    return [text for text, _ in table], [token for _, token in table]
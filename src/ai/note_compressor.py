@@ -0,0 +1,240 @@
+"""
+Note Compression
+Fits clinical notes into a per-agent token budget instead of cutting them at
+a fixed character count. Notes are segmented into SOAP sections (the headers
+evaluate_patient in scripts/data_pipeline.py looks for), split into sentence /
+line units and scored, ASSESSMENT and PLAN first; the best units that fit are
+kept in their original order under their section headers.
+
+    compressor = NoteCompressor(count_tokens=partial(backend.count_tokens, add_special_tokens=False))
+    short = compressor.compress(note_text, 'agent3')
+
+Notes that already fit are returned unchanged. Segmentation and scores are
+cached per note, and each (note, budget) result separately, so the extraction
+and agent passes over the same patient only analyze the note once.
+"""
+
+import hashlib
+import re
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Tuple, Union
+
+# Token budgets for the note text in each prompt. The old character cuts
+# (agent 3: 800, agent 4: 600) are about 200 / 150 tokens; extraction gets
+# what max_length=1024 leaves after the instruction text.
+BUDGETS = {
+    'extraction': 900,
+    'agent3': 200,
+    'agent4': 150,
+}
+
+SECTION_WEIGHTS = {
+    'ASSESSMENT': 3.0,
+    'PLAN': 2.5,
+    'SUBJECTIVE': 1.5,
+    'OBJECTIVE': 1.2,
+    'NOTE': 1.0,         # text before the first header
+}
+
+_SECTION_NAMES = {'S': 'SUBJECTIVE', 'O': 'OBJECTIVE', 'A': 'ASSESSMENT', 'P': 'PLAN', 'A/P': 'ASSESSMENT'}
+
+_HEADER_RE = re.compile(
+    r'^[ \t]*(SUBJECTIVE|OBJECTIVE|ASSESSMENT(?:\s*(?:AND|&|/)\s*PLAN)?|PLAN|A/P|[SOAP])[ \t]*:[ \t]*',
+    re.IGNORECASE | re.MULTILINE,
+)
+# Single-letter headers only count as a complete S, O, A, P (or S, O, A/P)
+# run; a lone 'P:' or 'A:' is usually a vital sign or a list item
+_SOAP_LETTERS = ['S', 'O', 'A', 'P']
+_SENTENCE_RE = re.compile(r'(?<=[.!?])\s+(?=[A-Z0-9(])')
+
+# Diagnostic reasoning, orders and abnormal findings are what the agents check
+_CUE_RE = re.compile(
+    r'\b(differential|rule out|r/o|concern|suspect|likely|consistent with|worrisome|'
+    r'ordered|pending|refer\w*|follow[- ]?up|urgent|abnormal|elevated|decreased|'
+    r'mass|lesion|positive|enlarg\w*|worsening|progressive|history of)\b',
+    re.IGNORECASE,
+)
+_NEGATIVE_RE = re.compile(r'^\s*(denies|no |negative for|without )', re.IGNORECASE)
+_NUMBER_RE = re.compile(r'\d')
+
+
+def approx_tokens(texts: List[str]) -> List[int]:
+    """~4 characters per token; used when no tokenizer is supplied."""
+    return [max(1, (len(t) + 3) // 4) for t in texts]
+
+
+@dataclass
+class Unit:
+    """One sentence or line of a note."""
+    section: int       # index into the note's section list
+    text: str
+    sep: str           # whitespace that followed it in the note (' ' or '\n')
+    score: float
+    tokens: int
+
+
+@dataclass
+class NoteAnalysis:
+    sections: List[Tuple[str, str]]    # (canonical name, header text as written)
+    units: List[Unit]
+    header_tokens: List[int]
+    total_tokens: int
+
+
+@dataclass
+class CompressorStats:
+    notes: int = 0
+    compressed: int = 0        # notes that did not fit their budget
+    tokens_in: int = 0
+    tokens_out: int = 0
+    analysis_hits: int = 0
+    result_hits: int = 0
+
+
+def segment_note(text: str) -> List[Tuple[str, str, str]]:
+    """(section name, header as written, body) in note order."""
+    matches = list(_HEADER_RE.finditer(text))
+    labels = [m.group(1).upper() for m in matches]
+    letters = [label for label in labels if len(label) == 1]
+    if letters != _SOAP_LETTERS and not (letters == _SOAP_LETTERS[:2] and 'A/P' in labels):
+        matches = [m for m in matches if len(m.group(1)) > 1]
+    sections = []
+    if not matches or text[:matches[0].start()].strip():
+        end = matches[0].start() if matches else len(text)
+        sections.append(('NOTE', '', text[:end]))
+    for i, m in enumerate(matches):
+        label = re.sub(r'\s+', ' ', m.group(1).upper())
+        name = _SECTION_NAMES.get(label) or re.match(r'[A-Z]+', label).group()
+        end = matches[i + 1].start() if i + 1 < len(matches) else len(text)
+        sections.append((name, m.group(0).strip(), text[m.end():end]))
+    return sections
+
+
+def split_units(body: str) -> List[Tuple[str, str]]:
+    """(unit text, trailing separator): lines, then sentences within a line."""
+    units = []
+    for line in body.split('\n'):
+        parts = [p.strip() for p in _SENTENCE_RE.split(line) if p.strip()]
+        for j, part in enumerate(parts):
+            units.append((part, '\n' if j == len(parts) - 1 else ' '))
+    return units
+
+
+def score_unit(section: str, text: str, position: int) -> float:
+    score = SECTION_WEIGHTS.get(section, 1.0)
+    score += 0.5 * min(3, len(_CUE_RE.findall(text)))
+    if section == 'OBJECTIVE' and _NUMBER_RE.search(text):
+        score += 0.5                         # vitals and lab values
+    if position == 0:
+        score += 1.0                         # chief complaint / headline assessment
+    if _NEGATIVE_RE.match(text):
+        score *= 0.6                         # pertinent negatives, kept only if room
+    if text.endswith(':'):
+        score *= 0.3                         # sub-heading; useless without its lines
+    return score
+
+
+class NoteCompressor:
+    """
+    Budgeted, section-aware note compression with a bounded LRU cache.
+
+    count_tokens takes a list of strings (ExtractionBackend.count_tokens has
+    this signature); the default is a 4-characters-per-token estimate. Units
+    are spliced into a prompt, so they must be counted without special
+    tokens: pass partial(backend.count_tokens, add_special_tokens=False),
+    or each unit costs one BOS more than it does.
+    """
+
+    def __init__(self, count_tokens: Optional[Callable[[List[str]], List[int]]] = None,
+                 budgets: Optional[Dict[str, int]] = None, cache_size: int = 4096):
+        self.count_tokens = count_tokens or approx_tokens
+        self.budgets = {**BUDGETS, **(budgets or {})}
+        self.cache_size = cache_size
+        self._analyses: 'OrderedDict[str, NoteAnalysis]' = OrderedDict()
+        self._results: 'OrderedDict[Tuple[str, int], Tuple[str, int, int]]' = OrderedDict()
+        self.stats = CompressorStats()
+
+    def _cached(self, cache: OrderedDict, key):
+        value = cache.get(key)
+        if value is not None:
+            cache.move_to_end(key)
+        return value
+
+    def _store(self, cache: OrderedDict, key, value):
+        cache[key] = value
+        if len(cache) > self.cache_size:
+            cache.popitem(last=False)
+
+    def analyze(self, text: str, key: Optional[str] = None) -> NoteAnalysis:
+        key = key or hashlib.sha1(text.encode('utf-8')).hexdigest()
+        analysis = self._cached(self._analyses, key)
+        if analysis is not None:
+            self.stats.analysis_hits += 1
+            return analysis
+
+        sections, raw_units = [], []
+        for s, (name, header, body) in enumerate(segment_note(text)):
+            sections.append((name, header))
+            for position, (unit, sep) in enumerate(split_units(body)):
+                raw_units.append((s, unit, sep, score_unit(name, unit, position)))
+
+        # One count_tokens call per note: units, then headers, then the whole text
+        counts = self.count_tokens([u[1] for u in raw_units] + [h for _, h in sections] + [text])
+        units = [Unit(s, t, sep, score, n) for (s, t, sep, score), n in zip(raw_units, counts)]
+        header_tokens = [n if header else 0 for n, (_, header) in zip(counts[len(units):-1], sections)]
+        analysis = NoteAnalysis(sections, units, header_tokens, counts[-1])
+        self._store(self._analyses, key, analysis)
+        return analysis
+
+    def compress(self, text: str, budget: Union[int, str]) -> str:
+        """text packed into budget tokens (an int or a BUDGETS key)."""
+        if isinstance(budget, str):
+            budget = self.budgets[budget]
+        key = hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+        entry = self._cached(self._results, (key, budget))
+        if entry is not None:
+            self.stats.result_hits += 1
+        else:
+            entry = self._pack(text, self.analyze(text, key), budget)
+            self._store(self._results, (key, budget), entry)
+
+        result, tokens_in, tokens_out = entry
+        self.stats.notes += 1
+        self.stats.compressed += tokens_out < tokens_in
+        self.stats.tokens_in += tokens_in
+        self.stats.tokens_out += tokens_out
+        return result
+
+    def _pack(self, text: str, analysis: NoteAnalysis, budget: int) -> Tuple[str, int, int]:
+        """(compressed text, tokens before, tokens after)."""
+        total = analysis.total_tokens
+        if total <= budget:
+            return text, total, total
+
+        # Greedy by score (shorter first on ties), skipping units that no longer
+        # fit; opening a section also pays for its header
+        order = sorted(range(len(analysis.units)),
+                       key=lambda i: (-analysis.units[i].score, analysis.units[i].tokens))
+        chosen, opened, used = set(), set(), 0
+        for i in order:
+            unit = analysis.units[i]
+            cost = unit.tokens + (0 if unit.section in opened else analysis.header_tokens[unit.section])
+            if used + cost <= budget:
+                chosen.add(i)
+                opened.add(unit.section)
+                used += cost
+
+        if not chosen:
+            # Nothing fits whole: cut the best unit by characters (~4 per token)
+            best = analysis.units[order[0]].text if order else text
+            return best[:budget * 4], total, budget
+
+        blocks = []
+        for s, (name, header) in enumerate(analysis.sections):
+            body = ''.join(u.text + u.sep for i, u in enumerate(analysis.units)
+                           if u.section == s and i in chosen).strip()
+            if body:
+                blocks.append(f'{header} {body}' if header else body)
+        return '\n\n'.join(blocks), total, used
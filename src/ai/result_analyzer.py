@@ -0,0 +1,442 @@
+"""
+Result Analysis Agents
+Agent 3 (quality review) and Agent 4 (confidence scoring) from
+05_agentic_pipeline, batched through an ExtractionBackend. Each agent's fixed
+instruction block is passed as the prompt prefix, so backends that support it
+(TransformersBackend) prefill it once per model and reuse its KV cache.
+
+fused_review() runs both agents from one prompt and one decode (AGENT34_PROMPT),
+so the note and the extraction are prefilled once per patient instead of
+twice; merge_review() writes either form into ai_analysis the way CELL 8 does.
+
+cascade_score() replaces Agent 4 for extractions whose own token
+log-probabilities (HypothesisExtractor with params.logprobs) already give a
+clearly low calibrated confidence (flagged either way), and calls the LLM
+for the rest.
+
+Notes are cut at 800 / 600 characters as in the notebook unless a
+NoteCompressor is given, which packs the most useful sentences (assessment
+and plan first) into the agent's token budget instead.
+"""
+
+import json
+import math
+import re
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Union
+
+from .hypothesis_extractor import ExtractionBackend, GenerationParams, decode_output
+from .note_compressor import NoteCompressor
+
+AGENT3_PROMPT = """You are a medical quality reviewer checking an AI-generated diagnostic extraction.
+
+Review this extraction against the original clinical note and check:
+1. Does the urgency level match the clinical severity?
+2. Does the reasoning logically follow from the key evidence?
+3. Are the differential diagnoses clinically plausible?
+4. Is the primary hypothesis consistent with the presented symptoms?
+
+Clinical Note:
+{note}
+
+AI Extraction:
+PRIMARY HYPOTHESIS: {primary_hypothesis}
+DIFFERENTIAL DIAGNOSES: {differential_diagnoses}
+KEY SUPPORTING EVIDENCE: {key_supporting_evidence}
+URGENCY LEVEL: {urgency_level}
+TESTS ORDERED: {tests_ordered}
+CLINICAL REASONING: {clinical_reasoning}
+
+Output exactly one of:
+PASS
+FAIL: [specific issue found]"""
+
+AGENT4_PROMPT = """You are assessing diagnostic confidence for an AI-generated clinical extraction.
+
+Rate the confidence that the primary hypothesis is correct, and flag if review is needed.
+Flag if: atypical presentation, conflicting findings, rare diagnosis, or critical urgency mismatch.
+
+Clinical Note (summary):
+{note}
+
+AI Extraction:
+PRIMARY HYPOTHESIS: {primary_hypothesis}
+URGENCY LEVEL: {urgency_level}
+KEY SUPPORTING EVIDENCE: {key_supporting_evidence}
+CLINICAL REASONING: {clinical_reasoning}
+
+Output exactly:
+CONFIDENCE: [1-10]
+FLAG: [yes/no]
+REASON: [one sentence if flagged, none if not]"""
+
+AGENT34_PROMPT = """You are a medical quality reviewer checking an AI-generated diagnostic extraction.
+
+Review this extraction against the original clinical note and check:
+1. Does the urgency level match the clinical severity?
+2. Does the reasoning logically follow from the key evidence?
+3. Are the differential diagnoses clinically plausible?
+4. Is the primary hypothesis consistent with the presented symptoms?
+
+Then rate the confidence that the primary hypothesis is correct, and flag if review is needed.
+Flag if: atypical presentation, conflicting findings, rare diagnosis, or critical urgency mismatch.
+
+Clinical Note:
+{note}
+
+AI Extraction:
+PRIMARY HYPOTHESIS: {primary_hypothesis}
+DIFFERENTIAL DIAGNOSES: {differential_diagnoses}
+KEY SUPPORTING EVIDENCE: {key_supporting_evidence}
+URGENCY LEVEL: {urgency_level}
+TESTS ORDERED: {tests_ordered}
+CLINICAL REASONING: {clinical_reasoning}
+
+Output exactly:
+QUALITY: [PASS, or FAIL: specific issue found]
+CONFIDENCE: [1-10]
+FLAG: [yes/no]
+REASON: [one sentence if flagged, none if not]"""
+
+CHAT_USER = '<start_of_turn>user\n'
+CHAT_MODEL = '<end_of_turn>\n<start_of_turn>model\n'
+
+# Everything before {note} is the same for every patient
+AGENT3_PREFIX = CHAT_USER + AGENT3_PROMPT[:AGENT3_PROMPT.index('{note}')]
+AGENT4_PREFIX = CHAT_USER + AGENT4_PROMPT[:AGENT4_PROMPT.index('{note}')]
+AGENT34_PREFIX = CHAT_USER + AGENT34_PROMPT[:AGENT34_PROMPT.index('{note}')]
+
+AGENT3_PARAMS = GenerationParams(max_length=1536, max_new_tokens=80, early_stop=False)
+AGENT4_PARAMS = GenerationParams(max_length=1536, max_new_tokens=60, early_stop=False)
+# QUALITY line (up to a FAIL reason) plus the Agent 4 block
+AGENT34_PARAMS = GenerationParams(max_length=1536, max_new_tokens=110, early_stop=False)
+
+DEFAULT_CONFIDENCE = 7
+
+
+def agent3_prompt(note_text: str, ai: Dict[str, Any],
+                  compressor: Optional[NoteCompressor] = None) -> str:
+    prompt_text = AGENT3_PROMPT.format(
+        note=compressor.compress(note_text, 'agent3') if compressor else note_text[:800],
+        primary_hypothesis=ai.get('primary_hypothesis', ''),
+        differential_diagnoses=ai.get('differential_diagnoses', ''),
+        key_supporting_evidence=ai.get('key_supporting_evidence', ''),
+        urgency_level=ai.get('urgency_level', ''),
+        tests_ordered=ai.get('tests_ordered', ''),
+        clinical_reasoning=ai.get('clinical_reasoning', ''),
+    )
+    return f'{CHAT_USER}{prompt_text}{CHAT_MODEL}'
+
+
+def agent4_prompt(note_text: str, ai: Dict[str, Any],
+                  compressor: Optional[NoteCompressor] = None) -> str:
+    prompt_text = AGENT4_PROMPT.format(
+        note=compressor.compress(note_text, 'agent4') if compressor else note_text[:600],
+        primary_hypothesis=ai.get('primary_hypothesis', ''),
+        urgency_level=ai.get('urgency_level', ''),
+        key_supporting_evidence=ai.get('key_supporting_evidence', '')[:200],
+        clinical_reasoning=ai.get('clinical_reasoning', '')[:200],
+    )
+    return f'{CHAT_USER}{prompt_text}{CHAT_MODEL}'
+
+
+def agent34_prompt(note_text: str, ai: Dict[str, Any],
+                   compressor: Optional[NoteCompressor] = None) -> str:
+    prompt_text = AGENT34_PROMPT.format(
+        note=compressor.compress(note_text, 'agent3') if compressor else note_text[:800],
+        primary_hypothesis=ai.get('primary_hypothesis', ''),
+        differential_diagnoses=ai.get('differential_diagnoses', ''),
+        key_supporting_evidence=ai.get('key_supporting_evidence', ''),
+        urgency_level=ai.get('urgency_level', ''),
+        tests_ordered=ai.get('tests_ordered', ''),
+        clinical_reasoning=ai.get('clinical_reasoning', ''),
+    )
+    return f'{CHAT_USER}{prompt_text}{CHAT_MODEL}'
+
+
+def parse_agent3(generated: str) -> Dict[str, Any]:
+    """PASS / FAIL: reason. Ambiguous output counts as a pass."""
+    gen_upper = generated.strip().upper()
+    if gen_upper.startswith('PASS'):
+        return {'passed': True, 'issue': None, 'raw': generated}
+    if 'FAIL' in gen_upper:
+        m = re.search(r'FAIL[:\s]+(.+)', generated, re.IGNORECASE | re.DOTALL)
+        issue = m.group(1).strip()[:200] if m else 'Quality check failed'
+        return {'passed': False, 'issue': issue, 'raw': generated}
+    return {'passed': True, 'issue': None, 'raw': generated}
+
+
+def parse_agent4(generated: str) -> Dict[str, Any]:
+    """CONFIDENCE (1-10, default 7) / FLAG yes|no / REASON."""
+    confidence = DEFAULT_CONFIDENCE
+    flagged = False
+    reason = 'none'
+
+    m_conf = re.search(r'CONFIDENCE[:\s]+([0-9]+(?:\.[0-9]+)?)', generated, re.IGNORECASE)
+    if m_conf:
+        confidence = min(10, max(1, int(float(m_conf.group(1)))))
+
+    m_flag = re.search(r'FLAG[:\s]+(yes|no)', generated, re.IGNORECASE)
+    if m_flag:
+        flagged = m_flag.group(1).lower() == 'yes'
+
+    m_reason = re.search(r'REASON[:\s]+(.+)', generated, re.IGNORECASE | re.DOTALL)
+    if m_reason:
+        reason_text = m_reason.group(1).strip()[:200]
+        reason = reason_text if reason_text.lower() != 'none' else 'none'
+
+    return {'confidence': confidence, 'flagged': flagged, 'reason': reason, 'raw': generated}
+
+
+# Labelled at line start only, so 'poor quality of ...' in a verdict is not a label
+_QUALITY_RE = re.compile(r'^\s*QUALITY\s*:\s*(.*?)(?=^\s*CONFIDENCE\b|\Z)',
+                         re.IGNORECASE | re.DOTALL | re.MULTILINE)
+_CONFIDENCE_LINE_RE = re.compile(r'^\s*CONFIDENCE\b', re.IGNORECASE | re.MULTILINE)
+
+
+def parse_agent34(generated: str) -> Dict[str, Any]:
+    """
+    Fused QUALITY / CONFIDENCE / FLAG / REASON output: the QUALITY part goes
+    through parse_agent3 and the rest through parse_agent4, so defaults and
+    edge cases match the separate agents. The result has both agents' keys
+    (passed, issue, confidence, flagged, reason) and can stand in for either.
+    """
+    text = generated.replace('**', '')
+    m = _QUALITY_RE.search(text)
+    if m:
+        quality, rest = m.group(1), text[m.end():]
+    else:  # label omitted: everything before the CONFIDENCE line is the verdict
+        c = _CONFIDENCE_LINE_RE.search(text)
+        quality, rest = (text[:c.start()], text[c.start():]) if c else (text, '')
+    a3 = parse_agent3(quality)
+    a4 = parse_agent4(rest)
+    return {
+        'passed': a3['passed'],
+        'issue': a3['issue'],
+        'confidence': a4['confidence'],
+        'flagged': a4['flagged'],
+        'reason': a4['reason'],
+        'raw': generated,
+    }
+
+
+def merge_review(ai: Dict[str, Any], a3: Dict[str, Any], a4: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Agent 3 / 4 verdicts into ai_analysis, as CELL 8 of 05_agentic_pipeline
+    writes them. For a fused review pass the same dict as a3 and a4.
+    """
+    ai['agent_quality'] = {
+        'passed': a3['passed'],
+        'issue': a3['issue'],
+    }
+    ai['agent_confidence'] = a4['confidence']
+    ai['agent_flagged'] = a4['flagged']
+    ai['agent_flag_reason'] = a4['reason']
+    return ai
+
+
+# Prefix -> parser of raw agent output; _run_agent uses it, and CachedBackend
+# stores and returns the parsed verdicts under the same prefix
+AGENT_PARSERS = {
+    AGENT3_PREFIX: lambda raw, params: parse_agent3(decode_output(raw)),
+    AGENT4_PREFIX: lambda raw, params: parse_agent4(decode_output(raw)),
+    AGENT34_PREFIX: lambda raw, params: parse_agent34(decode_output(raw)),
+}
+
+
+def _run_agent(backend: ExtractionBackend, prompts: List[str], params: GenerationParams,
+               prefix: str, batch_size: int) -> List[Dict[str, Any]]:
+    """Parsed verdicts (AGENT_PARSERS[prefix]), in order; cached backends return stored ones."""
+    parse = AGENT_PARSERS[prefix]
+    outputs: List[Dict[str, Any]] = []
+    for start in range(0, len(prompts), batch_size):
+        batch = prompts[start:start + batch_size]
+        outputs.extend(parsed for _, parsed in backend.generate_parsed(batch, params, parse, prefix=prefix))
+    return outputs
+
+
+def agent3_review(backend: ExtractionBackend, items: Sequence[Tuple[str, Dict[str, Any]]],
+                  batch_size: int = 8, compressor: Optional[NoteCompressor] = None) -> List[Dict[str, Any]]:
+    """Agent 3 over (note_text, ai_analysis) pairs, in order."""
+    prompts = [agent3_prompt(note, ai, compressor) for note, ai in items]
+    return _run_agent(backend, prompts, AGENT3_PARAMS, AGENT3_PREFIX, batch_size)
+
+
+def agent4_score(backend: ExtractionBackend, items: Sequence[Tuple[str, Dict[str, Any]]],
+                 batch_size: int = 8, compressor: Optional[NoteCompressor] = None) -> List[Dict[str, Any]]:
+    """Agent 4 over (note_text, ai_analysis) pairs, in order."""
+    prompts = [agent4_prompt(note, ai, compressor) for note, ai in items]
+    return _run_agent(backend, prompts, AGENT4_PARAMS, AGENT4_PREFIX, batch_size)
+
+
+def fused_review(backend: ExtractionBackend, items: Sequence[Tuple[str, Dict[str, Any]]],
+                 batch_size: int = 8, compressor: Optional[NoteCompressor] = None) -> List[Dict[str, Any]]:
+    """Agents 3 and 4 in one generation per (note_text, ai_analysis) pair, in order."""
+    prompts = [agent34_prompt(note, ai, compressor) for note, ai in items]
+    return _run_agent(backend, prompts, AGENT34_PARAMS, AGENT34_PREFIX, batch_size)
+
+
+def review_flag(a1: Dict[str, Any], a3: Dict[str, Any], a4: Dict[str, Any]) -> bool:
+    """CELL 8's master flag: any agent raised a concern."""
+    return (
+        not a1['passed'] or
+        not a3['passed'] or
+        a4['flagged'] or
+        a4['confidence'] <= 5
+    )
+
+
+# ── Logprob cascade
+
+CALIBRATION_FEATURES = ('ph_mean_logprob', 'ph_min_logprob', 'ph_mean_entropy', 'mean_logprob')
+
+
+def logprob_features(field_logprobs: Optional[Dict[str, Dict[str, float]]]) -> Optional[List[float]]:
+    """
+    CALIBRATION_FEATURES from an extraction's _field_logprobs: the primary
+    hypothesis's own stats plus the token-weighted mean over all fields.
+    None without primary hypothesis stats.
+    """
+    if not field_logprobs or not field_logprobs.get('primary_hypothesis'):
+        return None
+    ph = field_logprobs['primary_hypothesis']
+    tokens = sum(f['tokens'] for f in field_logprobs.values())
+    overall = sum(f['mean_logprob'] * f['tokens'] for f in field_logprobs.values()) / tokens
+    return [ph['mean_logprob'], ph['min_logprob'], ph['mean_entropy'], overall]
+
+
+class LogprobCalibrator:
+    """
+    Logistic model of P(primary hypothesis correct) from logprob_features,
+    reported on Agent 4's 1-10 scale. The default weights are a hand-set
+    starting point; fit() them on extractions with known correctness
+    (e.g. HypothesisEvaluator results) before trusting the cascade.
+    """
+
+    DEFAULT_WEIGHTS = (2.0, 0.3, -0.8, 1.5)
+    DEFAULT_BIAS = 2.0
+
+    def __init__(self, weights: Optional[Sequence[float]] = None, bias: Optional[float] = None):
+        self.weights = list(weights if weights is not None else self.DEFAULT_WEIGHTS)
+        self.bias = self.DEFAULT_BIAS if bias is None else bias
+
+    def probability(self, features: Sequence[float]) -> float:
+        z = self.bias + sum(w * x for w, x in zip(self.weights, features))
+        return 1 / (1 + math.exp(-max(-50.0, min(50.0, z))))
+
+    def confidence(self, field_logprobs: Optional[Dict[str, Dict[str, float]]]) -> Optional[int]:
+        """1-10, or None when the extraction has no logprob stats."""
+        features = logprob_features(field_logprobs)
+        if features is None:
+            return None
+        return 1 + int(round(9 * self.probability(features)))
+
+    def fit(self, field_logprobs: Sequence[Dict[str, Dict[str, float]]], correct: Sequence[bool],
+            l2: float = 1.0, iterations: int = 25) -> 'LogprobCalibrator':
+        """L2-regularized logistic regression by Newton's method."""
+        import numpy as np
+
+        rows = [(logprob_features(f), y) for f, y in zip(field_logprobs, correct)]
+        rows = [(x, y) for x, y in rows if x is not None]
+        if not rows:
+            raise ValueError('no extractions with logprob stats to fit on')
+        X = np.column_stack([np.ones(len(rows)), np.array([x for x, _ in rows], dtype=float)])
+        y = np.array([float(v) for _, v in rows])
+        reg = l2 * np.eye(X.shape[1])
+        reg[0, 0] = 0.0                     # bias is not penalized
+        beta = np.array([self.bias, *self.weights], dtype=float)
+        for _ in range(iterations):
+            p = 1 / (1 + np.exp(-np.clip(X @ beta, -50, 50)))
+            grad = X.T @ (p - y) + reg @ beta
+            hess = (X * (p * (1 - p))[:, None]).T @ X + reg
+            step = np.linalg.solve(hess, grad)
+            beta -= step
+            if np.abs(step).max() < 1e-8:
+                break
+        self.bias, self.weights = float(beta[0]), [float(b) for b in beta[1:]]
+        return self
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {'features': list(CALIBRATION_FEATURES), 'weights': self.weights, 'bias': self.bias}
+
+    def save(self, path: Union[str, Path]):
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    @classmethod
+    def load(cls, path: Union[str, Path]) -> 'LogprobCalibrator':
+        with open(path) as f:
+            spec = json.load(f)
+        return cls(spec['weights'], spec['bias'])
+
+
+class CascadePolicy:
+    """
+    When to spend an Agent 4 call. Calibrated confidence at or below `low`
+    is used as is; anything above it, or no logprob stats at all, goes to
+    the LLM. `low` may not exceed 5, so every skip still trips review_flag's
+    confidence <= 5 rule and agent_review_flag is unchanged.
+
+    `high` (off by default) also skips at or above it. That drops Agent 4's
+    FLAG (atypical presentation, rare diagnosis, urgency mismatch) for those
+    cases, so it needs a calibrator fitted on labelled extractions.
+    """
+
+    def __init__(self, calibrator: Optional[LogprobCalibrator] = None, low: int = 3,
+                 high: Optional[int] = None):
+        if low > 5:
+            raise ValueError('low must be <= 5 so skipped low-confidence cases stay flagged')
+        if high is not None:
+            if high <= low:
+                raise ValueError('high must be above low')
+            if calibrator is None:
+                raise ValueError('high-side skipping needs a fitted calibrator, not the default weights')
+        self.calibrator = calibrator or LogprobCalibrator()
+        self.low = low
+        self.high = high
+        self.stats = {'llm': 0, 'skipped_low': 0, 'skipped_high': 0, 'no_logprobs': 0}
+
+    def decide(self, field_logprobs: Optional[Dict[str, Dict[str, float]]]) -> Tuple[Optional[int], bool]:
+        """(calibrated confidence, whether Agent 4 should run)."""
+        confidence = self.calibrator.confidence(field_logprobs)
+        if confidence is None:
+            self.stats['no_logprobs'] += 1
+            self.stats['llm'] += 1
+            return None, True
+        if confidence <= self.low:
+            self.stats['skipped_low'] += 1
+            return confidence, False
+        if self.high is not None and confidence >= self.high:
+            self.stats['skipped_high'] += 1
+            return confidence, False
+        self.stats['llm'] += 1
+        return confidence, True
+
+
+def cascade_score(backend: ExtractionBackend, items: Sequence[Tuple[str, Dict[str, Any]]],
+                  policy: Optional[CascadePolicy] = None, batch_size: int = 8,
+                  compressor: Optional[NoteCompressor] = None) -> List[Dict[str, Any]]:
+    """
+    Agent 4 results for (note_text, ai_analysis) pairs, in order, calling
+    the LLM only where policy says so. Skipped items get the calibrated
+    confidence, flagged False and reason 'none' (by default only low
+    confidences are skipped, which review_flag flags anyway); every result
+    has 'source' ('llm' or 'logprob') and 'logprob_confidence'.
+    """
+    policy = policy or CascadePolicy()
+    results: List[Optional[Dict[str, Any]]] = [None] * len(items)
+    calibrated: List[Optional[int]] = []
+    pending: List[int] = []
+    for i, (_, ai) in enumerate(items):
+        confidence, run_llm = policy.decide(ai.get('_field_logprobs'))
+        calibrated.append(confidence)
+        if run_llm:
+            pending.append(i)
+        else:
+            results[i] = {'confidence': confidence, 'flagged': False, 'reason': 'none', 'raw': '',
+                          'source': 'logprob', 'logprob_confidence': confidence}
+
+    scored = agent4_score(backend, [items[i] for i in pending], batch_size, compressor) if pending else []
+    for i, a4 in zip(pending, scored):
+        results[i] = {**a4, 'source': 'llm', 'logprob_confidence': calibrated[i]}
+    return results
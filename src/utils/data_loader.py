@@ -0,0 +1,113 @@
+"""
+Data Loading Utilities
+Random-access reader for the JSONL + offset-index shards written by
+scripts/data_pipeline.py --shard
+"""
+
+import json
+import mmap
+import struct
+from pathlib import Path
+from typing import Any, Callable, Iterator, List, Optional, Tuple, Union
+
+# Index layout (must match scripts/data_pipeline.py::ShardWriter):
+#   8-byte magic, uint64 record count N, then N + 1 uint64 byte offsets
+#   into the .jsonl file, all little-endian
+SHARD_MAGIC = b"TRCSHRD1"
+_U64 = struct.Struct("<Q")
+_HEADER_SIZE = len(SHARD_MAGIC) + _U64.size
+
+
+class JSONLShard:
+    """
+    Memory-mapped view over a JSONL shard and its offset index.
+
+    Only the records you touch are parsed: len() reads the header,
+    shard[i] reads two offsets and decodes one line.
+
+        with JSONLShard("output/training_final_400.jsonl") as shard:
+            ex = shard[183402]
+            batch = shard[1000:1032]
+            for i, ex in shard.iter_filtered(contains='"urgency": "high"'):
+                ...
+    """
+
+    def __init__(self, path: Union[str, Path]):
+        path = Path(path)
+        self.data_path = path.with_suffix(".jsonl")
+        self.index_path = path.with_suffix(".idx")
+
+        self._index_file = open(self.index_path, "rb")
+        self._index = mmap.mmap(self._index_file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._index[:len(SHARD_MAGIC)] != SHARD_MAGIC:
+            self.close()
+            raise ValueError(f"{self.index_path} is not a shard index")
+        (self._count,) = _U64.unpack_from(self._index, len(SHARD_MAGIC))
+
+        self._data_file = open(self.data_path, "rb")
+        # mmap cannot map an empty file; an empty shard has nothing to read anyway
+        self._data = (mmap.mmap(self._data_file.fileno(), 0, access=mmap.ACCESS_READ)
+                      if self._count else b"")
+
+    def __len__(self) -> int:
+        return self._count
+
+    def _offset(self, i: int) -> int:
+        return _U64.unpack_from(self._index, _HEADER_SIZE + _U64.size * i)[0]
+
+    def span(self, i: int) -> Tuple[int, int]:
+        """Byte range of record i in the .jsonl file (newline excluded)."""
+        if i < 0:
+            i += self._count
+        if not 0 <= i < self._count:
+            raise IndexError(f"shard index {i} out of range ({self._count} records)")
+        return self._offset(i), self._offset(i + 1) - 1
+
+    def raw(self, i: int) -> bytes:
+        """Undecoded bytes of record i."""
+        start, end = self.span(i)
+        return self._data[start:end]
+
+    def __getitem__(self, key: Union[int, slice]) -> Union[Any, List[Any]]:
+        if isinstance(key, slice):
+            return [json.loads(self.raw(i)) for i in range(*key.indices(self._count))]
+        return json.loads(self.raw(key))
+
+    def __iter__(self) -> Iterator[Any]:
+        for i in range(self._count):
+            yield json.loads(self.raw(i))
+
+    def iter_filtered(
+        self,
+        contains: Optional[Union[str, bytes]] = None,
+        where: Optional[Callable[[Any], bool]] = None,
+        indices: Optional[range] = None,
+    ) -> Iterator[Tuple[int, Any]]:
+        """
+        Yield (index, record) pairs.
+
+        contains: raw substring test applied BEFORE parsing — records that
+                  do not contain it are never decoded
+        where:    predicate on the decoded record
+        indices:  restrict to these record numbers (default: all)
+        """
+        needle = contains.encode("utf-8") if isinstance(contains, str) else contains
+        for i in (indices if indices is not None else range(self._count)):
+            raw = self.raw(i)
+            if needle is not None and needle not in raw:
+                continue
+            record = json.loads(raw)
+            if where is None or where(record):
+                yield i, record
+
+    def close(self):
+        for handle in ("_data", "_data_file", "_index", "_index_file"):
+            obj = getattr(self, handle, None)
+            if obj is not None and hasattr(obj, "close"):
+                obj.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
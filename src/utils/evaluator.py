@@ -4,10 +4,123 @@ Compares base MedGemma vs fine-tuned model on hypothesis extraction task
 """
 
 import json
-from typing import Dict, List, Tuple
-from dataclasses import dataclass
+import re
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from pathlib import Path
+from typing import IO, Any, Dict, Iterator, List, Optional, Sequence, Tuple, Union
+from dataclasses import dataclass, field
 from datetime import datetime
 
+DEFAULT_CONCEPTS_PATH = Path(__file__).with_name("medical_concepts.json")
+
+_PAREN_RE = re.compile(r"\([^)]*\)")
+_APOSTROPHE_RE = re.compile(r"['\u2019]")
+_NON_WORD_RE = re.compile(r"[^a-z0-9]+")
+
+
+class ConceptIndex:
+    """
+    Precompiled synonym / category lookup for hypothesis scoring.
+
+    Built once from a concepts file (see medical_concepts.json):
+        abbreviations: {"mi": "myocardial infarction", ...}
+        categories:    {"cancer": {"keywords": [...], "suffixes": [...]}, ...}
+        concepts:      {"colon cancer": {"category": "cancer", "synonyms": [...]}, ...}
+
+    Every surface form is normalized (case, punctuation, abbreviations) into
+    a term -> concept-id map, so synonym and category checks are dict lookups.
+    """
+
+    def __init__(self, spec: Dict, cache_size: int = 65536):
+        self._spec = spec
+        self.abbreviations: Dict[str, str] = {
+            self._clean(k): self._clean(v) for k, v in spec.get("abbreviations", {}).items()
+        }
+
+        # Category order is priority order when a text hits several
+        self.categories: List[str] = list(spec.get("categories", {}))
+        self.keyword_category: Dict[str, int] = {}
+        suffixes = []
+        for rank, (name, cat) in enumerate(spec.get("categories", {}).items()):
+            for kw in cat.get("keywords", []):
+                self.keyword_category.setdefault(self.canonical(kw), rank)
+            suffixes.extend((self._clean(sfx), rank) for sfx in cat.get("suffixes", []))
+        self.suffixes: Tuple[Tuple[str, int], ...] = tuple(suffixes)
+        self.max_keyword_words = max((kw.count(" ") + 1 for kw in self.keyword_category), default=1)
+
+        self.concept_names: List[str] = []
+        self.concept_category: List[str] = []
+        self.term_concept: Dict[str, int] = {}
+        for name, concept in spec.get("concepts", {}).items():
+            cid = len(self.concept_names)
+            self.concept_names.append(name)
+            self.concept_category.append(concept.get("category", "other"))
+            for term in [name] + list(concept.get("synonyms", [])):
+                self.term_concept.setdefault(self.canonical(term), cid)
+
+        # Per-instance memoization: eval sweeps repeat the same strings a lot
+        self.normalize = lru_cache(maxsize=cache_size)(self._clean)
+        self.concept_of = lru_cache(maxsize=cache_size)(self._concept_of)
+        self.category_of = lru_cache(maxsize=cache_size)(self._category_of)
+
+    @classmethod
+    def from_file(cls, path: Union[str, Path]) -> "ConceptIndex":
+        with open(path) as f:
+            return cls(json.load(f))
+
+    @staticmethod
+    def _clean(text: str) -> str:
+        """Lowercase, drop punctuation, collapse whitespace."""
+        text = _APOSTROPHE_RE.sub("", text.lower())
+        return _NON_WORD_RE.sub(" ", text).strip()
+
+    def canonical(self, text: str) -> str:
+        """Normalized text with abbreviations expanded ("Acute MI" -> "acute myocardial infarction")."""
+        words = self._clean(text).split()
+        return " ".join(self.abbreviations.get(w, w) for w in words)
+
+    def _concept_of(self, text: str) -> Optional[int]:
+        """Concept id for text, or None. Parenthetical qualifiers are ignored on a miss."""
+        cid = self.term_concept.get(self.canonical(text))
+        if cid is None and "(" in text:
+            cid = self.term_concept.get(self.canonical(_PAREN_RE.sub(" ", text)))
+        return cid
+
+    def _category_of(self, text: str) -> str:
+        cid = self.concept_of(text)
+        if cid is not None and self.concept_category[cid] != "other":
+            return self.concept_category[cid]
+
+        words = self.canonical(text).split()
+        best = len(self.categories)
+        for n in range(1, self.max_keyword_words + 1):
+            for i in range(len(words) - n + 1):
+                rank = self.keyword_category.get(" ".join(words[i:i + n]))
+                if rank is not None and rank < best:
+                    best = rank
+        for word in words:
+            for sfx, rank in self.suffixes:
+                if rank < best and word.endswith(sfx):
+                    best = rank
+        return self.categories[best] if best < len(self.categories) else "other"
+
+    def same_concept(self, a: str, b: str) -> bool:
+        ca = self.concept_of(a)
+        return ca is not None and ca == self.concept_of(b)
+
+    def __reduce__(self):
+        # The memoized lookups are not picklable; rebuild from the spec instead
+        return (ConceptIndex, (self._spec,))
+
+
+@lru_cache(maxsize=None)
+def load_concept_index(path: Union[str, Path] = DEFAULT_CONCEPTS_PATH) -> ConceptIndex:
+    """Load (once per path) and return a ConceptIndex."""
+    return ConceptIndex.from_file(path)
+
+
 @dataclass
 class EvaluationMetric:
     """Single evaluation result"""
@@ -18,11 +131,500 @@ class EvaluationMetric:
     partial_credit: float  # 0.0 to 1.0
     notes: str
 
+# Scoring tiers, in increasing order of credit (see evaluate_extraction)
+TIER_NONE, TIER_PARTIAL, TIER_CATEGORY, TIER_SYNONYM, TIER_EXACT = range(5)
+TIER_NAMES = ("none", "partial", "category", "synonym", "exact")
+
+
+@dataclass
+class BatchResult:
+    """
+    Columnar scores for a batch of (expected, extracted) pairs.
+    Arrays are aligned; tier holds TIER_* codes, category the expected
+    text's category index (-1 = other) into category_names, and
+    extracted_category the same for the extracted text.
+    """
+    example_id: Any
+    score: Any
+    tier: Any
+    correct: Any
+    overlap: Any
+    category: Any
+    extracted_category: Any
+    category_names: List[str]
+    expected: Sequence[str] = field(repr=False)
+    extracted: Sequence[str] = field(repr=False)
+
+    def __len__(self) -> int:
+        return len(self.score)
+
+    def metrics(self) -> Dict:
+        """Same aggregates as HypothesisEvaluator.compute_metrics."""
+        total = len(self)
+        if not total:
+            return {}
+        correct = int(self.correct.sum())
+        partial_correct = int((self.score >= 0.7).sum())
+        return {
+            "total_examples": total,
+            "exact_correct": correct,
+            "exact_accuracy": correct / total,
+            "partial_correct": partial_correct,
+            "partial_accuracy": partial_correct / total,
+            "average_score": float(self.score.mean())
+        }
+
+    def tier_counts(self) -> Dict[str, int]:
+        import numpy as np
+        counts = np.bincount(self.tier, minlength=len(TIER_NAMES))
+        return {name: int(c) for name, c in zip(TIER_NAMES, counts)}
+
+    def notes(self, i: int) -> str:
+        tier = self.tier[i]
+        if tier == TIER_EXACT:
+            return "Exact match"
+        if tier == TIER_SYNONYM:
+            return "Synonym match"
+        if tier == TIER_CATEGORY:
+            return f"Same category ({self.category_names[self.category[i]]}) but different specificity"
+        if tier == TIER_PARTIAL:
+            return f"Partial overlap ({self.overlap[i]} words)"
+        return "No match"
+
+    def iter_metrics(self) -> Iterator[EvaluationMetric]:
+        """Row view, for code that still wants EvaluationMetric objects."""
+        for i in range(len(self)):
+            yield EvaluationMetric(
+                example_id=int(self.example_id[i]),
+                expected_hypothesis=self.expected[i],
+                extracted_hypothesis=self.extracted[i],
+                is_correct=bool(self.correct[i]),
+                partial_credit=float(self.score[i]),
+                notes=self.notes(i)
+            )
+
+    @classmethod
+    def concat(cls, parts: List["BatchResult"]) -> "BatchResult":
+        import numpy as np
+        return cls(
+            example_id=np.concatenate([p.example_id for p in parts]),
+            score=np.concatenate([p.score for p in parts]),
+            tier=np.concatenate([p.tier for p in parts]),
+            correct=np.concatenate([p.correct for p in parts]),
+            overlap=np.concatenate([p.overlap for p in parts]),
+            category=np.concatenate([p.category for p in parts]),
+            extracted_category=np.concatenate([p.extracted_category for p in parts]),
+            category_names=parts[0].category_names,
+            expected=[t for p in parts for t in p.expected],
+            extracted=[t for p in parts for t in p.extracted],
+        )
+
+
+def _score_batch(index: ConceptIndex, expected: Sequence[str], extracted: Sequence[str],
+                 example_ids) -> BatchResult:
+    """
+    Vectorized evaluate_extraction. Each distinct string is normalized and
+    looked up once; the tier cascade then runs as array ops over integer codes.
+    Word overlap is only computed for distinct pairs that miss every other tier.
+    """
+    import numpy as np
+
+    n = len(expected)
+    strings: Dict[str, int] = {}
+    exp_code = np.fromiter((strings.setdefault(t, len(strings)) for t in expected), np.int64, n)
+    ext_code = np.fromiter((strings.setdefault(t, len(strings)) for t in extracted), np.int64, n)
+
+    cat_ids = {name: i for i, name in enumerate(index.categories)}
+    norms: Dict[str, int] = {}
+    norm_of = np.empty(len(strings), np.int64)
+    concept_of = np.empty(len(strings), np.int64)
+    category_of = np.empty(len(strings), np.int64)
+    for i, text in enumerate(strings):
+        norm_of[i] = norms.setdefault(index.normalize(text), len(norms))
+        cid = index.concept_of(text)
+        concept_of[i] = -1 if cid is None else cid
+        category_of[i] = cat_ids.get(index.category_of(text), -1)
+
+    norm_e, norm_x = norm_of[exp_code], norm_of[ext_code]
+    con_e, con_x = concept_of[exp_code], concept_of[ext_code]
+    cat_e, cat_x = category_of[exp_code], category_of[ext_code]
+
+    exact = norm_e == norm_x
+    synonym = ~exact & (con_e >= 0) & (con_e == con_x)
+    category = ~exact & ~synonym & (cat_e >= 0) & (cat_e == cat_x)
+    rest = ~(exact | synonym | category)
+
+    overlap = np.zeros(n, np.int64)
+    jaccard = np.zeros(n)
+    if rest.any():
+        words = [set(t.split()) for t in norms]
+        pair_key = norm_e[rest] * len(norms) + norm_x[rest]
+        pairs, inverse = np.unique(pair_key, return_inverse=True)
+        pair_overlap = np.empty(len(pairs), np.int64)
+        pair_jaccard = np.empty(len(pairs))
+        for j, key in enumerate(pairs.tolist()):
+            a, b = words[key // len(norms)], words[key % len(norms)]
+            common = len(a & b)
+            pair_overlap[j] = common
+            pair_jaccard[j] = common / len(a | b) if common else 0.0
+        overlap[rest] = pair_overlap[inverse.ravel()]
+        jaccard[rest] = pair_jaccard[inverse.ravel()]
+
+    tier = np.full(n, TIER_NONE, np.int8)
+    tier[rest & (overlap > 0)] = TIER_PARTIAL
+    tier[category] = TIER_CATEGORY
+    tier[synonym] = TIER_SYNONYM
+    tier[exact] = TIER_EXACT
+    score = np.array([0.0, 0.0, 0.7, 0.9, 1.0])[tier]
+    partial = tier == TIER_PARTIAL
+    score[partial] = np.minimum(jaccard[partial], 0.5)
+
+    return BatchResult(
+        example_id=np.asarray(example_ids, np.int64),
+        score=score,
+        tier=tier,
+        correct=exact | synonym,
+        overlap=overlap,
+        category=cat_e,
+        extracted_category=cat_x,
+        category_names=list(index.categories),
+        expected=expected,
+        extracted=extracted,
+    )
+
+
+# Per-process concept index for the evaluate_batch process pool
+_WORKER_INDEX: Optional[ConceptIndex] = None
+
+
+def _init_batch_worker(index: ConceptIndex):
+    global _WORKER_INDEX
+    _WORKER_INDEX = index
+
+
+def _score_chunk(args) -> BatchResult:
+    expected, extracted, example_ids = args
+    return _score_batch(_WORKER_INDEX, expected, extracted, example_ids)
+
+
+def _tier_of(is_correct: bool, score: float) -> int:
+    """Recover the scoring tier from an EvaluationMetric's correctness and credit."""
+    if is_correct:
+        return TIER_EXACT if score == 1.0 else TIER_SYNONYM
+    if score == 0.7:
+        return TIER_CATEGORY
+    return TIER_PARTIAL if score > 0 else TIER_NONE
+
+
+HISTOGRAM_BINS = 10
+
+
+class MetricsAccumulator:
+    """
+    Running aggregates for streaming evaluation: O(1) memory per result.
+    Tracks the compute_metrics counters plus a score histogram, per-tier
+    counts and an expected x extracted category confusion table.
+    """
+    __slots__ = ("total", "correct", "partial_correct", "score_sum",
+                 "histogram", "tiers", "confusion")
+
+    def __init__(self):
+        self.total = 0
+        self.correct = 0
+        self.partial_correct = 0
+        self.score_sum = 0.0
+        self.histogram = [0] * HISTOGRAM_BINS
+        self.tiers = [0] * len(TIER_NAMES)
+        self.confusion: Dict[Tuple[str, str], int] = {}
+
+    def update(self, score: float, is_correct: bool, tier: int,
+               expected_cat: str, extracted_cat: str):
+        self.total += 1
+        self.correct += is_correct
+        self.partial_correct += score >= 0.7
+        self.score_sum += score
+        self.histogram[min(int(score * HISTOGRAM_BINS), HISTOGRAM_BINS - 1)] += 1
+        self.tiers[tier] += 1
+        key = (expected_cat, extracted_cat)
+        self.confusion[key] = self.confusion.get(key, 0) + 1
+
+    def update_batch(self, batch: BatchResult):
+        """Fold a whole BatchResult in with array reductions."""
+        import numpy as np
+
+        self.total += len(batch)
+        self.correct += int(batch.correct.sum())
+        self.partial_correct += int((batch.score >= 0.7).sum())
+        self.score_sum += float(batch.score.sum())
+        bins = np.minimum((batch.score * HISTOGRAM_BINS).astype(np.int64), HISTOGRAM_BINS - 1)
+        for i, c in enumerate(np.bincount(bins, minlength=HISTOGRAM_BINS)):
+            self.histogram[i] += int(c)
+        for i, c in enumerate(np.bincount(batch.tier, minlength=len(TIER_NAMES))):
+            self.tiers[i] += int(c)
+
+        names = batch.category_names + ["other"]  # index -1 -> "other"
+        pairs, counts = np.unique(np.stack([batch.category, batch.extracted_category]),
+                                  axis=1, return_counts=True)
+        for (e, x), c in zip(pairs.T.tolist(), counts.tolist()):
+            key = (names[e], names[x])
+            self.confusion[key] = self.confusion.get(key, 0) + c
+
+    def metrics(self) -> Dict:
+        """Same keys as HypothesisEvaluator.compute_metrics."""
+        if not self.total:
+            return {}
+        return {
+            "total_examples": self.total,
+            "exact_correct": self.correct,
+            "exact_accuracy": self.correct / self.total,
+            "partial_correct": self.partial_correct,
+            "partial_accuracy": self.partial_correct / self.total,
+            "average_score": self.score_sum / self.total
+        }
+
+    def summary(self) -> Dict:
+        confusion: Dict[str, Dict[str, int]] = {}
+        for (e, x), c in sorted(self.confusion.items()):
+            confusion.setdefault(e, {})[x] = c
+        return {
+            "score_histogram": {
+                f"{i / HISTOGRAM_BINS:.1f}-{(i + 1) / HISTOGRAM_BINS:.1f}": c
+                for i, c in enumerate(self.histogram)
+            },
+            "tiers": dict(zip(TIER_NAMES, self.tiers)),
+            "category_confusion": confusion
+        }
+
+
+class ResultStore:
+    """Compact per-result rows (typed arrays, no strings) for streaming mode."""
+    __slots__ = ("example_id", "score", "tier", "correct")
+
+    def __init__(self):
+        self.example_id = array("q")
+        self.score = array("d")
+        self.tier = array("b")
+        self.correct = array("b")
+
+    def append(self, example_id: int, score: float, tier: int, is_correct: bool):
+        self.example_id.append(example_id)
+        self.score.append(score)
+        self.tier.append(tier)
+        self.correct.append(is_correct)
+
+    def extend_batch(self, batch: BatchResult):
+        self.example_id.extend(batch.example_id.tolist())
+        self.score.extend(batch.score.tolist())
+        self.tier.extend(batch.tier.tolist())
+        self.correct.extend(batch.correct.tolist())
+
+    def __len__(self) -> int:
+        return len(self.score)
+
+    def rows(self) -> Iterator[Dict]:
+        for i in range(len(self)):
+            yield {
+                "example_id": self.example_id[i],
+                "correct": bool(self.correct[i]),
+                "score": self.score[i],
+                "tier": TIER_NAMES[self.tier[i]]
+            }
+
+
+class CharNGramSimilarity:
+    """
+    Character n-gram TF-IDF similarity (cosine over sparse vectors).
+
+    Robust to word order and inflection where whitespace Jaccard is not:
+    "adenocarcinoma of colon" vs "colon adenocarcinoma (stage II)".
+    Text goes through ConceptIndex.canonical first, so abbreviations are
+    expanded before n-grams are taken. scipy is imported lazily.
+
+        sim = CharNGramSimilarity().fit(all_hypotheses)
+        match = sim.match_differentials(extracted, primaries, differentials)
+    """
+
+    def __init__(self, ngram_range: Tuple[int, int] = (3, 5),
+                 concepts: Optional[ConceptIndex] = None, sublinear_tf: bool = True):
+        self.ngram_range = ngram_range
+        self.concepts = concepts or load_concept_index()
+        self.sublinear_tf = sublinear_tf
+        self.vocab: Optional[Dict[str, int]] = None
+        self.idf = None
+
+    def _ngrams(self, text: str) -> List[str]:
+        padded = f" {self.concepts.canonical(text)} "
+        lo, hi = self.ngram_range
+        return [padded[i:i + n] for n in range(lo, hi + 1) for i in range(len(padded) - n + 1)]
+
+    def fit(self, texts: Sequence[str]) -> "CharNGramSimilarity":
+        """Learn the n-gram vocabulary and smoothed IDF weights from texts."""
+        import numpy as np
+
+        df: Dict[str, int] = {}
+        unique = set(texts)
+        for text in unique:
+            for gram in set(self._ngrams(text)):
+                df[gram] = df.get(gram, 0) + 1
+        self.vocab = {gram: i for i, gram in enumerate(df)}
+        counts = np.fromiter(df.values(), np.float64, len(df))
+        self.idf = np.log((1 + len(unique)) / (1 + counts)) + 1
+        return self
+
+    def transform(self, texts: Sequence[str]):
+        """L2-normalized TF-IDF rows (scipy.sparse CSR), one per text."""
+        import numpy as np
+        from scipy import sparse
+
+        if self.vocab is None:
+            raise ValueError("CharNGramSimilarity is not fitted; call fit() first")
+
+        strings: Dict[str, int] = {}
+        codes = np.fromiter((strings.setdefault(t, len(strings)) for t in texts), np.int64, len(texts))
+        indptr, indices, data = [0], [], []
+        for text in strings:
+            tf: Dict[int, int] = {}
+            for gram in self._ngrams(text):
+                col = self.vocab.get(gram)
+                if col is not None:
+                    tf[col] = tf.get(col, 0) + 1
+            indices.extend(tf)
+            data.extend(tf.values())
+            indptr.append(len(indices))
+
+        data = np.asarray(data, np.float64)
+        if self.sublinear_tf:
+            data = 1 + np.log(data)
+        matrix = sparse.csr_matrix((data, np.asarray(indices, np.int64), np.asarray(indptr)),
+                                   shape=(len(strings), len(self.vocab)))
+        matrix = matrix @ sparse.diags(self.idf)
+        norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+        norms[norms == 0] = 1
+        matrix = sparse.diags(1 / norms) @ matrix
+        return matrix.tocsr()[codes]
+
+    def similarity(self, a: Sequence[str], b: Sequence[str]):
+        """Row-wise cosine similarity of aligned sequences a[i] vs b[i]."""
+        import numpy as np
+        if len(a) != len(b):
+            raise ValueError(f"a has {len(a)} items, b has {len(b)}")
+        return np.asarray(self.transform(a).multiply(self.transform(b)).sum(axis=1)).ravel()
+
+    def top_k(self, queries: Sequence[str], candidates: Sequence[str], k: int = 5):
+        """
+        For each query, the k most similar candidates.
+        Returns (indices, scores), both shaped (len(queries), k); missing
+        slots (fewer than k candidates share an n-gram) are -1 / 0.0.
+        """
+        import numpy as np
+
+        sims = (self.transform(queries) @ self.transform(candidates).T).tocsr()
+        indices = np.full((len(queries), k), -1, np.int64)
+        scores = np.zeros((len(queries), k))
+        for row in range(len(queries)):
+            lo, hi = sims.indptr[row], sims.indptr[row + 1]
+            if lo == hi:
+                continue
+            row_scores, row_cols = sims.data[lo:hi], sims.indices[lo:hi]
+            best = np.argsort(-row_scores, kind="stable")[:k]
+            indices[row, :len(best)] = row_cols[best]
+            scores[row, :len(best)] = row_scores[best]
+        return indices, scores
+
+    def match_differentials(
+        self,
+        extracted: Sequence[str],
+        primaries: Sequence[str],
+        differentials: Sequence[Sequence[str]],
+        top_k: int = 3,
+        threshold: float = 0.5
+    ) -> Dict[str, Any]:
+        """
+        Score each extracted hypothesis against its own expected primary and
+        differential list in one sparse product. Candidate rank 0 is the
+        primary, 1.. the differentials in order. Fits on the inputs if the
+        engine has not been fitted yet.
+
+        Returns aligned arrays: primary_score, best_score, best_rank,
+        top_rank / top_score (n x top_k, -1 / 0.0 padded) and in_differential
+        (best match is a differential at >= threshold while the primary is not).
+        """
+        import numpy as np
+
+        n = len(extracted)
+        if not (n == len(primaries) == len(differentials)):
+            raise ValueError("extracted, primaries and differentials must be the same length")
+
+        sizes = np.fromiter((1 + len(d) for d in differentials), np.int64, n)
+        owner = np.repeat(np.arange(n), sizes)
+        starts = np.concatenate(([0], np.cumsum(sizes)[:-1]))
+        rank = np.arange(len(owner)) - starts[owner]
+        candidates = [t for primary, diffs in zip(primaries, differentials) for t in [primary, *diffs]]
+
+        if self.vocab is None:
+            self.fit(list(extracted) + candidates)
+        queries = self.transform(extracted)[owner]
+        sims = np.asarray(queries.multiply(self.transform(candidates)).sum(axis=1)).ravel()
+
+        # Order candidates by (example, -score); the position within each
+        # example's run gives its top-k slot
+        order = np.lexsort((rank, -sims, owner))
+        slot = np.arange(len(order)) - starts[owner[order]]
+        keep = order[slot < top_k]
+        top_rank = np.full((n, top_k), -1, np.int64)
+        top_score = np.zeros((n, top_k))
+        top_rank[owner[keep], slot[slot < top_k]] = rank[keep]
+        top_score[owner[keep], slot[slot < top_k]] = sims[keep]
+
+        primary_score = sims[starts]
+        best_score, best_rank = top_score[:, 0], top_rank[:, 0]
+        return {
+            "primary_score": primary_score,
+            "best_score": best_score,
+            "best_rank": best_rank,
+            "top_rank": top_rank,
+            "top_score": top_score,
+            "in_differential": (best_rank > 0) & (best_score >= threshold) & (primary_score < threshold),
+        }
+
+
 class HypothesisEvaluator:
     """Evaluate hypothesis extraction accuracy"""
     
-    def __init__(self):
+    def __init__(
+        self,
+        concepts: Optional[Union[str, Path, ConceptIndex]] = None,
+        streaming: bool = False,
+        sink: Optional[Union[str, Path, IO[str]]] = None,
+        keep_rows: bool = True
+    ):
+        """
+        streaming: fold results into running aggregates instead of keeping
+                   every EvaluationMetric in self.results
+        sink:      streaming only; JSONL path or text file to write full
+                   result rows to
+        keep_rows: streaming only; keep compact rows (ids, scores, tiers)
+                   in memory for generate_report's detailed_results
+        """
         self.results: List[EvaluationMetric] = []
+        if isinstance(concepts, ConceptIndex):
+            self.concepts = concepts
+        else:
+            self.concepts = load_concept_index(concepts or DEFAULT_CONCEPTS_PATH)
+
+        self.streaming = streaming
+        self.aggregate = MetricsAccumulator() if streaming else None
+        self.rows = ResultStore() if streaming and keep_rows else None
+        self.sink_path = None
+        self._owns_sink = False
+        self.sink = None
+        if streaming and sink is not None:
+            if isinstance(sink, (str, Path)):
+                self.sink_path = str(sink)
+                self.sink = open(sink, "w")
+                self._owns_sink = True
+            else:
+                self.sink = sink
     
     def evaluate_extraction(
         self,
@@ -39,13 +641,16 @@ class HypothesisEvaluator:
         - Correct category but different specificity (e.g., "cancer" vs "colon cancer"): 0.7
         - Related but wrong (e.g., "colon cancer" vs "lymphoma"): 0.3
         - Completely wrong: 0.0
+
+        Synonyms and categories come from self.concepts (a ConceptIndex).
         """
         
-        expected_lower = expected.lower().strip()
-        extracted_lower = extracted.lower().strip()
+        index = self.concepts
+        expected_norm = index.normalize(expected)
+        extracted_norm = index.normalize(extracted)
         
         # Exact match
-        if expected_lower == extracted_lower:
+        if expected_norm == extracted_norm:
             return EvaluationMetric(
                 example_id=example_id,
                 expected_hypothesis=expected,
@@ -56,42 +661,19 @@ class HypothesisEvaluator:
             )
         
         # Synonym matching (medical terminology)
-        synonyms = {
-            "colon cancer": ["colorectal cancer", "colonic malignancy", "bowel cancer"],
-            "pneumonia": ["lung infection", "pulmonary infection", "cap"],
-            "myocardial infarction": ["heart attack", "mi", "acute mi"],
-            "pulmonary embolism": ["pe", "lung clot"],
-            "sepsis": ["severe infection", "septic shock"]
-        }
-        
-        for canonical, variations in synonyms.items():
-            if expected_lower == canonical or expected_lower in variations:
-                if extracted_lower == canonical or extracted_lower in variations:
-                    return EvaluationMetric(
-                        example_id=example_id,
-                        expected_hypothesis=expected,
-                        extracted_hypothesis=extracted,
-                        is_correct=True,
-                        partial_credit=0.9,
-                        notes="Synonym match"
-                    )
+        if index.same_concept(expected, extracted):
+            return EvaluationMetric(
+                example_id=example_id,
+                expected_hypothesis=expected,
+                extracted_hypothesis=extracted,
+                is_correct=True,
+                partial_credit=0.9,
+                notes="Synonym match"
+            )
         
         # Category match (e.g., both are cancers)
-        cancer_keywords = ["cancer", "malignancy", "tumor", "carcinoma", "lymphoma", "leukemia"]
-        infection_keywords = ["infection", "sepsis", "pneumonia", "meningitis"]
-        cardiac_keywords = ["infarction", "heart attack", "mi", "ischemia"]
-        
-        def get_category(text):
-            if any(kw in text for kw in cancer_keywords):
-                return "cancer"
-            if any(kw in text for kw in infection_keywords):
-                return "infection"
-            if any(kw in text for kw in cardiac_keywords):
-                return "cardiac"
-            return "other"
-        
-        expected_cat = get_category(expected_lower)
-        extracted_cat = get_category(extracted_lower)
+        expected_cat = index.category_of(expected)
+        extracted_cat = index.category_of(extracted)
         
         if expected_cat == extracted_cat and expected_cat != "other":
             return EvaluationMetric(
@@ -104,8 +686,8 @@ class HypothesisEvaluator:
             )
         
         # Partial match (some overlap in words)
-        expected_words = set(expected_lower.split())
-        extracted_words = set(extracted_lower.split())
+        expected_words = set(expected_norm.split())
+        extracted_words = set(extracted_norm.split())
         overlap = expected_words & extracted_words
         
         if len(overlap) > 0:
@@ -129,12 +711,101 @@ class HypothesisEvaluator:
             notes="No match"
         )
     
+    def evaluate_batch(
+        self,
+        expected: Sequence[str],
+        extracted: Sequence[str],
+        example_ids: Optional[Sequence[int]] = None,
+        workers: int = 1,
+        chunk_size: int = 50000
+    ) -> BatchResult:
+        """
+        Score many pairs at once; same rules and scores as evaluate_extraction.
+
+        Returns a columnar BatchResult (NumPy arrays for score, tier and
+        correctness) instead of one EvaluationMetric per pair. Results are
+        not added to self.results. With workers > 1 (0 = all cores), batches
+        larger than chunk_size are split across a process pool.
+        """
+        if len(expected) != len(extracted):
+            raise ValueError(f"expected has {len(expected)} items, extracted has {len(extracted)}")
+        n = len(expected)
+        if example_ids is None:
+            example_ids = range(n)
+        elif len(example_ids) != n:
+            raise ValueError(f"example_ids has {len(example_ids)} items, expected {n}")
+
+        if workers == 1 or n <= chunk_size:
+            return _score_batch(self.concepts, expected, extracted, example_ids)
+
+        chunks = [
+            (expected[i:i + chunk_size], extracted[i:i + chunk_size], example_ids[i:i + chunk_size])
+            for i in range(0, n, chunk_size)
+        ]
+        with ProcessPoolExecutor(max_workers=workers or None, initializer=_init_batch_worker,
+                                 initargs=(self.concepts,)) as pool:
+            return BatchResult.concat(list(pool.map(_score_chunk, chunks)))
+    
     def add_result(self, metric: EvaluationMetric):
         """Add evaluation result"""
-        self.results.append(metric)
+        if not self.streaming:
+            self.results.append(metric)
+            return
+
+        tier = _tier_of(metric.is_correct, metric.partial_credit)
+        self.aggregate.update(
+            metric.partial_credit, metric.is_correct, tier,
+            self.concepts.category_of(metric.expected_hypothesis),
+            self.concepts.category_of(metric.extracted_hypothesis)
+        )
+        if self.rows is not None:
+            self.rows.append(metric.example_id, metric.partial_credit, tier, metric.is_correct)
+        if self.sink is not None:
+            self.sink.write(json.dumps({
+                "example_id": metric.example_id,
+                "expected": metric.expected_hypothesis,
+                "extracted": metric.extracted_hypothesis,
+                "correct": metric.is_correct,
+                "score": metric.partial_credit,
+                "notes": metric.notes
+            }) + "\n")
+
+    def add_batch(self, batch: BatchResult):
+        """Add a BatchResult from evaluate_batch (streaming mode only)."""
+        if not self.streaming:
+            raise ValueError("add_batch requires streaming=True; use batch.iter_metrics() otherwise")
+        self.aggregate.update_batch(batch)
+        if self.rows is not None:
+            self.rows.extend_batch(batch)
+        if self.sink is not None:
+            for i in range(len(batch)):
+                self.sink.write(json.dumps({
+                    "example_id": int(batch.example_id[i]),
+                    "expected": batch.expected[i],
+                    "extracted": batch.extracted[i],
+                    "correct": bool(batch.correct[i]),
+                    "score": float(batch.score[i]),
+                    "notes": batch.notes(i)
+                }) + "\n")
+
+    def close(self):
+        """Flush/close a sink opened from a path."""
+        if self.sink is not None:
+            self.sink.flush()
+            if self._owns_sink:
+                self.sink.close()
+                self.sink = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
     
     def compute_metrics(self) -> Dict:
         """Compute aggregate metrics"""
+        if self.streaming:
+            return self.aggregate.metrics()
         if not self.results:
             return {}
         
@@ -155,6 +826,18 @@ class HypothesisEvaluator:
     def generate_report(self, model_name: str) -> Dict:
         """Generate full evaluation report"""
         metrics = self.compute_metrics()
+
+        if self.streaming:
+            report = {
+                "model": model_name,
+                "evaluation_date": datetime.now().isoformat(),
+                "metrics": metrics,
+                "aggregates": self.aggregate.summary(),
+                "detailed_results": list(self.rows.rows()) if self.rows is not None else []
+            }
+            if self.sink_path:
+                report["detailed_results_file"] = self.sink_path
+            return report
         
         report = {
             "model": model_name,
@@ -182,6 +865,130 @@ class HypothesisEvaluator:
             json.dump(report, f, indent=2)
 
 
+# Model output field names (notebooks' parse_fields); training data uses the aliases
+LIST_FIELDS = ("differential_diagnoses", "key_supporting_evidence", "tests_ordered")
+FIELD_ALIASES = {
+    "key_symptoms": "key_supporting_evidence",
+    "urgency": "urgency_level",
+    "reasoning": "clinical_reasoning",
+}
+URGENCY_LABELS = ("low", "medium", "high")
+
+_ITEM_SPLIT_RE = re.compile(r"[,;\n]|\s+-\s+|\u2022")
+
+
+def _field(record: Dict, name: str) -> Any:
+    """record[name], accepting the training-data alias of a model field."""
+    if name in record:
+        return record[name]
+    for alias, target in FIELD_ALIASES.items():
+        if target == name and alias in record:
+            return record[alias]
+    return None
+
+
+def normalize_urgency(value: Any) -> str:
+    """Same mapping as parse_fields: high / low / medium (moderate), default medium."""
+    u = str(value or "").lower()
+    if "high" in u:
+        return "high"
+    if "low" in u:
+        return "low"
+    return "medium"
+
+
+class FieldEvaluator:
+    """
+    Field-level grading of structured extractions.
+
+    List fields are split (lists or comma-separated strings) into canonical
+    item sets and scored with set precision/recall/F1; urgency gets a
+    confusion matrix; the primary hypothesis goes through evaluate_batch.
+    Canonical items are cached in self.item_cache, which can be shared
+    between evaluators so a run normalizes each distinct item once.
+    """
+
+    def __init__(self, concepts: Optional[Union[str, Path, ConceptIndex]] = None,
+                 item_cache: Optional[Dict[str, str]] = None):
+        self.hypotheses = HypothesisEvaluator(concepts)
+        self.concepts = self.hypotheses.concepts
+        self.item_cache: Dict[str, str] = {} if item_cache is None else item_cache
+
+    def canonical_item(self, item: str) -> str:
+        """Concept name for known terms, else the normalized, abbreviation-expanded text."""
+        key = self.item_cache.get(item)
+        if key is None:
+            cid = self.concepts.concept_of(item)
+            key = self.concepts.concept_names[cid] if cid is not None else self.concepts.canonical(item)
+            self.item_cache[item] = key
+        return key
+
+    def item_set(self, value: Any) -> set:
+        if not value:
+            return set()
+        items = value if isinstance(value, list) else _ITEM_SPLIT_RE.split(str(value))
+        keys = {self.canonical_item(str(item).strip().strip("[]")) for item in items}
+        keys.discard("")
+        return keys
+
+    def evaluate(self, expected: Sequence[Dict], extracted: Sequence[Dict]) -> Dict:
+        """
+        Grade aligned lists of expected / extracted field dicts.
+
+        Per list field: micro precision/recall/F1 over all items and macro
+        (per-example mean) F1. Empty-vs-empty counts as a perfect example.
+        """
+        import numpy as np
+
+        if len(expected) != len(extracted):
+            raise ValueError(f"expected has {len(expected)} items, extracted has {len(extracted)}")
+        n = len(expected)
+        if not n:
+            return {}
+
+        report: Dict[str, Any] = {"examples": n}
+
+        primary = self.hypotheses.evaluate_batch(
+            [str(_field(r, "primary_hypothesis") or "") for r in expected],
+            [str(_field(r, "primary_hypothesis") or "") for r in extracted],
+        )
+        report["primary_hypothesis"] = primary.metrics()
+
+        fields = {}
+        for name in LIST_FIELDS:
+            counts = np.zeros((3, n), np.int64)  # matched, expected, extracted
+            for i, (e, x) in enumerate(zip(expected, extracted)):
+                want, got = self.item_set(_field(e, name)), self.item_set(_field(x, name))
+                counts[0, i], counts[1, i], counts[2, i] = len(want & got), len(want), len(got)
+            tp, n_exp, n_ext = counts
+            precision = tp.sum() / n_ext.sum() if n_ext.sum() else 0.0
+            recall = tp.sum() / n_exp.sum() if n_exp.sum() else 0.0
+            with np.errstate(divide="ignore", invalid="ignore"):
+                per_f1 = np.where(n_exp + n_ext > 0, 2 * tp / (n_exp + n_ext), 1.0)
+            fields[name] = {
+                "precision": float(precision),
+                "recall": float(recall),
+                "f1": float(2 * precision * recall / (precision + recall)) if precision + recall else 0.0,
+                "macro_f1": float(per_f1.mean()),
+                "matched_items": int(tp.sum()),
+                "expected_items": int(n_exp.sum()),
+                "extracted_items": int(n_ext.sum()),
+            }
+        report["fields"] = fields
+
+        label = {u: i for i, u in enumerate(URGENCY_LABELS)}
+        want = np.fromiter((label[normalize_urgency(_field(r, "urgency_level"))] for r in expected), np.int64, n)
+        got = np.fromiter((label[normalize_urgency(_field(r, "urgency_level"))] for r in extracted), np.int64, n)
+        confusion = np.bincount(want * len(URGENCY_LABELS) + got,
+                                minlength=len(URGENCY_LABELS) ** 2).reshape(len(URGENCY_LABELS), -1)
+        report["urgency"] = {
+            "labels": list(URGENCY_LABELS),
+            "confusion": confusion.tolist(),  # rows = expected, columns = extracted
+            "accuracy": float(np.trace(confusion) / n),
+        }
+        return report
+
+
 def compare_models(base_results_path: str, finetuned_results_path: str) -> Dict:
     """Compare base vs fine-tuned model performance"""
     
@@ -212,6 +1019,133 @@ def compare_models(base_results_path: str, finetuned_results_path: str) -> Dict:
     return comparison
 
 
+# Metrics compared by compare_many, as functions of (correct, score) per example
+LEADERBOARD_METRICS = ("exact_accuracy", "partial_accuracy", "average_score")
+
+
+def _load_detailed_results(path: str) -> Tuple[str, Dict[int, Tuple[bool, float]]]:
+    """Model name and {example_id: (correct, score)} from a saved report."""
+    with open(path) as f:
+        report = json.load(f)
+    rows = report.get("detailed_results") or []
+    if not rows and report.get("detailed_results_file"):
+        with open(report["detailed_results_file"]) as f:
+            rows = [json.loads(line) for line in f if line.strip()]
+    return report["model"], {r["example_id"]: (bool(r["correct"]), float(r["score"])) for r in rows}
+
+
+def compare_many(
+    report_paths: Sequence[str],
+    n_resamples: int = 10000,
+    confidence: float = 0.95,
+    seed: int = 0,
+    rank_by: str = "average_score",
+    output_path: Optional[str] = None,
+    max_block: int = 20_000_000
+) -> Dict:
+    """
+    Compare any number of saved evaluation reports with paired bootstrap CIs.
+
+    Reports are aligned on example_id (only examples present in every report
+    are used), then all models are resampled with the SAME bootstrap indices
+    so differences are paired. Returns (and optionally writes) a leaderboard
+    ranked by rank_by, with a CI per metric and, for every model below the
+    leader, the delta to the leader with its CI and two-sided p-value.
+    max_block caps the draw-count elements materialized per resampling block.
+    """
+    import numpy as np
+
+    if rank_by not in LEADERBOARD_METRICS:
+        raise ValueError(f"rank_by must be one of {LEADERBOARD_METRICS}")
+
+    names, tables = [], []
+    for path in report_paths:
+        name, table = _load_detailed_results(path)
+        if name in names:
+            name = f"{name} ({Path(path).stem})"
+        names.append(name)
+        tables.append(table)
+
+    common = set(tables[0]) if tables else set()
+    for table in tables[1:]:
+        common &= set(table)
+    ids = sorted(common)
+    n, m = len(ids), len(names)
+    if not n:
+        raise ValueError("reports share no example_id values")
+
+    correct = np.array([[t[i][0] for i in ids] for t in tables], np.float64)
+    score = np.array([[t[i][1] for i in ids] for t in tables], np.float64)
+    per_example = {
+        "exact_accuracy": correct,
+        "partial_accuracy": (score >= 0.7).astype(np.float64),
+        "average_score": score,
+    }
+    stacked = np.stack([per_example[k] for k in LEADERBOARD_METRICS])  # (metrics, models, n)
+    point = stacked.mean(axis=2)
+
+    # boot[k, j, b]: metric k of model j on resample b. Each resample is
+    # expressed as per-example draw counts, so a block of resamples for all
+    # models and metrics is a single (metrics*models x n) @ (n x block) matmul
+    rng = np.random.default_rng(seed)
+    flat = stacked.reshape(-1, n)
+    boot = np.empty((flat.shape[0], n_resamples))
+    block = max(1, max_block // n)
+    for lo in range(0, n_resamples, block):
+        hi = min(lo + block, n_resamples)
+        idx = rng.integers(0, n, size=(hi - lo, n))
+        idx += np.arange(hi - lo)[:, None] * n
+        counts = np.bincount(idx.ravel(), minlength=(hi - lo) * n).reshape(hi - lo, n)
+        boot[:, lo:hi] = flat @ counts.T / n
+    boot = boot.reshape(len(LEADERBOARD_METRICS), m, n_resamples)
+
+    alpha = (1 - confidence) / 2
+    ci_lo, ci_hi = np.quantile(boot, [alpha, 1 - alpha], axis=2)
+
+    k_rank = LEADERBOARD_METRICS.index(rank_by)
+    order = np.argsort(-point[k_rank], kind="stable")
+    best = order[0]
+    diff = boot - boot[:, best:best + 1, :]  # paired deltas vs leader
+    d_lo, d_hi = np.quantile(diff, [alpha, 1 - alpha], axis=2)
+    p_value = np.minimum(1.0, 2 * np.minimum((diff <= 0).mean(axis=2), (diff >= 0).mean(axis=2)))
+
+    leaderboard = []
+    for rank, j in enumerate(order.tolist(), start=1):
+        entry = {
+            "rank": rank,
+            "model": names[j],
+            "metrics": {
+                k: {"value": float(point[ki, j]), "ci": [float(ci_lo[ki, j]), float(ci_hi[ki, j])]}
+                for ki, k in enumerate(LEADERBOARD_METRICS)
+            },
+        }
+        if j != best:
+            entry["vs_leader"] = {
+                k: {
+                    "delta": float(point[ki, j] - point[ki, best]),
+                    "ci": [float(d_lo[ki, j]), float(d_hi[ki, j])],
+                    "p_value": float(p_value[ki, j]),
+                    "significant": bool(p_value[ki, j] < 1 - confidence),
+                }
+                for ki, k in enumerate(LEADERBOARD_METRICS)
+            }
+        leaderboard.append(entry)
+
+    result = {
+        "evaluation_date": datetime.now().isoformat(),
+        "examples_compared": n,
+        "examples_dropped": {names[j]: len(tables[j]) - n for j in range(m)},
+        "n_resamples": n_resamples,
+        "confidence": confidence,
+        "ranked_by": rank_by,
+        "leader": names[best],
+        "leaderboard": leaderboard,
+    }
+    if output_path:
+        with open(output_path, 'w') as f:
+            json.dump(result, f, indent=2)
+    return result
+
 # Example usage
 if __name__ == "__main__":
     # This will be used after we test both models
@@ -0,0 +1,25 @@
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "scripts"))
+
+from data_pipeline import dedup_training_examples, lsh_clusters, minhash_signatures  # noqa: E402
+
+NOTE = ("54-year-old male with three days of substernal chest pain radiating to the left arm, "
+        "diaphoresis and nausea. ECG shows ST depression in V4-V6; troponin pending.")
+
+
+def _notes(n):
+    return [{"input": NOTE + f" Bed {i}."} for i in range(n)]
+
+
+def test_cluster_keeps_lowest_valid_index_when_first_is_rejected(tmp_path):
+    drop = dedup_training_examples(_notes(4), str(tmp_path), threshold=0.8, rejected={0})
+    # 0 goes as a rejection, 1 survives as the keeper, 2 and 3 are duplicates of it
+    assert drop == {2, 3}
+
+
+def test_cluster_without_valid_member_is_not_reported():
+    signatures = minhash_signatures(ex["input"] for ex in _notes(3))
+    assert lsh_clusters(signatures, threshold=0.8, rejected={0, 1, 2}) == []
+    assert lsh_clusters(signatures, threshold=0.8)[0]["keep"] == 0
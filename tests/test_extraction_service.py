@@ -0,0 +1,151 @@
+import asyncio
+import random
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from src.ai.extraction_service import (  # noqa: E402
+    ExtractionService, MicroBatcher, QueueFull, ServiceStopped,
+)
+from src.ai.hypothesis_extractor import HypothesisExtractor, StandInBackend  # noqa: E402
+
+
+class RecordingBackend(StandInBackend):
+    """Stand-in that remembers every prompt it generated for."""
+
+    def __init__(self, latency: float = 0.0):
+        super().__init__(latency=latency)
+        self.prompts = []
+
+    def generate(self, prompts, params, prefix=None):
+        self.prompts.extend(prompts)
+        return super().generate(prompts, params, prefix=prefix)
+
+
+def _note(i):
+    return f"Patient {i} reports chest pain for {i + 1} days with shortness of breath."
+
+
+def _expected(notes):
+    extractor = HypothesisExtractor(StandInBackend())
+    return {note: extractor.extract_one(note).fields for note in notes}
+
+
+async def _fill(batcher):
+    """Submit until the queue is at capacity; the worker holds the rest."""
+    tasks = []
+    while not batcher.queue.full():
+        tasks.append(asyncio.ensure_future(batcher.submit(_note(len(tasks)))))
+        await asyncio.sleep(0)
+    return tasks
+
+
+def test_full_queue_rejects_with_queue_full_and_429():
+    async def run():
+        batcher = MicroBatcher(StandInBackend(latency=0.05), max_batch_size=1, max_queue=2)
+        service = ExtractionService(batcher)
+        await batcher.start()
+        tasks = await _fill(batcher)
+
+        with pytest.raises(QueueFull):
+            await batcher.submit(_note(99))
+        status, body, headers = await service._route('POST', '/extract', b'{"note": "chest pain"}')
+        assert (status, headers) == (429, {'Retry-After': '1'})
+
+        results = await asyncio.gather(*tasks)
+        await batcher.stop()
+        return results, batcher.counters
+
+    results, counters = asyncio.run(run())
+    assert counters['rejected'] == 2
+    assert counters['accepted'] == counters['completed'] == len(results)
+
+
+def test_collect_loses_and_duplicates_nothing_when_busy_ends_mid_get():
+    async def run(seed):
+        rng = random.Random(seed)
+        batcher = MicroBatcher(StandInBackend(), max_batch_size=64, max_wait_ms=0)
+        batcher.queue = asyncio.Queue()
+
+        async def produce():
+            for i in range(40):
+                for _ in range(rng.randint(0, 2)):
+                    await asyncio.sleep(0)
+                batcher.queue.put_nowait((i, None, 0.0))
+
+        async def device():
+            for _ in range(rng.randint(1, 30)):
+                await asyncio.sleep(0)
+
+        producer = asyncio.ensure_future(produce())
+        collected = []
+        while not (producer.done() and batcher.queue.empty()):
+            busy = asyncio.ensure_future(device())
+            collected += [item[0] for item in await batcher._collect(busy)]
+            await busy
+        return collected
+
+    for seed in range(25):
+        assert asyncio.run(run(seed)) == list(range(40))
+
+
+def test_each_request_gets_its_own_result_under_load():
+    notes = [_note(i) for i in range(60)]
+    expected = _expected(notes)
+
+    async def run():
+        backend = StandInBackend(latency=0.002)
+        batcher = MicroBatcher(backend, max_batch_size=8, max_wait_ms=2)
+        await batcher.start()
+        rng = random.Random(0)
+
+        async def client(note):
+            await asyncio.sleep(rng.random() * 0.05)
+            return note, await batcher.submit(note)
+
+        answers = await asyncio.gather(*(client(note) for note in notes))
+        await batcher.stop()
+        return answers, batcher.counters
+
+    answers, counters = asyncio.run(run())
+    assert all(result['fields'] == expected[note] for note, result in answers)
+    assert counters['completed'] == counters['batched_notes'] == len(notes)
+
+
+def test_cancelled_requests_are_not_generated():
+    async def run():
+        backend = RecordingBackend(latency=0.05)
+        batcher = MicroBatcher(backend, max_batch_size=4, max_wait_ms=0)
+        await batcher.start()
+        first = asyncio.ensure_future(batcher.submit(_note(0)))
+        await asyncio.sleep(0.01)  # note 0 is on the device
+        waiting = [asyncio.ensure_future(batcher.submit(_note(i))) for i in (1, 2, 3)]
+        await asyncio.sleep(0)
+        waiting[1].cancel()
+        results = await asyncio.gather(first, waiting[0], waiting[2])
+        await batcher.stop()
+        return backend.prompts, results
+
+    prompts, results = asyncio.run(run())
+    assert len(results) == 3
+    assert not any(_note(2) in prompt for prompt in prompts)
+    assert sum(_note(1) in prompt for prompt in prompts) == 1
+
+
+def test_stop_fails_requests_in_flight_and_queued():
+    async def run():
+        batcher = MicroBatcher(StandInBackend(latency=0.05), max_batch_size=1, max_queue=4)
+        await batcher.start()
+        tasks = await _fill(batcher)
+        await batcher.stop()
+        outcomes = await asyncio.wait_for(asyncio.gather(*tasks, return_exceptions=True), 1)
+        with pytest.raises(ServiceStopped):
+            await batcher.submit(_note(0))
+        return outcomes
+
+    outcomes = asyncio.run(run())
+    assert len(outcomes) == 6
+    assert all(isinstance(outcome, ServiceStopped) for outcome in outcomes)